@@ -0,0 +1 @@
+../_utils/_aws_utils.py
\ No newline at end of file
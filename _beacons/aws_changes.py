@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Beacon firing events when the AWS data behind the grains changes.
+
+Rather than refreshing every grain on a timer, this beacon polls cheap change
+signals: the latest scaling activities of the instance's autoscaling group
+(and any other listed groups) and the associations of elastic IPs. Events
+are only fired when one of them has changed, and name the grains that need
+refreshing. The shared inventory snapshot is discarded at the same time so
+that the refresh sees the change.
+
+.. code-block:: yaml
+
+    beacons:
+      aws_changes:
+        - interval: 30
+        - groups:
+            - my-other-asg
+        - eips:
+            - 1.2.3.4
+            - 5.6.7.8
+
+Events are fired with the tags ``salt/beacon/<minion>/aws_changes/asg`` and
+``salt/beacon/<minion>/aws_changes/eip``.
+"""
+import logging
+import os
+
+import _aws_utils  # noqa: F401, puts _utils on sys.path
+import aws_clients
+import aws_inventory
+import aws_metadata
+import aws_stats
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'aws_changes'
+
+STATE_FILE = os.path.join(aws_metadata.CACHE_DIR, 'beacon-aws-changes.json')
+# Number of recent scaling activities compared on each poll
+ACTIVITY_WINDOW = 20
+# Grains affected by scaling activities, no grain carries EIP associations
+ASG_GRAINS = ['ec2_neighbours', 'elb_lbs']
+
+
+def __virtual__():
+    if not aws_metadata.is_ec2():
+        return (False, 'The aws_changes beacon only runs on EC2 instances')
+    return __virtualname__
+
+
+def _merge_config(config):
+    # Beacon config is a list of single key dictionaries in newer salt
+    if isinstance(config, dict):
+        return config
+    merged = {}
+    for item in config:
+        merged.update(item)
+    return merged
+
+
+def validate(config):
+    """
+    Validate the beacon configuration.
+    """
+    if not isinstance(config, (list, dict)):
+        return False, 'Configuration for aws_changes beacon must be a list.'
+    config = _merge_config(config)
+    for key in ('groups', 'eips'):
+        if not isinstance(config.get(key, []), list):
+            return False, ('Configuration for aws_changes beacon {} must be '
+                           'a list.'.format(key))
+    return True, 'Valid beacon configuration'
+
+
+def _activity_signatures(autoscale, group_name):
+    """
+    Returns 'activity_id:status_code' for the latest scaling activities of
+    the group, which change when instances launch, terminate or move in or
+    out of standby, and when those activities complete.
+    """
+    activities = autoscale.get_all_activities(group_name,
+                                              max_records=ACTIVITY_WINDOW)
+    return ['{}:{}'.format(a.activity_id, a.status_code) for a in activities]
+
+
+def _associations(ec2_conn, eips):
+    """
+    Returns {public_ip: instance_id} for the listed, or all, addresses.
+    """
+    return dict((address.public_ip, address.instance_id)
+                for address in ec2_conn.get_all_addresses(
+                    addresses=eips or None))
+
+
+def _poll(config, instance_metadata, previous, state):
+    """
+    Fill state with the current activity signatures and associations.
+    """
+    region = instance_metadata['region']
+    autoscale = aws_clients.get_connection('ec2.autoscale', region)
+    groups = list(config.get('groups', []))
+    # The group of an instance does not change, so it is only looked
+    # up in the inventory on the first poll
+    if previous and 'group' in previous:
+        own = previous['group']
+    else:
+        own = aws_inventory.find_group(
+            aws_inventory.get_section(region, instance_metadata['vpc-id'],
+                                      'groups'),
+            instance_metadata['instance-id'])
+    state['group'] = own
+    if own and own not in groups:
+        groups.append(own)
+    for group_name in groups:
+        state['activities'][group_name] = _activity_signatures(
+            autoscale, group_name)
+
+    ec2_conn = aws_clients.get_connection('ec2', region)
+    state['associations'] = _associations(ec2_conn, config.get('eips'))
+
+
+def beacon(config):
+    """
+    Poll the change signals, returning an event for each kind that
+    changed since the last poll. The first poll only records them.
+    """
+    config = _merge_config(config)
+    instance_metadata = aws_metadata.get_instance_metadata().static()
+    previous = aws_metadata.read_json(STATE_FILE)
+    state = {'activities': {}, 'associations': {}}
+    events = []
+
+    try:
+        with aws_stats.scope('beacons.aws_changes'):
+            _poll(config, instance_metadata, previous, state)
+    except Exception as e:
+        log.error("Error polling AWS changes: {}".format(e))
+        return []
+
+    aws_metadata.write_json_atomic(STATE_FILE, state)
+    if previous is None:
+        return []
+
+    for group_name, signatures in state['activities'].items():
+        if group_name not in previous['activities']:
+            continue
+        seen = set(previous['activities'][group_name])
+        changed = [s for s in signatures if s not in seen]
+        if changed:
+            events.append({
+                'tag': 'asg',
+                'group': group_name,
+                'activities': changed,
+                'grains': ASG_GRAINS,
+            })
+
+    changed = dict((ip, instance_id)
+                   for ip, instance_id in state['associations'].items()
+                   if previous['associations'].get(ip) != instance_id)
+    if changed:
+        events.append({
+            'tag': 'eip',
+            'associations': changed,
+            'grains': [],
+        })
+
+    if events:
+        log.info("AWS changes detected: {}".format(
+            ', '.join(event['tag'] for event in events)))
+        aws_inventory.invalidate()
+    return events
@@ -1,16 +1,48 @@
 #!/usr/bin/env python
-import boto.ec2
-import boto.utils
 import logging
 import sys
-  
+
+import _aws_utils  # noqa: F401, puts _utils on sys.path
+import aws_collector
+import aws_inventory
+import aws_metadata
+import aws_neighbours
+
+
+def __virtual__():
+    """
+    Only load on EC2 instances, checked without any network calls where
+    possible so grains load quickly elsewhere. When the aws_topology
+    ext_pillar provides the neighbours, the grain only collects ec2_local.
+    """
+    if not aws_metadata.is_ec2():
+        return False
+    # Salt imports the module before asking, so only join the collection
+    # rounds once loaded
+    aws_collector.register('ec2_neighbours', _collect)
+    return True
+
+
+def _get_option(name, default=None):
+    """
+    Read an option from the minion config, if running under salt.
+    """
+    return globals().get('__opts__', {}).get(name, default)
+
 
 def set_grain_instances_by_vpc():
     """
     Prints a mapping of private ip addresses to private dns names
     """
+    return aws_collector.get('ec2_neighbours', globals().get('__opts__'))
+
+
+def _collect():
+    """
+    Collect the ec2_local and ec2_neighbours grains from AWS.
+    """
     try:
-        instance_metadata = boto.utils.get_instance_metadata(timeout=5, num_retries=2)
+        instance_metadata = aws_metadata.get_instance_metadata().static()
     except Exception as e:
         sys.stderr.write("Error getting VPC ips: {}".format(e))
         return {'custom_grain_error': True}
@@ -22,35 +54,71 @@ def set_grain_instances_by_vpc():
     ec2_local['private_ip_address'] = instance_metadata['local-ipv4']
     ec2_local['private_dns_name'] = instance_metadata['local-hostname']
     ec2_local['private_dns_name_safe'] =  ec2_local['private_dns_name'].split('.')[0].replace('.','-')
-    ec2_local['vpc_id'] = instance_metadata['network']['interfaces']['macs'].values()[0]['vpc-id']
-    ec2_local['region'] = instance_metadata['placement']['availability-zone'][:-1]
+    ec2_local['vpc_id'] = instance_metadata['vpc-id']
+    ec2_local['region'] = instance_metadata['region']
     
     
-    # Collect neighbours of this instance (in the same vpc)
+    # The aws_topology ext_pillar hands out the neighbours instead, the
+    # grain only carries the local details it needs to find this minion
+    if _get_option('aws_topology_source') == 'pillar':
+        return {'ec2_local': ec2_local}
+
+    # Collect neighbours of this instance (in the same vpc, narrowed
+    # down by any configured scopes)
     ec2_neighbours = {}
+    # In index mode the neighbours are kept in a local index, queried with
+    # the aws.neighbours execution module, instead of in the grains
+    index_mode = _get_option('aws_neighbours_mode') == 'index'
+    indexed = []
+    ttl = _get_option('aws_inventory_ttl', aws_inventory.SNAPSHOT_TTL)
     try:
-        ec2_conn = boto.ec2.connect_to_region(ec2_local['region'])
-        all_vpc_instances = ec2_conn.get_only_instances(
-            filters={
-                'vpc_id':ec2_local['vpc_id'],
-                'instance-state-name': 'running'
-            }
-        )
-        vpc_instances = [i for i in all_vpc_instances if i.vpc_id == ec2_local['vpc_id'] and i.private_ip_address != ec2_local['private_ip_address'] ]
-        for i in vpc_instances:
-            ec2_neighbours[str(i.private_ip_address)] = {
-                'private_dns_name': str(i.private_dns_name),
-                'private_dns_name_safe': str(i.private_dns_name).split('.')[0].replace('.','-')
-            }
+        instances = aws_inventory.get_section(
+            ec2_local['region'], ec2_local['vpc_id'], 'instances', ttl=ttl)
+        own = instances.get(instance_metadata['instance-id'], {})
+        in_scope = aws_neighbours.scope_filter(
+            {
+                'subnet_id': instance_metadata['subnet-id'],
+                'availability_zone': instance_metadata['availability-zone'],
+                'asg': own.get('asg'),
+            },
+            _get_option('aws_neighbours_scope'),
+            _get_option('aws_neighbours_tags'))
+        neighbours = aws_neighbours.neighbours_in_scope(
+            instances, ec2_local['private_ip_address'], in_scope)
+        if index_mode:
+            indexed = [{
+                'ip': str(i['private_ip_address']),
+                'instance_id': i['instance_id'],
+                'private_dns_name': str(i['private_dns_name']),
+                'subnet_id': i['subnet_id'],
+                'availability_zone': i['availability_zone'],
+                'asg': i['asg'],
+                'tags': i['tags']
+            } for i in neighbours]
+            indexed.sort(key=lambda n: aws_neighbours.ip_to_int(n['ip']))
+            index = aws_neighbours.NeighbourIndex()
+            index.replace(indexed)
+        else:
+            ec2_neighbours = aws_neighbours.neighbour_map(neighbours)
     except Exception as e:
       sys.stderr.write("Error getting VPC ips: {}".format(e))
       return {'custom_grain_error': True}
-    
+
+    if index_mode:
+        return {
+            'ec2_local': ec2_local,
+            'ec2_neighbours_summary': {
+                'count': len(indexed),
+                'hash': aws_metadata.content_hash(indexed),
+                'index': index.path
+            }
+        }
     return {
         'ec2_local': ec2_local,
         'ec2_neighbours': ec2_neighbours
     }
-            
+
 
 if __name__ == '__main__':
-    print set_grain_instances_by_vpc()
+    if __virtual__():
+        print set_grain_instances_by_vpc()
@@ -1,17 +1,39 @@
 #!/usr/bin/env python
 
+import os
 import sys
-import boto.ec2
-import boto.cloudformation
-import boto.ec2.autoscale
-import boto.elasticache
-from boto.utils import get_instance_identity, get_instance_metadata
+import time
 import logging
 
+import _aws_utils  # noqa: F401, puts _utils on sys.path
+import aws_clients
+import aws_collector
+import aws_inventory
+import aws_metadata
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+CACHE_FILE = os.path.join(aws_metadata.CACHE_DIR, 'elasticache.json')
+STACK_NAME_TAG = 'aws:cloudformation:stack-name'
+# Seconds the stack outputs are used before the stack is described again
+STACK_TTL = 3600
+
+
+def __virtual__():
+    """
+    Only load on EC2 instances, checked without any network calls where
+    possible so grains load quickly elsewhere.
+    """
+    if not aws_metadata.is_ec2():
+        return False
+    # Salt imports the module before asking, so only join the collection
+    # rounds once loaded
+    aws_collector.register('elasticache', _collect)
+    return True
+
+
 def get_elasticache_endpoints():
     """
     Get elasticache endpoints. 
@@ -22,10 +44,18 @@ def get_elasticache_endpoints():
     if there is already a grain ElasticacheReplicationGroupName
     containing the replication group name.
     
+    Read endpoints are ordered with the replicas in this instance's
+    availability zone first, and nearest_read_endpoint is the first of
+    them. Sharded (cluster mode) groups list each shard's nodes under
+    shards. AWS does not say which node of a cluster mode shard is its
+    primary, so there the shard's primary_endpoint is None and its
+    replica_endpoints are all of its nodes.
+
     Returns:
         For redis types, a dictionary containing the primary endpoint
         and a list of read endpoints. The default_endpoint is set to
-        be the primary_endpoint.
+        be the primary_endpoint, or the configuration endpoint in
+        cluster mode.
         {
             'elasticache':  {
             'primary_endpoint': {'address': <address>, 'port': <port>},
@@ -34,31 +64,56 @@ def get_elasticache_endpoints():
                 {'address': <address>, 'port': <port>},
                 {'address': <address>, 'port': <port>},
                 {'address': <address>, 'port': <port>}
+            ],
+            'nearest_read_endpoint': {'address': <address>, 'port': <port>},
+            'cluster_mode': <bool>,
+            'shards': [
+                {
+                    'id': <node group id>,
+                    'slots': <slots>,
+                    'primary_endpoint': {'address': <address>, 'port': <port>},
+                    'replica_endpoints': [...],
+                    'nearest_read_endpoint': {'address': <address>, 'port': <port>}
+                }
             ]
         }
     """
+    return aws_collector.get('elasticache', globals().get('__opts__'))
+
+
+def _collect():
+    """
+    Collect the elasticache grain from AWS.
+    """
+    # boto is imported here so that loading the grain is cheap
+    import boto.exception
+
     # Collect together instance data
     try:
-        instance_identity = boto.utils.get_instance_identity()
-        instance_id = instance_identity['document']['instanceId']
-        instance_region = instance_identity['document']['availabilityZone'].strip()[:-1]
-        conn = boto.ec2.connect_to_region(instance_region)
-        instance_data = conn.get_all_instances(
-            instance_ids=[instance_id])[0].instances[0]
-    except boto.exception.AWSConnectionError as e:
-        log.error("There was a problem collecting instance data, '{}'").format(e.message)
+        instance_metadata = aws_metadata.get_instance_metadata().static()
+        instance_id = instance_metadata['instance-id']
+        instance_region = instance_metadata['region']
+    except aws_metadata.MetadataError as e:
+        log.error("There was a problem collecting instance data, '{}'".format(e))
         return {}
-     
+
+    cache = aws_metadata.read_json(CACHE_FILE) or {}
+    if cache.get('instance_id') != instance_id:
+        cache = {'instance_id': instance_id}
+
     # Collect together clouformation data
-    try:   
-        cf_conn = boto.cloudformation.connect_to_region(instance_region)
-        stack_name = instance_data.tags['aws:cloudformation:stack-name']
-        stack_outputs = cf_conn.describe_stacks(stack_name)[0].outputs
-    except boto.exception.AWSConnectionError as e:
-        log.error("There was a problem collecting Cloudformation data, '{}'").format(e.message)
+    try:
+        stack_name = _get_stack_name(cache, instance_metadata)
+        outputs = _get_stack_outputs(cache, stack_name, instance_region)
+    except (boto.exception.BotoServerError,
+            boto.exception.AWSConnectionError,
+            aws_inventory.InventoryError,
+            aws_metadata.MetadataError) as e:
+        log.error("There was a problem collecting Cloudformation data, '{}'".format(e))
         return {}
+    finally:
+        aws_metadata.write_json_atomic(CACHE_FILE, cache)
 
-    outputs = {o.key: o.value for o in stack_outputs}
     if outputs.get('ElasticacheEngine', None) == 'redis':
         replication_group_id = outputs.get('ElasticacheReplicationGroupName', None)
 
@@ -71,7 +126,7 @@ def get_elasticache_endpoints():
         # Try to get the replication group data from AWS 
         replication_group = None
         try:
-            es_conn = boto.elasticache.connect_to_region(instance_region)
+            es_conn = aws_clients.get_connection('elasticache', instance_region)
             # We're assuming one replication group with one node group in this setup
             replication_group = es_conn.describe_replication_groups(replication_group_id).get('DescribeReplicationGroupsResponse',{}).get('DescribeReplicationGroupsResult', {}).get('ReplicationGroups', [None])[0]
         except Exception:
@@ -81,41 +136,234 @@ def get_elasticache_endpoints():
         if not replication_group:
             log.error("Could not find any replication group info on AWS for group id '%s'" % (replication_group_id))
             return {}
-        
+
+        # The endpoints only change along with the replication group, so
+        # while it is the same they are taken from the cache
+        availability_zone = instance_metadata.get('availability-zone')
+        signature = aws_metadata.content_hash([replication_group,
+                                               availability_zone])
+        endpoints = cache.get('endpoints') or {}
+        if (endpoints.get('replication_group_id') == replication_group_id and
+                endpoints.get('signature') == signature):
+            return endpoints['grain']
+
         # Check the replication group status.
         # In creation we go through 'creating'->'modifying'->'available'
         # Endpoints are ready only in the available stage, this is likely
         # to not be the case on first highstate, so we want to notify
         replication_group_status = replication_group.get('Status')
         if replication_group_status in ['creating', 'modifying', 'deleting']:
+            # A group that is being modified keeps its endpoints, so the
+            # ones from when it was last available are still good
+            if (replication_group_status == 'modifying' and
+                    endpoints.get('replication_group_id') == replication_group_id):
+                log.warning("The Elasticache replication group is '%s', using its endpoints from when it was last available" % (replication_group_status))
+                return endpoints['grain']
             log.error('The Elasticache replication group is not available yet, please update grains after AWS creation has completed.')
             return {}
 
-        node_group = replication_group.get('NodeGroups', [None])[0]
-        
-        if not node_group:
+        node_groups = replication_group.get('NodeGroups', [])
+        if not node_groups:
             log.error("Could not find any node group info on AWS for group id '%s'" % (replication_group_id))
             return {}
-            
-        primary_endpoint = node_group.get('PrimaryEndpoint', {})
-        read_endpoints = []
-        for member in node_group.get('NodeGroupMembers', []):
-            read_endpoint = member.get('ReadEndpoint', None)
-            if read_endpoint:
-                read_endpoints.append(read_endpoint)
-        
+
+        configuration_endpoint = replication_group.get('ConfigurationEndpoint')
+        if configuration_endpoint:
+            # Cluster mode groups give no endpoints for their shards or
+            # nodes, so they are looked up from the group's cache clusters
+            try:
+                endpoints = _node_endpoints(
+                    es_conn, replication_group.get('MemberClusters', []),
+                    cache.get('node_endpoints') or {})
+            except Exception:
+                log.error("There was a problem describing the Elasticache cache clusters")
+                return {}
+            cache['node_endpoints'] = endpoints
+            aws_metadata.write_json_atomic(CACHE_FILE, cache)
+            node_groups = [_with_node_endpoints(node_group, endpoints)
+                           for node_group in node_groups]
+
+        shards = [_shard(node_group, availability_zone)
+                  for node_group in node_groups]
+
+        # Every node endpoint across the shards, AZ-local replicas first
+        members = []
+        for node_group in node_groups:
+            members.extend(node_group.get('NodeGroupMembers', []))
+        read_endpoints = _read_endpoints(members, availability_zone)
+
+        primary_endpoint = (shards[0]['primary_endpoint'] or
+                            configuration_endpoint or {})
+        # Clients of a sharded cluster must discover the shards through the
+        # configuration endpoint rather than a single shard primary
+        default_endpoint = configuration_endpoint or primary_endpoint
+
         grain = {
             'elasticache':  {
-                'default_endpoint': primary_endpoint,
+                'default_endpoint': default_endpoint,
                 'primary_endpoint': primary_endpoint,
-                'read_endpoints': read_endpoints
+                'read_endpoints': read_endpoints,
+                'nearest_read_endpoint': (read_endpoints[0] if read_endpoints
+                                          else primary_endpoint),
+                'cluster_mode': len(node_groups) > 1 or bool(configuration_endpoint),
+                'shards': shards,
             }
         }
+        if replication_group_status == 'available':
+            cache['endpoints'] = {
+                'replication_group_id': replication_group_id,
+                'status': replication_group_status,
+                'signature': signature,
+                'grain': grain,
+            }
+            aws_metadata.write_json_atomic(CACHE_FILE, cache)
     else:
         log.info(("No known elasticache engine type found '%s'" ) % (outputs.get('ElasticacheEngine', None)))
         return {}
     
     return grain
 
+
+def _get_stack_name(cache, instance_metadata):
+    """
+    Returns the name of the CloudFormation stack that created the instance.
+
+    This can not change for the life of the instance, so it is kept in
+    the cache. Otherwise it is read from the instance tags in the metadata
+    service, if they are enabled there, and only failing that from the
+    shared inventory snapshot.
+    """
+    if cache.get('stack_name'):
+        return cache['stack_name']
+    stack_name = aws_metadata.get_instance_metadata().get(
+        'tags/instance/' + STACK_NAME_TAG, max_age=0)
+    if not stack_name:
+        instances = aws_inventory.get_section(
+            instance_metadata['region'], instance_metadata['vpc-id'],
+            'instances', ttl=globals().get('__opts__', {}).get(
+                'aws_inventory_ttl', aws_inventory.SNAPSHOT_TTL))
+        instance = instances.get(instance_metadata['instance-id'], {})
+        stack_name = instance.get('tags', {}).get(STACK_NAME_TAG)
+        if not stack_name:
+            raise aws_inventory.InventoryError(
+                "Instance has no {} tag".format(STACK_NAME_TAG))
+    cache['stack_name'] = stack_name
+    return stack_name
+
+
+def _get_stack_outputs(cache, stack_name, region):
+    """
+    Returns the outputs of the stack as a dictionary.
+
+    The outputs are cached and only described again once they are older
+    than the minion option aws_elasticache_stack_ttl. When the stack's
+    LastUpdatedTime has changed by then, the cached endpoints derived from
+    the old outputs are dropped too.
+    """
+    ttl = globals().get('__opts__', {}).get('aws_elasticache_stack_ttl',
+                                            STACK_TTL)
+    stack = cache.get('stack') or {}
+    if (stack.get('name') == stack_name and
+            time.time() - stack.get('checked', 0) < ttl):
+        return stack['outputs']
+
+    cf_conn = aws_clients.get_connection('cloudformation', region)
+    described = cf_conn.describe_stacks(stack_name)[0]
+    # boto sets LastUpdatedTime as is, it is missing until the first update
+    last_updated = str(getattr(described, 'LastUpdatedTime', None) or
+                       described.creation_time)
+    if stack and (stack.get('name') != stack_name or
+                  stack.get('last_updated') != last_updated):
+        log.info("Stack '%s' changed, updating its outputs" % (stack_name))
+        cache.pop('endpoints', None)
+    cache['stack'] = {
+        'name': stack_name,
+        'last_updated': last_updated,
+        'outputs': dict((o.key, o.value) for o in described.outputs),
+        'checked': time.time(),
+    }
+    return cache['stack']['outputs']
+
+
+def _node_endpoints(es_conn, member_clusters, cached):
+    """
+    Returns {cache cluster id: {cache node id: endpoint}} for the member
+    clusters of a replication group. A node keeps its endpoint for as long
+    as it exists, so only the member clusters missing from cached, which
+    has the same form, are described.
+    """
+    endpoints = {}
+    for cluster_id in member_clusters:
+        if cached.get(cluster_id):
+            endpoints[cluster_id] = cached[cluster_id]
+            continue
+        result = es_conn.describe_cache_clusters(
+            cache_cluster_id=cluster_id, show_cache_node_info=True).get(
+                'DescribeCacheClustersResponse', {}).get(
+                    'DescribeCacheClustersResult', {})
+        for cluster in result.get('CacheClusters') or []:
+            endpoints[cluster_id] = dict(
+                (node.get('CacheNodeId'), node.get('Endpoint'))
+                for node in cluster.get('CacheNodes') or []
+                if node.get('Endpoint'))
+    return endpoints
+
+
+def _with_node_endpoints(node_group, endpoints):
+    """
+    Returns a copy of a cluster mode node group with the ReadEndpoint of
+    each member set from endpoints, as cluster mode disabled groups have.
+    """
+    members = [dict(m, ReadEndpoint=endpoints.get(
+        m.get('CacheClusterId'), {}).get(m.get('CacheNodeId')))
+               for m in node_group.get('NodeGroupMembers', [])]
+    return dict(node_group, NodeGroupMembers=members)
+
+
+def _is_primary(member):
+    """
+    Whether a node group member is a shard primary. Only cluster mode
+    disabled groups report the CurrentRole of their members.
+    """
+    return member.get('CurrentRole') == 'primary'
+
+
+def _read_endpoints(members, availability_zone):
+    """
+    Returns the read endpoints of members, those in availability_zone first
+    and replicas before primaries, otherwise in the order AWS returned them.
+    """
+    ordered = sorted(
+        (m for m in members if m.get('ReadEndpoint')),
+        key=lambda m: (m.get('PreferredAvailabilityZone') != availability_zone,
+                       _is_primary(m)))
+    return [m['ReadEndpoint'] for m in ordered]
+
+
+def _shard(node_group, availability_zone):
+    """
+    Returns the primary and AZ ordered replica endpoints of a node group.
+    The primary is only known for cluster mode disabled groups, otherwise
+    every node is listed as a replica.
+    """
+    members = node_group.get('NodeGroupMembers', [])
+    primary_endpoint = node_group.get('PrimaryEndpoint')
+    if not primary_endpoint:
+        for member in members:
+            if _is_primary(member):
+                primary_endpoint = member.get('ReadEndpoint')
+    replicas = [m for m in members if not _is_primary(m)]
+    replica_endpoints = _read_endpoints(replicas, availability_zone)
+    return {
+        'id': node_group.get('NodeGroupId'),
+        'slots': node_group.get('Slots'),
+        'primary_endpoint': primary_endpoint,
+        'replica_endpoints': replica_endpoints,
+        'nearest_read_endpoint': (replica_endpoints[0] if replica_endpoints
+                                  else primary_endpoint),
+    }
+
+
 if __name__ == '__main__':
-    print get_elasticache_endpoints()
+    if __virtual__():
+        print get_elasticache_endpoints()
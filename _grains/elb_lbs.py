@@ -1,9 +1,12 @@
 #!/usr/bin/env python
-import boto.ec2.elb
-import boto.utils
 import logging
 import salt.log
 
+import _aws_utils  # noqa: F401, puts _utils on sys.path
+import aws_collector
+import aws_inventory
+import aws_metadata
+
 
 # configure a logger in case we are running it directly from python
 # (eg: command line or testing)
@@ -12,53 +15,68 @@ if not salt.log.is_logging_configured():
 log = logging.getLogger(__name__)
 
 
+def __virtual__():
+    """
+    Only load on EC2 instances, checked without any network calls where
+    possible so grains load quickly elsewhere. Not loaded either when the
+    aws_topology ext_pillar provides the load balancers.
+    """
+    if globals().get('__opts__', {}).get('aws_topology_source') == 'pillar':
+        return False
+    if not aws_metadata.is_ec2():
+        return False
+    # Salt imports the module before asking, so only join the collection
+    # rounds once loaded
+    aws_collector.register('elb_lbs', _collect)
+    return True
+
+
 def get_elb_lbs():
     """
     Returns a dictionary of load balancer names as keys
-    each with their respective attributes
+    each with their respective attributes, and a dictionary of
+    ALB/NLB target group names this instance is registered in.
+
+    The load balancers are looked up in a reverse index of instance id
+    to load balancers, kept in the shared inventory snapshot and used for
+    aws_elb_index_ttl seconds (minion config, default 60).
     """
+    return aws_collector.get('elb_lbs', globals().get('__opts__'))
 
-    # attributes to extract from the load balancer boto objects
-    # this could possibly be a named argument too
-    extract_attrs = ['scheme', 'dns_name', 'vpc_id', 'name', 'security_groups']
 
+def _collect():
+    """
+    Collect the lbs and target_groups grains from AWS.
+    """
     try:
-        instance_metadata = boto.utils.get_instance_metadata(timeout=5, num_retries=2)
+        instance_metadata = aws_metadata.get_instance_metadata().static()
     except Exception as e:
         log.exception("Error getting ELB names: {}".format(e))
         return {'custom_grain_error': True}
 
     # Setup the lbs grain
-    lbs_grain = {'lbs': {}}
+    lbs_grain = {'lbs': {}, 'target_groups': {}}
+    ttl = globals().get('__opts__', {}).get('aws_elb_index_ttl',
+                                            aws_inventory.SNAPSHOT_TTL)
 
     # Collect details about this instance
-    vpc_id = instance_metadata['network']['interfaces']['macs'].values()[0]['vpc-id']
-    region = instance_metadata['placement']['availability-zone'][:-1]
+    vpc_id = instance_metadata['vpc-id']
+    region = instance_metadata['region']
 
     # Collect load balancers of this instance (in the same vpc)
     try:
-        elb_connection = boto.ec2.elb.connect_to_region(region)
-
-        # find load balancers by vpc_id
-        all_lbs = [lb for lb in elb_connection.get_all_load_balancers()
-                   if lb.vpc_id == vpc_id]
-        log.debug('all lbs before filtering by instance id: {}'.format(all_lbs))
-
-        # further filter the load balancers by instance id
-        lbs = [lb for lb in all_lbs for inst in lb.instances
-               if inst.id == instance_metadata['instance-id']]
-        # initialise and populate the output of load balancers
-        out = {}
-        [out.update({l.name: {}}) for l in lbs]
-        [out[l.name].update({attr: getattr(l, attr, None)})
-         for attr in extract_attrs for l in lbs]
-
-        if not out:
+        index = aws_inventory.get_section(region, vpc_id, 'elb', ttl=ttl)
+        out = index['lbs'].get(instance_metadata['instance-id'], {})
+        target_groups = index['target_groups'].get(
+            instance_metadata['instance-id'], {})
+
+        if not out and not target_groups:
             # This loglevel could perhaps be adjusted to something more visible
             log.warning("No ELBs found for this instance, this is unusual, "
                         "but we will not break highstate")
 
         lbs_grain['lbs'] = out
+        lbs_grain['target_groups'] = target_groups
 
     except Exception as e:
         # This prints a user-friendly error with stacktrace
@@ -67,5 +85,7 @@ def get_elb_lbs():
 
     return lbs_grain
 
+
 if __name__ == '__main__':
-    print get_elb_lbs()
+    if __virtual__():
+        print get_elb_lbs()
@@ -1,52 +1,217 @@
 #!/usr/bin/env python
 
+import bisect
+import hashlib
+import os
 import sys
-import boto.cloudformation
-import boto.ec2
-import boto.ec2.autoscale
-from boto.utils import get_instance_identity
+import boto.exception
 import logging
-import operator
+import time
+
+import _aws_utils  # noqa: F401, puts _utils on sys.path
+import aws_clients
+import aws_inventory
+import aws_metadata
+import aws_stats
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 
+MEMBERSHIP_CACHE_FILE = os.path.join(aws_metadata.CACHE_DIR,
+                                     'asg-membership.json')
+# Seconds the cached membership is used without any API calls, after
+# which it is revalidated against the latest scaling activity
+MEMBERSHIP_TTL = 60
+# Points each member has on the consistent hash ring used by owns
+RING_REPLICAS = 100
+# Errors looking up the group membership
+MEMBERSHIP_ERRORS = (boto.exception.BotoServerError,
+                     boto.exception.AWSConnectionError,
+                     aws_inventory.InventoryError,
+                     aws_metadata.MetadataError,
+                     ValueError)
+
+
+def _scaling_activity_signature(autoscale, group_name):
+    """
+    Returns a signature of the latest scaling activity of the group. It
+    changes whenever instances launch, terminate, or move in or out of
+    standby, and so membership changes.
+    """
+    activities = autoscale.get_all_activities(group_name, max_records=1)
+    if not activities:
+        return None
+    latest = activities[0]
+    return '{}:{}:{}'.format(latest.activity_id,
+                             latest.status_code,
+                             latest.progress)
+
+
+def _get_members():
+    """
+    Get the members of this instance's autoscaling group.
+
+    The membership is cached on disk. Within the TTL (minion option
+    asg_membership_ttl, default 60 seconds) no API calls are made, after
+    it one cheap DescribeScalingActivities call checks whether the
+    membership could have changed. Only then is the groups section of the
+    inventory snapshot shared with the grains and autoeips collected again.
+
+    Returns:
+        (dict): The cache entry, with the keys instance_id, group, members
+            (a list of dictionaries with instance_id, lifecycle_state and
+            health_status), activity and checked.
+    """
+    instance_metadata = aws_metadata.get_instance_metadata().static()
+    instance_id = instance_metadata['instance-id']
+    region = instance_metadata['region']
+    ttl = globals().get('__opts__', {}).get('asg_membership_ttl',
+                                            MEMBERSHIP_TTL)
+
+    cache = aws_metadata.read_json(MEMBERSHIP_CACHE_FILE) or {}
+    if cache.get('instance_id') != instance_id:
+        cache = {}
+    if cache and time.time() - cache['checked'] < ttl:
+        return cache
+
+    with aws_stats.scope('asg'):
+        autoscale = aws_clients.get_connection('ec2.autoscale', region)
+        activity = None
+        if cache:
+            activity = _scaling_activity_signature(autoscale, cache['group'])
+        if not cache or activity != cache['activity']:
+            # The snapshot may predate the activity, so always describe
+            # the groups again
+            groups = aws_inventory.get_section(region,
+                                               instance_metadata['vpc-id'],
+                                               'groups', ttl=0)
+            # my autoscaling group
+            group_name = aws_inventory.find_group(groups, instance_id)
+            if not group_name:
+                raise ValueError("Instance {} is not in an autoscaling group"
+                                 .format(instance_id))
+            if not cache:
+                activity = _scaling_activity_signature(autoscale, group_name)
+            cache = {
+                'instance_id': instance_id,
+                'group': group_name,
+                'members': groups[group_name]['instances'],
+            }
+    cache.update({
+        'activity': activity,
+        'checked': time.time(),
+    })
+    aws_metadata.write_json_atomic(MEMBERSHIP_CACHE_FILE, cache)
+    return cache
+
+
+def _in_service_members(members):
+    return [m['instance_id'] for m in members
+            if m['lifecycle_state'] == 'InService']
+
+
 def is_first_of_asg_group():
     """
     Returns True if the current instance is the first instance in the
     sorted by instance_id ASG group.
 
-    XXX: some methods can be generalized and moved to a common.py file
+    Only InService instances are considered, so Pending, Standby and
+    Terminating instances are never the first.
     """
-    # Collect together instance data
     try:
-        instance_identity = get_instance_identity()
-        instance_id = instance_identity['document']['instanceId']
-        instance_region = instance_identity['document']['availabilityZone'].strip()[:-1]
-        conn = boto.ec2.connect_to_region(instance_region)
-        instance_data = conn.get_all_instances(
-            instance_ids=[instance_id])[0].instances[0]
-    except boto.exception.AWSConnectionError as e:
-        log.error("There was a problem collecting instance data, '{}'").format(e.message)
+        membership = _get_members()
+    except MEMBERSHIP_ERRORS as e:
+        log.error("There was a problem collecting instance data, '{}'".format(e))
+        return False
+
+    in_service = _in_service_members(membership['members'])
+    if not in_service:
         return False
+    return min(in_service) == membership['instance_id']
+
+
+def member_count():
+    """
+    Returns the number of InService instances in this instance's ASG
+    group, or 0 if it can not be found.
+
+    CLI Example:
+
+    .. code-block:: bash
 
-    # my autoscaling group
-    asg_group = instance_data.tags['aws:autoscaling:groupName']
+        salt-call asg.member_count
+    """
+    try:
+        membership = _get_members()
+    except MEMBERSHIP_ERRORS as e:
+        log.error("There was a problem collecting instance data, '{}'".format(e))
+        return 0
+    return len(_in_service_members(membership['members']))
+
+
+def member_rank():
+    """
+    Returns the position, starting at 0, of the current instance in the
+    InService instances of its ASG group sorted by instance_id, or None
+    if it is not InService.
+
+    CLI Example:
 
+    .. code-block:: bash
+
+        salt-call asg.member_rank
+    """
     try:
-        autoscale = boto.ec2.autoscale.connect_to_region(instance_region)
-        group = autoscale.get_all_groups(names=[asg_group])[0]
-        sorted_instances = sorted(group.instances, key=operator.attrgetter('instance_id'))
-    except boto.exception.AWSConnectionError as e:
-        log.error("There was a problem collecting instance data, '{}'").format(e.message)
-        return False
+        membership = _get_members()
+    except MEMBERSHIP_ERRORS as e:
+        log.error("There was a problem collecting instance data, '{}'".format(e))
+        return None
+    in_service = sorted(_in_service_members(membership['members']))
+    if membership['instance_id'] not in in_service:
+        return None
+    return in_service.index(membership['instance_id'])
 
-    if sorted_instances[0].instance_id == instance_id:
-        return True
-    else:
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _ring_owner(members, key):
+    """
+    Find the member owning key on a consistent hash ring, on which every
+    member has RING_REPLICAS points. When members join or leave only about
+    1/N of the keys change owner.
+    """
+    ring = sorted((_hash('{}#{}'.format(member, replica)), member)
+                  for member in members
+                  for replica in range(RING_REPLICAS))
+    position = bisect.bisect(ring, (_hash(key),))
+    return ring[position % len(ring)][1]
+
+
+def owns(key):
+    """
+    Returns True if the current instance owns key, so that work can be
+    shared out across the InService instances of an ASG group. Each key
+    has exactly one owner in the group and keys are spread evenly.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-call asg.owns my-batch-job
+    """
+    try:
+        membership = _get_members()
+    except MEMBERSHIP_ERRORS as e:
+        log.error("There was a problem collecting instance data, '{}'".format(e))
+        return False
+    in_service = sorted(_in_service_members(membership['members']))
+    if membership['instance_id'] not in in_service:
         return False
+    return _ring_owner(in_service, str(key)) == membership['instance_id']
 
 
 if __name__ == '__main__':
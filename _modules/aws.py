@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Execution module for querying the AWS data collected by this formula.
+"""
+import os
+import socket
+import logging
+
+import _aws_utils  # noqa: F401, puts _utils on sys.path
+import aws_collector
+import aws_inventory
+import aws_neighbours
+import aws_stats
+
+log = logging.getLogger(__name__)
+
+# Tag of the event fired when AWS grains have changed
+CHANGED_EVENT_TAG = 'aws/grains/changed'
+STATSD_PORT = 8125
+# Maximum size of a statsd packet, metrics are batched up to it
+STATSD_PACKET_SIZE = 512
+
+
+def neighbours(ip=None,
+               cidr=None,
+               subnet=None,
+               az=None,
+               asg=None,
+               tag=None,
+               instance_id=None):
+    """
+    Query the local neighbour index written by the ec2_neighbours grain
+    when the minion option aws_neighbours_mode is set to 'index'. All of
+    the given criteria must match.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-call aws.neighbours subnet=subnet-1234abcd
+        salt-call aws.neighbours cidr=10.0.1.0/24 tag=Role=web
+
+    Returns:
+        A mapping of private ip address to neighbour details.
+    """
+    index = aws_neighbours.NeighbourIndex()
+    if not os.path.exists(index.path):
+        log.error("No neighbour index at {}, set aws_neighbours_mode: index "
+                  "and refresh grains".format(index.path))
+        return {}
+    return index.query(ip=ip,
+                       cidr=cidr,
+                       subnet=subnet,
+                       az=az,
+                       asg=asg,
+                       tag=tag,
+                       instance_id=instance_id)
+
+
+def refresh_if_changed(grains=None, fire_event=True):
+    """
+    Collect the AWS grains again, from a freshly collected inventory
+    snapshot, and compare their content hashes with the ones in the current
+    grains. Only when something differs are the grains refreshed and an
+    aws/grains/changed event fired, naming the grains that changed, so
+    reactors and states keyed on them do not re-run for nothing.
+
+    grains
+        List of grains to check, eg. ec2_neighbours, elb_lbs and
+        elasticache. Defaults to all of those loaded on this minion,
+        grains that are not, eg. elb_lbs with aws_topology_source: pillar,
+        are skipped.
+
+    fire_event
+        Fire the aws/grains/changed event when something changed.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-call aws.refresh_if_changed
+        salt-call aws.refresh_if_changed grains='[ec2_neighbours]'
+
+    Returns:
+        A mapping of grain name to whether it changed and its new hash.
+    """
+    if not aws_collector.registered():
+        # Loading the grain modules registers the collection functions of
+        # those that are enabled. The loader is lazy, listing its functions
+        # loads every module.
+        import salt.loader
+        list(salt.loader.grain_funcs(__opts__))
+    names = grains or aws_collector.registered()
+    if not isinstance(names, (list, tuple)):
+        names = [names]
+
+    # The snapshot the grains are read from may be up to a minute old
+    aws_inventory.invalidate()
+    ret = {}
+    for name in names:
+        if name not in aws_collector.registered():
+            log.info("AWS grain '{}' is unknown or not loaded on this "
+                     "minion, skipping it".format(name))
+            continue
+        key = aws_collector.hash_key(name)
+        value = aws_collector.get(name, __opts__, refresh=True)
+        if value.get('custom_grain_error'):
+            ret[name] = {'changed': False, 'error': True}
+            continue
+        ret[name] = {
+            'changed': value.get(key) != __grains__.get(key),
+            'hash': value.get(key),
+        }
+
+    changed = sorted(name for name in ret if ret[name]['changed'])
+    if changed:
+        log.info("AWS grains changed: {}".format(', '.join(changed)))
+        __salt__['saltutil.refresh_grains']()
+        if fire_event:
+            __salt__['event.send'](CHANGED_EVENT_TAG, {
+                'grains': changed,
+                'hashes': dict((name, ret[name]['hash']) for name in changed),
+            })
+    return ret
+
+
+def _statsd_lines(prefix, scopes):
+    for name, stats in sorted(scopes.items()):
+        base = '{}.{}'.format(prefix, name)
+        yield '{}.runs:{}|c'.format(base, stats['runs'])
+        if stats['last_seconds'] is not None:
+            yield '{}.seconds:{}|ms'.format(
+                base, int(stats['last_seconds'] * 1000))
+        for key, op in sorted(stats['operations'].items()):
+            metric = '{}.{}'.format(base, key.replace(':', '.'))
+            for counter in ('calls', 'errors', 'retries', 'throttles',
+                            'bytes'):
+                yield '{}.{}:{}|c'.format(metric, counter, op[counter])
+            yield '{}.latency:{}|ms'.format(metric, op['avg_ms'])
+
+
+def _send_statsd(address, prefix, scopes):
+    host, _, port = str(address).partition(':')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        packet = []
+        for line in _statsd_lines(prefix, scopes):
+            if packet and len('\n'.join(packet + [line])) > STATSD_PACKET_SIZE:
+                sock.sendto('\n'.join(packet).encode('utf-8'),
+                            (host, int(port or STATSD_PORT)))
+                packet = []
+            packet.append(line)
+        if packet:
+            sock.sendto('\n'.join(packet).encode('utf-8'),
+                        (host, int(port or STATSD_PORT)))
+    except (socket.error, ValueError) as e:
+        log.error("Error sending AWS call stats to statsd {}: {}"
+                  .format(address, e))
+    finally:
+        sock.close()
+
+
+def call_stats(scope=None, reset=False, statsd=None, prefix='aws'):
+    """
+    Report the AWS API calls made on this minion by the AWS grains, the asg
+    module, the aws_changes beacon and autoeips, per scope and operation.
+    The scope of a grain is grains.<name>, and its last_seconds is how long
+    it took to collect the last time, of which api_seconds were spent in
+    AWS calls.
+
+    scope
+        Only report this scope, eg. grains.ec2_neighbours or autoeips.
+
+    reset
+        Start counting again from zero, for the scope when one is given,
+        otherwise for every scope.
+
+    statsd
+        host:port of a statsd server to also send the stats to over UDP.
+        The counts sent are reset, so that each send only carries the calls
+        made since the last one. With scope, the other scopes keep
+        counting.
+
+    prefix
+        Prefix of the statsd metric names.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-call aws.call_stats
+        salt-call aws.call_stats scope=grains.ec2_neighbours
+        salt-call aws.call_stats statsd=localhost:8125
+
+    Returns:
+        A mapping with the time counting started from, since, and scopes,
+        a mapping of scope to its since, runs, seconds, last_seconds, calls,
+        api_seconds and operations, a mapping of
+        <region>:<service>:<operation> to its calls, errors, retries,
+        throttles, seconds, max_seconds, avg_ms and bytes.
+    """
+    data = aws_stats.read(reset=reset or bool(statsd),
+                          scopes=[scope] if scope else None)
+    scopes = {}
+    for name, stats in data['scopes'].items():
+        if scope and name != scope:
+            continue
+        operations = stats['operations'].values()
+        for op in operations:
+            op['avg_ms'] = round(1000 * op['seconds'] / op['calls'], 1) \
+                if op['calls'] else 0
+        stats['calls'] = sum(op['calls'] for op in operations)
+        stats['api_seconds'] = sum(op['seconds'] for op in operations)
+        scopes[name] = stats
+
+    if statsd:
+        _send_statsd(statsd, prefix, scopes)
+    return {'since': data['since'], 'scopes': scopes}
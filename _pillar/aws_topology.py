@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Master side AWS topology for minions.
+
+Instead of every minion describing its whole VPC for the ec2_neighbours and
+elb_lbs grains, this ext_pillar collects the topology of each VPC once on
+the master, with the same inventory snapshot the grains use, and hands each
+minion only its own slice. A VPC is described again at most once every ttl
+seconds however many minions refresh their pillar, so the API calls drop
+from one per minion to one per VPC.
+
+Minions are matched by the region, vpc_id and private_ip_address of their
+ec2_local grain, which comes from the instance metadata service alone.
+
+.. code-block:: yaml
+
+    ext_pillar:
+      - aws_topology:
+          ttl: 300
+          scope:
+            - vpc
+          tags: {}
+"""
+import logging
+import os
+
+try:
+    import boto
+    HAS_BOTO = True
+except ImportError:
+    HAS_BOTO = False
+
+import _aws_utils  # noqa: F401, puts _utils on sys.path
+import aws_inventory
+import aws_metadata
+import aws_neighbours
+import aws_stats
+
+log = logging.getLogger(__name__)
+
+TOPOLOGY_DIR = os.path.join(aws_metadata.CACHE_DIR, 'topology')
+TOPOLOGY_TTL = 300
+
+# ip to instance details of the latest snapshot of each VPC, so that
+# matching a minion does not scan the whole VPC every time
+_ip_index = {}
+
+
+def __virtual__():
+    if not HAS_BOTO:
+        return (False, 'The aws_topology ext_pillar requires boto')
+    return 'aws_topology'
+
+
+def _snapshot_file(region, vpc_id):
+    return os.path.join(TOPOLOGY_DIR, '{}-{}.json'.format(region, vpc_id))
+
+
+def _find_instance(path, snapshot, ip):
+    serial, index = _ip_index.get(path, (None, None))
+    if serial != snapshot['serial']:
+        index = dict((i['private_ip_address'], i)
+                     for i in snapshot['instances'].values()
+                     if i['state'] == 'running')
+        _ip_index[path] = (snapshot['serial'], index)
+    return index.get(ip)
+
+
+def _asg_slice(groups, group_name):
+    if not groups or group_name not in groups:
+        return {}
+    return {
+        'name': group_name,
+        'in_service': sorted(m['instance_id']
+                             for m in groups[group_name]['instances']
+                             if m['lifecycle_state'] == 'InService'),
+    }
+
+
+def ext_pillar(minion_id, pillar, ttl=TOPOLOGY_TTL, scope=None, tags=None):
+    """
+    Returns the aws_topology pillar of a minion.
+
+    Args:
+        ttl(int): Seconds a VPC snapshot is used before it is collected
+            again.
+        scope(list): Neighbour scopes, as aws_neighbours_scope.
+        tags(dict): Neighbour tags for the 'tag' scope, as
+            aws_neighbours_tags.
+
+    Returns:
+        (dict): {'aws_topology': {'instance_id': <instance_id>,
+                                  'ec2_neighbours': {<ip>: {...}},
+                                  'lbs': {<lb_name>: {...}},
+                                  'target_groups': {<tg_name>: {...}},
+                                  'asg': {'name': <group>,
+                                          'in_service': [<instance_id>]}}}
+    """
+    ec2_local = globals().get('__grains__', {}).get('ec2_local')
+    if not ec2_local:
+        return {}
+    region = ec2_local['region']
+    vpc_id = ec2_local['vpc_id']
+    ip = ec2_local['private_ip_address']
+
+    path = _snapshot_file(region, vpc_id)
+    try:
+        with aws_stats.scope('pillar.aws_topology'):
+            snapshot = aws_inventory.get_snapshot(
+                region, vpc_id, ttl=ttl, path=path,
+                sections=['instances', 'elb', 'groups'])
+    except Exception as e:
+        log.exception("Error collecting the topology of {}: {}"
+                      .format(vpc_id, e))
+        return {}
+    if snapshot.get('instances') is None:
+        log.error("No instances in the topology of {}: {}".format(
+            vpc_id, snapshot['errors'].get('instances')))
+        return {}
+
+    own = _find_instance(path, snapshot, ip)
+    if own is None:
+        log.warning("Minion {} ({}) not found in the topology of {}"
+                    .format(minion_id, ip, vpc_id))
+        return {}
+    instance_id = own['instance_id']
+
+    in_scope = aws_neighbours.scope_filter(own, scope, tags)
+    neighbours = aws_neighbours.neighbours_in_scope(
+        snapshot['instances'], ip, in_scope)
+    elb = snapshot.get('elb') or {'lbs': {}, 'target_groups': {}}
+    return {
+        'aws_topology': {
+            'instance_id': instance_id,
+            'ec2_neighbours': aws_neighbours.neighbour_map(neighbours),
+            'lbs': elb['lbs'].get(instance_id, {}),
+            'target_groups': elb['target_groups'].get(instance_id, {}),
+            'asg': _asg_slice(snapshot.get('groups'), own['asg']),
+        }
+    }
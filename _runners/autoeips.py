@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Fleet wide EIP assignment for an autoscaling group.
+
+Instead of every instance discovering and claiming EIPs on its own, this
+runner makes one DescribeAddresses call and one DescribeAutoScalingGroups
+call for the whole group, works out the instance to EIP mapping that moves
+the fewest addresses, and applies only the differences. Instances left
+without an EIP are put into standby, instances that gained one are taken
+out of it.
+
+.. code-block:: bash
+
+    salt-run autoeips.plan my-asg '["1.2.3.4", "5.6.7.8"]' region=eu-west-1
+    salt-run autoeips.rebalance my-asg '["1.2.3.4", "5.6.7.8"]' region=eu-west-1
+
+The calls go through the shared boto3 clients, so they are rate limited
+and counted in the AWS call stats under runners.autoeips.
+"""
+import logging
+
+try:
+    import boto3  # noqa: F401
+    HAS_BOTO3 = True
+except ImportError:
+    HAS_BOTO3 = False
+
+import _aws_utils  # noqa: F401, puts _utils on sys.path
+import aws_clients
+import aws_stats
+
+log = logging.getLogger(__name__)
+
+STATS_SCOPE = 'runners.autoeips'
+
+# Lifecycle states of instances that may hold an EIP
+ELIGIBLE_STATES = ('InService', 'Standby')
+# Maximum number of instances per EnterStandby/ExitStandby call
+STANDBY_BATCH_SIZE = 20
+
+
+def __virtual__():
+    if not HAS_BOTO3:
+        return (False, 'The autoeips runner requires boto3')
+    return 'autoeips'
+
+
+def _describe(asg_name, eips, region):
+    """
+    Collect the group members and the listed addresses in one call each.
+    """
+    ec2 = aws_clients.get_client('ec2', region)
+    autoscaling = aws_clients.get_client('autoscaling', region)
+    addresses = ec2.describe_addresses(PublicIps=eips)['Addresses']
+    groups = autoscaling.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[asg_name])['AutoScalingGroups']
+    if not groups:
+        raise ValueError("Autoscaling group {} not found".format(asg_name))
+    return addresses, groups[0]['Instances']
+
+
+def _plan(addresses, members):
+    """
+    Compute the changes needed so each eligible member holds one listed
+    EIP, keeping existing associations wherever possible.
+
+    Args:
+        addresses(list): Addresses as returned by DescribeAddresses.
+        members(list): Instances as returned by DescribeAutoScalingGroups.
+
+    Returns:
+        (dict): The target assignments and the changes to apply.
+    """
+    lifecycle = dict((m['InstanceId'], m['LifecycleState']) for m in members)
+    eligible = sorted(m['InstanceId'] for m in members
+                      if m['LifecycleState'] in ELIGIBLE_STATES and
+                      m.get('HealthStatus', 'Healthy') == 'Healthy')
+
+    assignments = {}
+    free = []
+    for address in sorted(addresses, key=lambda a: a['PublicIp']):
+        holder = address.get('InstanceId')
+        if holder in eligible and holder not in assignments:
+            assignments[holder] = address
+        elif holder and holder not in lifecycle:
+            # Held by an instance outside the group, leave it alone
+            log.warning("EIP {} is held by {} which is not in the group"
+                        .format(address['PublicIp'], holder))
+        else:
+            # Unassociated, held by a member on its way out, or a second
+            # address held by the same member
+            free.append(address)
+
+    associate = []
+    for instance_id in eligible:
+        if instance_id in assignments or not free:
+            continue
+        address = free.pop(0)
+        assignments[instance_id] = address
+        associate.append({'instance_id': instance_id,
+                          'public_ip': address['PublicIp'],
+                          'allocation_id': address['AllocationId'],
+                          'reassociate': bool(address.get('InstanceId'))})
+
+    without_eip = [i for i in eligible if i not in assignments]
+    return {
+        'assignments': dict((i, a['PublicIp']) for i, a in assignments.items()),
+        'associate': associate,
+        'enter_standby': [i for i in without_eip
+                          if lifecycle[i] == 'InService'],
+        'exit_standby': sorted(i for i in assignments
+                               if lifecycle[i] == 'Standby'),
+        'unused_eips': [a['PublicIp'] for a in free],
+    }
+
+
+def _batches(items, size=STANDBY_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def plan(asg_name, eips, region=None):
+    """
+    Show the EIP assignment changes rebalance would make, without
+    making them.
+
+    Args:
+        asg_name(str): Name of the autoscaling group.
+        eips(list): The public ips the group may use.
+        region(str): AWS region, defaults to the boto3 default region.
+    """
+    with aws_stats.scope(STATS_SCOPE):
+        addresses, members = _describe(asg_name, eips, region)
+    return _plan(addresses, members)
+
+
+def rebalance(asg_name, eips, region=None, standby=True, test=False):
+    """
+    Assign the listed EIPs across the members of an autoscaling group,
+    applying only the changes computed by plan.
+
+    Args:
+        asg_name(str): Name of the autoscaling group.
+        eips(list): The public ips the group may use.
+        region(str): AWS region, defaults to the boto3 default region.
+        standby(bool): Move instances without an EIP into standby and
+            instances that gained one back into service.
+        test(bool): Only return the plan.
+    """
+    changes = plan(asg_name, eips, region=region)
+    if test:
+        return changes
+
+    with aws_stats.scope(STATS_SCOPE):
+        ec2 = aws_clients.get_client('ec2', region)
+        autoscaling = aws_clients.get_client('autoscaling', region)
+        errors = []
+        for change in changes['associate']:
+            try:
+                ec2.associate_address(AllocationId=change['allocation_id'],
+                                      InstanceId=change['instance_id'],
+                                      AllowReassociation=change['reassociate'])
+            except Exception as e:
+                log.error("Failed to associate {} with {}: {}".format(
+                    change['public_ip'], change['instance_id'], e))
+                errors.append(change)
+
+        if standby:
+            failed = set(e['instance_id'] for e in errors)
+            exit_standby = [i for i in changes['exit_standby']
+                            if i not in failed]
+            try:
+                for batch in _batches(exit_standby):
+                    autoscaling.exit_standby(InstanceIds=batch,
+                                             AutoScalingGroupName=asg_name)
+                for batch in _batches(changes['enter_standby']):
+                    autoscaling.enter_standby(
+                        InstanceIds=batch,
+                        AutoScalingGroupName=asg_name,
+                        ShouldDecrementDesiredCapacity=True)
+            except Exception as e:
+                log.error("Failed to update standby mode: {}".format(e))
+                errors.append({'standby': str(e)})
+
+    changes['errors'] = errors
+    changes['result'] = not errors
+    return changes
@@ -0,0 +1,19 @@
+"""
+Makes the shared helpers in _utils importable.
+
+Salt syncs _utils to extmods/utils, but only puts the directory of the
+module it is loading on sys.path, so the grains, execution modules, beacons
+and pillars in this formula import this file from their own directory,
+where it is a symlink to _utils/_aws_utils.py, before importing the
+helpers. Salt's loader skips files starting with an underscore, so it is
+never loaded as a module itself.
+"""
+import os
+import sys
+
+# _utils in the formula, utils once synced to extmods
+for _utils_dir in ('_utils', 'utils'):
+    _utils_path = os.path.normpath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, _utils_dir))
+    if os.path.isdir(_utils_path) and _utils_path not in sys.path:
+        sys.path.insert(0, _utils_path)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Per-process registry of AWS connections.
+
+Grains, modules and autoeips.py get their boto connections and boto3
+clients from here instead of creating new ones for every call. Each is
+created once per service and region and then reused, keeping its pooled
+keep-alive HTTP connections open. boto connections are not thread safe, a
+thread making calls while another uses the shared connection gets an
+unshared one from new_connection. All boto3 clients come from one session,
+so credentials are resolved once and only refreshed when they expire.
+Every connection and client is rate limited by aws_ratelimit and its calls
+are recorded by aws_stats.
+"""
+import importlib
+import threading
+
+import aws_ratelimit
+import aws_stats
+
+# Settings for boto3 clients
+MAX_POOL_CONNECTIONS = 10
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+MAX_ATTEMPTS = aws_ratelimit.MAX_RETRIES + 1
+
+_connections = {}
+_clients = {}
+_session = None
+_lock = threading.Lock()
+
+
+def _connect(service, region):
+    module = importlib.import_module('boto.' + service)
+    connection = module.connect_to_region(region)
+    if connection is None:
+        return None
+    return aws_stats.instrument_connection(
+        aws_ratelimit.limit_connection(connection), service, region)
+
+
+def get_connection(service, region):
+    """
+    Get a boto connection.
+
+    Args:
+        service(str): The boto module with a connect_to_region function,
+            eg. 'ec2', 'ec2.elb', 'ec2.autoscale', 'cloudformation'.
+        region(str): The AWS region.
+
+    Returns:
+        The connection, or None if boto could not connect to the region.
+    """
+    key = (service, region)
+    with _lock:
+        if key not in _connections:
+            connection = _connect(service, region)
+            if connection is None:
+                return None
+            _connections[key] = connection
+        return _connections[key]
+
+
+def new_connection(service, region):
+    """
+    Get a boto connection that is not shared, for a thread making calls
+    while another uses the connection from get_connection.
+
+    Args:
+        service(str): As for get_connection.
+        region(str): The AWS region.
+
+    Returns:
+        The connection, or None if boto could not connect to the region.
+    """
+    return _connect(service, region)
+
+
+def get_session():
+    """
+    Get the shared boto3 session.
+    """
+    global _session
+    if _session is None:
+        import boto3.session
+        _session = boto3.session.Session()
+    return _session
+
+
+def get_client(service, region):
+    """
+    Get a boto3 client.
+
+    Args:
+        service(str): The boto3 service name, eg. 'autoscaling', 'elbv2'.
+        region(str): The AWS region.
+
+    Returns:
+        The boto3 client.
+    """
+    key = (service, region)
+    with _lock:
+        if key not in _clients:
+            from botocore.config import Config
+            config = Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                            connect_timeout=CONNECT_TIMEOUT,
+                            read_timeout=READ_TIMEOUT,
+                            retries={'max_attempts': MAX_ATTEMPTS})
+            client = get_session().client(service,
+                                          region_name=region,
+                                          config=config)
+            _clients[key] = aws_stats.instrument_client(
+                aws_ratelimit.limit_client(client), service, region)
+        return _clients[key]
+
+
+def reset():
+    """
+    Drop all connections and clients, eg. after a fork.
+    """
+    global _session
+    with _lock:
+        _connections.clear()
+        _clients.clear()
+        _session = None
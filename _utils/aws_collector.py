@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Concurrent collection of the AWS grains.
+
+Each AWS grain module registers its collection function here from its
+__virtual__, so that grains salt does not load, eg. on a non EC2 host or in
+pillar mode, are never collected. Salt loads every grains module before
+calling any of them, so the
+first grain function called starts a collection round that runs all the
+registered functions at once on a small pool of threads, and the other
+grains pick up their results from the same round.
+
+Every boto call gets a socket timeout and the round as a whole has a
+deadline. A grain that fails or is not ready by the deadline gets its last
+good value from the on-disk cache instead of an error.
+
+Each grain also carries a content hash of its data, <name>_hash, which only
+changes when the data does, so that consumers can tell a refresh that
+changed nothing from one that did.
+"""
+import logging
+import os
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import aws_metadata
+import aws_stats
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(aws_metadata.CACHE_DIR, 'grains')
+# Defaults, overridden by the minion config options of the same name
+DEFAULTS = {
+    'aws_grains_workers': 3,
+    'aws_grains_call_timeout': 5,
+    'aws_grains_deadline': 20,
+}
+# Grains called within this many seconds of a round starting share it, or
+# until its deadline if that is later, so that a slow grain does not make
+# the next grain called start the round again
+ROUND_TTL = 10
+
+_tasks = {}
+_round = None
+_lock = threading.Lock()
+
+
+def register(name, func):
+    """
+    Register a grain collection function.
+
+    Args:
+        name(str): Name of the grain, used for its cache file.
+        func(callable): Function returning the grain dictionary.
+    """
+    _tasks[name] = func
+
+
+def _option(opts, name):
+    return (opts or {}).get(name, DEFAULTS[name])
+
+
+def _set_call_timeout(timeout):
+    """
+    Give boto calls a socket timeout, unless one is configured already.
+    """
+    import boto
+    if not boto.config.has_section('Boto'):
+        boto.config.add_section('Boto')
+    if not boto.config.has_option('Boto', 'http_socket_timeout'):
+        boto.config.set('Boto', 'http_socket_timeout', str(timeout))
+
+
+class CollectionRound(object):
+    """
+    One concurrent run of all the registered collection functions.
+    """
+    started = None
+    results = None
+    done = None
+
+    def __init__(self, tasks, workers):
+        self.started = time.time()
+        self.results = {}
+        self.done = dict((name, threading.Event()) for name in tasks)
+        queue = Queue()
+        for item in tasks.items():
+            queue.put(item)
+        for _ in range(max(1, min(workers, len(tasks)))):
+            worker = threading.Thread(target=self._work, args=(queue,))
+            worker.daemon = True
+            worker.start()
+
+    def _work(self, queue):
+        while True:
+            try:
+                name, func = queue.get_nowait()
+            except Empty:
+                return
+            start = time.time()
+            try:
+                with aws_stats.scope('grains.' + name):
+                    self.results[name] = func()
+            except Exception as e:
+                log.exception("Error collecting grain {}: {}".format(name, e))
+                self.results[name] = None
+            finally:
+                log.debug("Collected grain {} in {:.2f}s"
+                          .format(name, time.time() - start))
+                self.done[name].set()
+
+    def wait(self, name, deadline):
+        """
+        Wait for a result until deadline seconds after the round started.
+
+        Returns:
+            (bool): True if the result is available.
+        """
+        remaining = deadline - (time.time() - self.started)
+        return self.done[name].wait(max(0, remaining))
+
+
+def _cache_file(name):
+    return os.path.join(CACHE_DIR, '{}.json'.format(name))
+
+
+def hash_key(name):
+    """
+    Returns the name of the content hash grain of a registered grain.
+    """
+    return '{}_hash'.format(name)
+
+
+def _add_hash(name, result):
+    key = hash_key(name)
+    result[key] = aws_metadata.content_hash(
+        dict((k, v) for k, v in result.items() if k != key))
+    return result
+
+
+def registered():
+    """
+    Returns the names of the registered grains.
+    """
+    return sorted(_tasks)
+
+
+def get(name, opts=None, refresh=False):
+    """
+    Get the value of a registered grain, collecting all the registered
+    grains concurrently if there is no current round.
+
+    Args:
+        name(str): The registered grain name.
+        opts(dict): The minion config.
+        refresh(bool): Start a new round for this grain even if there is
+            a current one.
+
+    Returns:
+        (dict): The grain value, the last good value if collection failed or
+            missed the deadline, or {'custom_grain_error': True} if there
+            is neither.
+    """
+    global _round
+    with _lock:
+        if refresh:
+            _set_call_timeout(_option(opts, 'aws_grains_call_timeout'))
+            _round = CollectionRound({name: _tasks[name]}, 1)
+        elif (_round is None or name not in _round.done or
+                time.time() - _round.started >
+                max(ROUND_TTL, _option(opts, 'aws_grains_deadline'))):
+            _set_call_timeout(_option(opts, 'aws_grains_call_timeout'))
+            _round = CollectionRound(_tasks, _option(opts, 'aws_grains_workers'))
+        current = _round
+
+    result = None
+    if current.wait(name, _option(opts, 'aws_grains_deadline')):
+        result = current.results.get(name)
+    else:
+        log.error("Timed out collecting grain {}".format(name))
+
+    if result is not None and not result.get('custom_grain_error'):
+        if result:
+            _add_hash(name, result)
+        aws_metadata.write_json_atomic(_cache_file(name), result)
+        return result
+
+    cached = aws_metadata.read_json(_cache_file(name))
+    if cached is not None:
+        log.warning("Using last good value of grain {}".format(name))
+        return cached
+    return result or {'custom_grain_error': True}
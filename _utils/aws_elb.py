@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Reverse index from instance id to the load balancers it is registered with.
+
+Classic ELBs are described a page at a time and their instance lists are
+inverted in a single pass, ALB/NLB target groups are included when boto3 is
+available. The index is kept in the aws_inventory snapshot, so finding the
+load balancers of an instance is a single dictionary lookup.
+"""
+import logging
+
+import aws_clients
+
+log = logging.getLogger(__name__)
+
+# attributes to extract from the classic load balancer boto objects
+CLASSIC_ATTRS = ['scheme', 'dns_name', 'vpc_id', 'name', 'security_groups']
+
+
+def _classic_index(region, vpc_id):
+    """
+    Returns {instance_id: {lb_name: attrs}} for the classic ELBs in vpc_id.
+    """
+    index = {}
+    elb_connection = aws_clients.get_connection('ec2.elb', region)
+    marker = None
+    while True:
+        page = elb_connection.get_all_load_balancers(marker=marker)
+        for lb in page:
+            if lb.vpc_id != vpc_id:
+                continue
+            attrs = dict((attr, getattr(lb, attr, None))
+                         for attr in CLASSIC_ATTRS)
+            attrs['security_groups'] = list(attrs['security_groups'] or [])
+            for inst in lb.instances:
+                index.setdefault(inst.id, {})[lb.name] = attrs
+        marker = getattr(page, 'next_marker', None)
+        if not marker:
+            break
+    return index
+
+
+def _target_group_index(region, vpc_id):
+    """
+    Returns {instance_id: {target_group_name: attrs}} for the instance
+    target groups of the ALBs and NLBs in vpc_id.
+    """
+    index = {}
+    elbv2 = aws_clients.get_client('elbv2', region)
+
+    load_balancers = {}
+    for page in elbv2.get_paginator('describe_load_balancers').paginate():
+        for lb in page['LoadBalancers']:
+            if lb.get('VpcId') != vpc_id:
+                continue
+            load_balancers[lb['LoadBalancerArn']] = {
+                'name': lb['LoadBalancerName'],
+                'dns_name': lb['DNSName'],
+                'scheme': lb['Scheme'],
+                'type': lb['Type'],
+                'vpc_id': lb['VpcId'],
+                'security_groups': lb.get('SecurityGroups', []),
+            }
+
+    for page in elbv2.get_paginator('describe_target_groups').paginate():
+        for tg in page['TargetGroups']:
+            if (tg.get('VpcId') != vpc_id or
+                    tg.get('TargetType', 'instance') != 'instance'):
+                continue
+            attrs = {
+                'arn': tg['TargetGroupArn'],
+                'name': tg['TargetGroupName'],
+                'port': tg.get('Port'),
+                'protocol': tg.get('Protocol'),
+                'load_balancers': [load_balancers[arn]
+                                   for arn in tg.get('LoadBalancerArns', [])
+                                   if arn in load_balancers],
+            }
+            health = elbv2.describe_target_health(
+                TargetGroupArn=tg['TargetGroupArn'])
+            for target in health['TargetHealthDescriptions']:
+                index.setdefault(target['Target']['Id'], {})[
+                    tg['TargetGroupName']] = attrs
+    return index
+
+
+def build_reverse_index(region, vpc_id):
+    """
+    Describe the load balancers in a vpc and invert their registrations.
+
+    Returns:
+        (dict): {'lbs': {instance_id: {lb_name: attrs}},
+                 'target_groups': {instance_id: {tg_name: attrs}}}
+    """
+    index = {'lbs': _classic_index(region, vpc_id), 'target_groups': {}}
+    try:
+        import boto3  # noqa: F401
+    except ImportError:
+        log.debug("boto3 is not installed, skipping ALB/NLB target groups")
+        return index
+    index['target_groups'] = _target_group_index(region, vpc_id)
+    return index
+
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Shared snapshot of the AWS inventory of a region and vpc.
+
+The neighbours, ELB and elasticache grains, the asg module and autoeips.py
+all need overlapping views of the same region: instances and their tags,
+autoscaling group membership, instance health and load balancers. Instead
+of each describing them on its own, they read one snapshot that is collected
+with batched, paginated describe calls and written atomically to disk.
+
+Each reader passes the sections it needs and the maximum age it accepts.
+The first reader to find one of them older than that collects only the
+stale sections again and merges them into the snapshot, holding a lock so
+concurrent readers on the host wait for its result rather than collecting
+them as well.
+"""
+import fcntl
+import logging
+import os
+import time
+
+import aws_clients
+import aws_elb
+import aws_metadata
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = os.path.join(aws_metadata.CACHE_DIR, 'inventory.json')
+# Bumped whenever the layout of the snapshot changes
+SNAPSHOT_VERSION = 2
+SNAPSHOT_TTL = 60
+# Page size for DescribeInstances and DescribeInstanceStatus
+PAGE_SIZE = 1000
+# Tag set on instances by autoscaling
+ASG_TAG = 'aws:autoscaling:groupName'
+
+
+class InventoryError(Exception):
+    """
+    Raised when a section of the inventory could not be collected.
+    """
+    pass
+
+
+def _describe_instances(region, vpc_id):
+    """
+    Returns {instance_id: details} for every running instance in the vpc.
+    """
+    instances = {}
+    ec2_conn = aws_clients.get_connection('ec2', region)
+    # boto follows the pages of PAGE_SIZE reservations itself
+    for i in ec2_conn.get_only_instances(
+            filters={'vpc-id': vpc_id, 'instance-state-name': 'running'},
+            max_results=PAGE_SIZE):
+        instances[i.id] = {
+            'instance_id': i.id,
+            'state': i.state,
+            'private_ip_address': i.private_ip_address,
+            'private_dns_name': i.private_dns_name,
+            'subnet_id': i.subnet_id,
+            'availability_zone': i.placement,
+            'asg': i.tags.get(ASG_TAG),
+            'tags': dict(i.tags),
+        }
+    return instances
+
+
+def _describe_impaired(region):
+    """
+    Returns the ids of the running instances in the region failing their
+    system or instance status checks.
+    """
+    impaired = []
+    ec2_conn = aws_clients.get_connection('ec2', region)
+    next_token = None
+    while True:
+        page = ec2_conn.get_all_instance_status(max_results=PAGE_SIZE,
+                                                next_token=next_token)
+        for status in page:
+            if (status.system_status.status == 'impaired' or
+                    status.instance_status.status == 'impaired'):
+                impaired.append(status.id)
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            break
+    return impaired
+
+
+def _describe_groups(region):
+    """
+    Returns {group_name: {'instances': [...]}} for every autoscaling group
+    in the region, each instance a dictionary with instance_id,
+    lifecycle_state and health_status.
+    """
+    groups = {}
+    autoscale = aws_clients.get_connection('ec2.autoscale', region)
+    next_token = None
+    while True:
+        page = autoscale.get_all_groups(next_token=next_token)
+        for group in page:
+            groups[group.name] = {
+                'desired_capacity': group.desired_capacity,
+                'instances': [{
+                    'instance_id': i.instance_id,
+                    'lifecycle_state': i.lifecycle_state,
+                    'health_status': i.health_status,
+                } for i in group.instances],
+            }
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            break
+    return groups
+
+
+SECTIONS = (
+    ('instances', _describe_instances),
+    ('impaired', lambda region, vpc_id: _describe_impaired(region)),
+    ('groups', lambda region, vpc_id: _describe_groups(region)),
+    ('elb', aws_elb.build_reverse_index),
+)
+
+
+def _matches(snapshot, region, vpc_id):
+    return (snapshot is not None and
+            snapshot.get('version') == SNAPSHOT_VERSION and
+            snapshot.get('region') == region and
+            snapshot.get('vpc_id') == vpc_id)
+
+
+def collect(region, vpc_id, sections=None, snapshot=None):
+    """
+    Describe sections of the inventory of a region and vpc, and merge them
+    into snapshot. A section that fails, eg. for lack of IAM permissions,
+    is left out and its error recorded, so it does not take the other
+    sections down with it.
+
+    Args:
+        sections(list): Names of the sections to describe, all of them
+            by default.
+        snapshot(dict): The previous snapshot, whose other sections are
+            kept if it is of the same region and vpc.
+
+    Returns:
+        (dict): The snapshot.
+    """
+    serial = (snapshot or {}).get('serial', 0)
+    if not _matches(snapshot, region, vpc_id):
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'region': region,
+            'vpc_id': vpc_id,
+            'errors': {},
+            'collected': {},
+        }
+    snapshot['serial'] = serial + 1
+    describers = dict(SECTIONS)
+    for name in sections or describers:
+        start = time.time()
+        try:
+            snapshot[name] = describers[name](region, vpc_id)
+            snapshot['errors'].pop(name, None)
+        except Exception as e:
+            log.error("Error collecting the {} inventory: {}".format(name, e))
+            snapshot[name] = None
+            snapshot['errors'][name] = str(e)
+        snapshot['collected'][name] = time.time()
+        log.debug("Collected the {} inventory of {} in {:.2f}s".format(
+            name, vpc_id, snapshot['collected'][name] - start))
+    return snapshot
+
+
+def _stale_sections(snapshot, region, vpc_id, sections, ttl):
+    """
+    Returns the sections missing from snapshot or older than ttl seconds.
+    """
+    if not _matches(snapshot, region, vpc_id):
+        return list(sections)
+    collected = snapshot['collected']
+    return [name for name in sections
+            if time.time() - collected.get(name, 0) >= ttl]
+
+
+def read_snapshot(region, vpc_id, sections, ttl=SNAPSHOT_TTL,
+                  path=SNAPSHOT_FILE):
+    """
+    Returns the inventory snapshot for a region and vpc if sections were
+    all collected within ttl seconds, otherwise None. Nothing is collected,
+    for readers that only need a few instances and can describe those
+    instead.
+    """
+    snapshot = aws_metadata.read_json(path)
+    if _stale_sections(snapshot, region, vpc_id, sections, ttl):
+        return None
+    if any(snapshot.get(name) is None for name in sections):
+        return None
+    return snapshot
+
+
+def get_snapshot(region, vpc_id, ttl=SNAPSHOT_TTL, path=SNAPSHOT_FILE,
+                 sections=None):
+    """
+    Returns the inventory snapshot for a region and vpc, first collecting
+    again those of sections that are older than ttl seconds. The other
+    sections are returned as they are, and may be stale or missing.
+
+    Args:
+        sections(list): Names of the sections the caller reads, all of
+            them by default.
+    """
+    if sections is None:
+        sections = [name for name, describe in SECTIONS]
+    snapshot = aws_metadata.read_json(path)
+    if not _stale_sections(snapshot, region, vpc_id, sections, ttl):
+        return snapshot
+
+    lock = None
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        lock = open(path + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    except (IOError, OSError) as e:
+        log.debug("Inventory lock unavailable: {}".format(e))
+
+    try:
+        # Another process may have collected them while we waited
+        snapshot = aws_metadata.read_json(path)
+        stale = _stale_sections(snapshot, region, vpc_id, sections, ttl)
+        if not stale:
+            return snapshot
+        snapshot = collect(region, vpc_id, stale, snapshot)
+        aws_metadata.write_json_atomic(path, snapshot)
+        return snapshot
+    finally:
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+
+def invalidate(path=SNAPSHOT_FILE):
+    """
+    Discard the snapshot, eg. once a change has been detected, so that the
+    next reader collects it again whatever ttl it passes.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def get_section(region, vpc_id, name, ttl=SNAPSHOT_TTL):
+    """
+    Returns one section ('instances', 'impaired', 'groups' or 'elb') of
+    the inventory snapshot.
+
+    Raises:
+        InventoryError: If the section could not be collected.
+    """
+    snapshot = get_snapshot(region, vpc_id, ttl=ttl, sections=[name])
+    if snapshot.get(name) is None:
+        raise InventoryError("The {} inventory is unavailable: {}".format(
+            name, snapshot['errors'].get(name)))
+    return snapshot[name]
+
+
+def find_group(groups, instance_id):
+    """
+    Returns the name of the autoscaling group instance_id is a member of,
+    or None.
+    """
+    for name, group in groups.items():
+        for instance in group['instances']:
+            if instance['instance_id'] == instance_id:
+                return name
+    return None
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Shared access to the EC2 instance metadata service (IMDS).
+
+Every grain, the asg module and autoeips.py read their instance details
+through this module instead of walking the whole metadata tree on their
+own. Fields that can not change for the life of an instance are fetched
+once and kept in an on-disk cache, so that later readers (other grains,
+the next grains refresh, the next autoeips run) need no HTTP calls at all.
+Volatile fields are fetched individually and only when their cached copy
+is older than the requested age.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+try:
+    from urllib2 import urlopen, HTTPError, URLError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+
+log = logging.getLogger(__name__)
+
+METADATA_URL = 'http://169.254.169.254/latest/'
+CACHE_DIR = os.environ.get('AWS_FORMULA_CACHE_DIR', '/var/cache/aws-formula')
+METADATA_CACHE_FILE = os.path.join(CACHE_DIR, 'instance-metadata.json')
+PLATFORM_CACHE_FILE = os.path.join(CACHE_DIR, 'platform.json')
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+# Files identifying the platform, with the prefixes they have on EC2:
+# Xen instances have a hypervisor uuid starting ec2, Nitro instances
+# have Amazon EC2 DMI vendor strings and the instance id as asset tag.
+PLATFORM_FILES = (
+    ('/sys/hypervisor/uuid', ('ec2',)),
+    ('/sys/devices/virtual/dmi/id/product_uuid', ('ec2', 'EC2')),
+    ('/sys/devices/virtual/dmi/id/sys_vendor', ('Amazon EC2',)),
+    ('/sys/devices/virtual/dmi/id/bios_vendor', ('Amazon EC2',)),
+    ('/sys/devices/virtual/dmi/id/board_asset_tag', ('i-',)),
+)
+PLATFORM_TTL = 3600
+
+# Fields that are fixed for the life of an instance
+STATIC_FIELDS = (
+    'instance-id',
+    'instance-type',
+    'ami-id',
+    'account-id',
+    'region',
+    'availability-zone',
+    'mac',
+    'vpc-id',
+    'subnet-id',
+    'local-ipv4',
+    'local-hostname',
+)
+STATIC_TTL = 86400
+VOLATILE_TTL = 60
+
+
+class MetadataError(Exception):
+    """
+    Raised when the instance metadata service can not be reached.
+    """
+    pass
+
+
+def fetch(path, timeout=5, num_retries=2):
+    """
+    Fetch a single path from the instance metadata service.
+
+    Args:
+        path(str): Path relative to /latest/, eg. 'meta-data/public-ipv4'
+        timeout(int): Socket timeout in seconds for each attempt.
+        num_retries(int): Number of retries after the first attempt.
+
+    Returns:
+        (str): The response body, or None if the path does not exist.
+    """
+    last_error = None
+    for attempt in range(num_retries + 1):
+        try:
+            response = urlopen(METADATA_URL + path, timeout=timeout)
+            return response.read().decode('utf-8')
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            last_error = e
+        except (URLError, socket.error, socket.timeout) as e:
+            last_error = e
+        if attempt < num_retries:
+            time.sleep(min(0.1 * 2 ** attempt, 1))
+    raise MetadataError("Error getting instance metadata '{}': {}"
+                        .format(path, last_error))
+
+
+def _read_boot_id():
+    try:
+        with open(BOOT_ID_FILE) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def write_json_atomic(path, data):
+    """
+    Write data as json to path, replacing any existing file atomically
+    so concurrent readers never see a partial file.
+
+    Returns:
+        (bool): True if the file was written, False otherwise.
+    """
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+        return True
+    except (IOError, OSError) as e:
+        log.debug("Could not write cache file {}: {}".format(path, e))
+        return False
+
+
+def read_json(path):
+    """
+    Read a json file, returning None if it is missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def content_hash(data):
+    """
+    Stable hash of json serialisable data.
+    """
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _probe_platform_files():
+    """
+    Check the local platform files for signs of EC2.
+
+    Returns:
+        (bool): True or False if the files give an answer, None if none of
+            them could be read (eg. in a container).
+    """
+    readable = False
+    for path, prefixes in PLATFORM_FILES:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except (IOError, OSError):
+            continue
+        readable = True
+        if value.startswith(prefixes):
+            return True
+    return False if readable else None
+
+
+def is_ec2(ttl=PLATFORM_TTL):
+    """
+    Cheaply check whether this host is an EC2 instance, before any slow
+    network calls are made. The platform files are checked first, falling
+    back to a single short metadata service probe when they are not
+    available. The answer is cached on disk for ttl seconds so hosts
+    outside AWS only pay for the probe once.
+
+    Returns:
+        (bool): True if this host is an EC2 instance.
+    """
+    cached = read_json(PLATFORM_CACHE_FILE)
+    if (cached and cached.get('boot_id') == _read_boot_id() and
+            time.time() - cached.get('checked', 0) < ttl):
+        return cached['ec2']
+
+    ec2 = _probe_platform_files()
+    if ec2 is None:
+        try:
+            ec2 = fetch('meta-data/instance-id',
+                        timeout=0.5, num_retries=0) is not None
+        except MetadataError:
+            ec2 = False
+    write_json_atomic(PLATFORM_CACHE_FILE, {
+        'boot_id': _read_boot_id(),
+        'checked': time.time(),
+        'ec2': ec2,
+    })
+    return ec2
+
+
+class InstanceMetadata(object):
+    """
+    Cached view of the instance metadata for this instance. It is shared by
+    every thread in the process, eg. the grains collected in parallel, so
+    the cache is only loaded and each field only fetched once.
+    """
+    cache_file = None
+    static_ttl = None
+    volatile_ttl = None
+    timeout = None
+    num_retries = None
+
+    def __init__(self,
+                 cache_file=METADATA_CACHE_FILE,
+                 static_ttl=STATIC_TTL,
+                 volatile_ttl=VOLATILE_TTL,
+                 timeout=5,
+                 num_retries=2):
+        self.cache_file = cache_file
+        self.static_ttl = static_ttl
+        self.volatile_ttl = volatile_ttl
+        self.timeout = timeout
+        self.num_retries = num_retries
+        self._cache = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        """
+        Load the cache from disk, discarding it if it was written during a
+        previous boot (eg. baked into an AMI) or is older than static_ttl.
+        """
+        with self._lock:
+            if self._cache is not None:
+                return self._cache
+            cache = read_json(self.cache_file) or {}
+            if (cache.get('boot_id') != _read_boot_id() or
+                    time.time() - cache.get('fetched', 0) > self.static_ttl):
+                cache = {}
+            self._cache = cache
+            return cache
+
+    def _save(self):
+        write_json_atomic(self.cache_file, self._cache)
+
+    def _fetch(self, path):
+        return fetch(path, timeout=self.timeout, num_retries=self.num_retries)
+
+    def static(self):
+        """
+        Returns a dictionary of the static fields in STATIC_FIELDS, only
+        calling the metadata service if there is no valid cached copy.
+        """
+        with self._lock:
+            cache = self._load()
+            if cache.get('static'):
+                return cache['static']
+
+            document = json.loads(
+                self._fetch('dynamic/instance-identity/document'))
+            mac = self._fetch('meta-data/mac')
+            interface = 'meta-data/network/interfaces/macs/{}/'.format(mac)
+            static = {
+                'instance-id': document['instanceId'],
+                'instance-type': document.get('instanceType'),
+                'ami-id': document.get('imageId'),
+                'account-id': document.get('accountId'),
+                'region': document['region'],
+                'availability-zone': document['availabilityZone'],
+                'local-ipv4': document.get('privateIp'),
+                'mac': mac,
+                'vpc-id': self._fetch(interface + 'vpc-id'),
+                'subnet-id': self._fetch(interface + 'subnet-id'),
+                'local-hostname': self._fetch('meta-data/local-hostname'),
+            }
+            self._cache = {
+                'boot_id': _read_boot_id(),
+                'fetched': time.time(),
+                'static': static,
+                'volatile': {},
+            }
+            self._save()
+            return static
+
+    def get(self, key, max_age=None):
+        """
+        Get a single metadata field.
+
+        Args:
+            key(str): A field in STATIC_FIELDS, or any path below
+                meta-data/, eg. 'public-ipv4'.
+            max_age(int): For volatile fields, the maximum age in seconds
+                of a cached value before it is fetched again. Defaults to
+                volatile_ttl, 0 always fetches.
+
+        Returns:
+            (str): The field value, or None if it does not exist.
+        """
+        if key in STATIC_FIELDS:
+            return self.static().get(key)
+
+        if max_age is None:
+            max_age = self.volatile_ttl
+        with self._lock:
+            cache = self._load()
+            volatile = cache.setdefault('volatile', {})
+            cached = volatile.get(key)
+            if cached and time.time() - cached['fetched'] <= max_age:
+                return cached['value']
+
+            value = self._fetch('meta-data/' + key)
+            volatile[key] = {'value': value, 'fetched': time.time()}
+            # Only persist volatile values alongside a complete static set
+            if cache.get('static'):
+                self._save()
+            return value
+
+    def interfaces(self, max_age=None):
+        """
+        Get the network interfaces attached to this instance. Interfaces
+        can be attached and private ips assigned at any time, so they are
+        volatile fields.
+
+        Args:
+            max_age(int): As for get.
+
+        Returns:
+            (list): Dictionaries with the mac, interface_id, device_number
+                and private_ips (the primary ip first) of each interface,
+                ordered by device number.
+        """
+        macs = self.get('network/interfaces/macs/', max_age=max_age) or ''
+        interfaces = []
+        for mac in macs.split():
+            mac = mac.rstrip('/')
+            path = 'network/interfaces/macs/{}/'.format(mac)
+            interfaces.append({
+                'mac': mac,
+                'interface_id': self.get(path + 'interface-id', max_age),
+                'device_number': int(
+                    self.get(path + 'device-number', max_age) or 0),
+                'private_ips': (
+                    self.get(path + 'local-ipv4s', max_age) or '').split(),
+            })
+        return sorted(interfaces, key=lambda i: i['device_number'])
+
+
+_instance_metadata = None
+
+
+def get_instance_metadata():
+    """
+    Returns the process wide InstanceMetadata object.
+    """
+    global _instance_metadata
+    if _instance_metadata is None:
+        _instance_metadata = InstanceMetadata()
+    return _instance_metadata
+
+
+if __name__ == '__main__':
+    print(json.dumps(get_instance_metadata().static(), indent=2))
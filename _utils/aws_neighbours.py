@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Compact local index of the EC2 neighbours of this instance.
+
+Instead of carrying every neighbour in the grains, the ec2_neighbours grain
+can store them in a SQLite database indexed by ip, subnet, availability
+zone, autoscaling group and tag. The aws execution module answers point
+and range queries against it.
+"""
+import os
+import socket
+import sqlite3
+import struct
+
+import aws_metadata
+
+INDEX_FILE = os.path.join(aws_metadata.CACHE_DIR, 'neighbours.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    ip_int INTEGER PRIMARY KEY,
+    ip TEXT NOT NULL,
+    instance_id TEXT,
+    private_dns_name TEXT,
+    subnet_id TEXT,
+    availability_zone TEXT,
+    asg TEXT
+);
+CREATE INDEX IF NOT EXISTS instances_subnet ON instances (subnet_id);
+CREATE INDEX IF NOT EXISTS instances_az ON instances (availability_zone);
+CREATE INDEX IF NOT EXISTS instances_asg ON instances (asg);
+CREATE TABLE IF NOT EXISTS tags (
+    ip_int INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value);
+"""
+
+# Columns that can be queried directly, by query argument name
+COLUMNS = {
+    'instance_id': 'instance_id',
+    'subnet': 'subnet_id',
+    'az': 'availability_zone',
+    'asg': 'asg',
+}
+
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def cidr_range(cidr):
+    """
+    Returns the first and last integer addresses of a cidr block.
+    """
+    network, _, bits = cidr.partition('/')
+    bits = int(bits or 32)
+    start = ip_to_int(network) & (0xffffffff << (32 - bits)) & 0xffffffff
+    return start, start + (1 << (32 - bits)) - 1
+
+
+def safe_dns_name(private_dns_name):
+    return private_dns_name.split('.')[0].replace('.', '-')
+
+
+def scope_filter(own, scopes=None, tags=None):
+    """
+    Build a filter for neighbour scopes, applied to instance details from
+    the aws_inventory snapshot.
+
+    Args:
+        own(dict): Details of the instance whose neighbours are wanted,
+            with subnet_id, availability_zone and asg.
+        scopes(list): Any of 'vpc' (the default), 'subnet', 'az', 'asg'
+            and 'tag', combined so neighbours must match all of them.
+        tags(dict): Tags neighbours must have for the 'tag' scope.
+
+    Returns:
+        (callable): Returns True for the instance details in scope.
+    """
+    criteria = {'state': 'running'}
+    scopes = scopes or ['vpc']
+    if not isinstance(scopes, (list, tuple)):
+        scopes = [scopes]
+    if 'subnet' in scopes:
+        criteria['subnet_id'] = own['subnet_id']
+    if 'az' in scopes:
+        criteria['availability_zone'] = own['availability_zone']
+    if 'asg' in scopes and own.get('asg'):
+        criteria['asg'] = own['asg']
+    if 'tag' not in scopes:
+        tags = {}
+
+    def in_scope(instance):
+        return (all(instance.get(k) == v for k, v in criteria.items()) and
+                all(instance['tags'].get(k) == v
+                    for k, v in (tags or {}).items()))
+    return in_scope
+
+
+def neighbours_in_scope(instances, own_ip, in_scope):
+    """
+    Returns the instance details in scope, other than own_ip, sorted by
+    instance id.
+    """
+    return [i for i in sorted(instances.values(),
+                              key=lambda i: i['instance_id'])
+            if in_scope(i) and i['private_ip_address'] != own_ip]
+
+
+def neighbour_map(neighbours):
+    """
+    Returns the ec2_neighbours grain mapping of ip to dns names.
+    """
+    return dict((str(i['private_ip_address']), {
+        'private_dns_name': str(i['private_dns_name']),
+        'private_dns_name_safe': safe_dns_name(str(i['private_dns_name'])),
+    }) for i in neighbours)
+
+
+class NeighbourIndex(object):
+    """
+    SQLite backed store of neighbour instances.
+    """
+    path = None
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        conn = sqlite3.connect(self.path)
+        conn.executescript(SCHEMA)
+        return conn
+
+    def replace(self, neighbours):
+        """
+        Replace the contents of the index in a single transaction.
+
+        Args:
+            neighbours(list): Dictionaries with the keys ip, instance_id,
+                private_dns_name, subnet_id, availability_zone, asg and tags.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM instances')
+                conn.execute('DELETE FROM tags')
+                for n in neighbours:
+                    ip_int = ip_to_int(n['ip'])
+                    conn.execute(
+                        'INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (ip_int, n['ip'], n.get('instance_id'),
+                         n.get('private_dns_name'), n.get('subnet_id'),
+                         n.get('availability_zone'), n.get('asg')))
+                    conn.executemany(
+                        'INSERT INTO tags VALUES (?, ?, ?)',
+                        [(ip_int, k, v) for k, v in n.get('tags', {}).items()])
+        finally:
+            conn.close()
+
+    def query(self, ip=None, cidr=None, tag=None, **kwargs):
+        """
+        Find neighbours matching all of the given criteria.
+
+        Args:
+            ip(str): An exact private ip address.
+            cidr(str): A range of private ip addresses, eg. 10.0.1.0/24
+            tag(str): A tag as 'key' or 'key=value'.
+            instance_id, subnet, az, asg(str): Exact matches on those fields.
+
+        Returns:
+            (dict): Mapping of private ip address to neighbour details, in
+                the same format as the ec2_neighbours grain.
+        """
+        clauses = []
+        params = []
+        if ip:
+            clauses.append('ip_int = ?')
+            params.append(ip_to_int(ip))
+        if cidr:
+            clauses.append('ip_int BETWEEN ? AND ?')
+            params.extend(cidr_range(cidr))
+        for arg, column in COLUMNS.items():
+            if kwargs.get(arg):
+                clauses.append('{} = ?'.format(column))
+                params.append(kwargs[arg])
+        if tag:
+            key, sep, value = tag.partition('=')
+            if sep:
+                clauses.append('ip_int IN (SELECT ip_int FROM tags '
+                               'WHERE key = ? AND value = ?)')
+                params.extend([key, value])
+            else:
+                clauses.append('ip_int IN (SELECT ip_int FROM tags WHERE key = ?)')
+                params.append(key)
+
+        sql = ('SELECT ip, instance_id, private_dns_name, subnet_id, '
+               'availability_zone, asg FROM instances')
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql + ' ORDER BY ip_int', params).fetchall()
+        finally:
+            conn.close()
+
+        return dict((str(row[0]), {
+            'instance_id': row[1],
+            'private_dns_name': row[2],
+            'private_dns_name_safe': safe_dns_name(row[2] or ''),
+            'subnet_id': row[3],
+            'availability_zone': row[4],
+            'asg': row[5],
+        }) for row in rows)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Host wide rate limiting of AWS API calls.
+
+Grains, the asg module and autoeips.py all call the same regional APIs,
+often at the same moment. Every call made through aws_clients first takes
+a token from a token bucket whose state is shared by every process on the
+host through a file lock, so together they stay within one budget.
+
+When AWS throttles a call anyway the bucket rate is halved and all callers
+back off for a while, with jitter, before the call is retried. The rate then
+creeps back up over time. The time callers spent waiting and the number of
+retries are counted and can be logged with get_stats, and each call's
+retries and throttles are passed on to aws_stats.
+"""
+import fcntl
+import logging
+import os
+import random
+import time
+
+import aws_metadata
+import aws_stats
+
+log = logging.getLogger(__name__)
+
+STATE_FILE = os.path.join(aws_metadata.CACHE_DIR, 'ratelimit.json')
+LOCK_FILE = os.path.join(aws_metadata.CACHE_DIR, 'ratelimit.lock')
+
+# Calls per second, and the burst allowed above it
+RATE = 10.0
+MIN_RATE = 0.5
+CAPACITY = 20.0
+# Calls per second added back to the rate for every second that passes
+RATE_RECOVERY = 0.5
+# Seconds all callers wait after a throttled call, doubling per retry
+BACKOFF = 1.0
+MAX_BACKOFF = 20.0
+MAX_RETRIES = 5
+
+THROTTLE_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'TooManyRequestsException',
+)
+
+_stats = {
+    'calls': 0,
+    'throttles': 0,
+    'retries': 0,
+    'throttled_seconds': 0.0,
+}
+
+
+def get_stats():
+    """
+    Returns the rate limiting counters for this process.
+    """
+    return dict(_stats)
+
+
+class _Locked(object):
+    """
+    Exclusive lock on the shared bucket state, yielding it for update.
+    """
+    def __enter__(self):
+        directory = os.path.dirname(LOCK_FILE)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        self.lock = open(LOCK_FILE, 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.state = aws_metadata.read_json(STATE_FILE) or {
+            'tokens': CAPACITY,
+            'rate': RATE,
+            'updated': time.time(),
+            'backoff_until': 0,
+        }
+        now = time.time()
+        elapsed = max(0, now - self.state['updated'])
+        self.state['tokens'] = min(
+            CAPACITY, self.state['tokens'] + elapsed * self.state['rate'])
+        self.state['rate'] = min(
+            RATE, self.state['rate'] + elapsed * RATE_RECOVERY)
+        self.state['updated'] = now
+        return self.state
+
+    def __exit__(self, *exc):
+        aws_metadata.write_json_atomic(STATE_FILE, self.state)
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+
+def acquire():
+    """
+    Block until a token is available for one API call.
+
+    Returns:
+        (float): Seconds spent waiting.
+    """
+    waited = 0.0
+    while True:
+        try:
+            with _Locked() as state:
+                now = time.time()
+                if now < state['backoff_until']:
+                    wait = state['backoff_until'] - now
+                elif state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    wait = 0
+                else:
+                    wait = (1 - state['tokens']) / state['rate']
+        except (IOError, OSError) as e:
+            # Never block AWS calls because the state can not be shared
+            log.debug("Rate limiter unavailable: {}".format(e))
+            wait = 0
+        if not wait:
+            break
+        wait += random.uniform(0, wait / 2)
+        time.sleep(wait)
+        waited += wait
+    _stats['calls'] += 1
+    _stats['throttled_seconds'] += waited
+    return waited
+
+
+def throttled(attempt):
+    """
+    Record a throttled call, halving the rate and making every caller on
+    the host back off. The wait happens in the next acquire.
+
+    Args:
+        attempt(int): The number of the attempt that was throttled,
+            starting at 0.
+
+    Returns:
+        (float): Seconds all callers will back off for.
+    """
+    backoff = min(MAX_BACKOFF, BACKOFF * 2 ** attempt)
+    backoff += random.uniform(0, backoff)
+    _stats['throttles'] += 1
+    aws_stats.count('throttles')
+    try:
+        with _Locked() as state:
+            state['rate'] = max(MIN_RATE, state['rate'] / 2)
+            state['backoff_until'] = max(state['backoff_until'],
+                                         time.time() + backoff)
+    except (IOError, OSError):
+        pass
+    log.warning("AWS call throttled, backing off for {:.1f}s".format(backoff))
+    return backoff
+
+
+def _is_throttle_response(response):
+    if response.status not in (400, 503):
+        return False
+    # boto caches the body, so the caller can still read it
+    body = response.read()
+    if not isinstance(body, str):
+        body = body.decode('utf-8', 'replace')
+    return any('>{}<'.format(code) in body for code in THROTTLE_CODES)
+
+
+def limit_connection(connection):
+    """
+    Rate limit every request made by a boto connection, retrying requests
+    that are throttled.
+
+    Args:
+        connection: A boto AWSQueryConnection.
+
+    Returns:
+        The same connection.
+    """
+    make_request = connection.make_request
+
+    def limited_make_request(*args, **kwargs):
+        attempt = 0
+        while True:
+            acquire()
+            response = make_request(*args, **kwargs)
+            if not _is_throttle_response(response):
+                return response
+            throttled(attempt)
+            if attempt == MAX_RETRIES:
+                return response
+            attempt += 1
+            _stats['retries'] += 1
+            aws_stats.count('retries')
+
+    connection.make_request = limited_make_request
+    return connection
+
+
+def limit_client(client):
+    """
+    Rate limit every request made by a boto3 client, including botocore's
+    own retries, and feed throttled responses back into the shared rate.
+
+    Args:
+        client: A boto3 client.
+
+    Returns:
+        The same client.
+    """
+    def before_send(**kwargs):
+        acquire()
+
+    def needs_retry(response=None, attempts=1, **kwargs):
+        if response is not None and response[1]:
+            code = response[1].get('Error', {}).get('Code')
+            if code in THROTTLE_CODES:
+                _stats['retries'] += 1
+                aws_stats.count('retries')
+                throttled(attempts - 1)
+        # Leave the retry decision to botocore
+        return None
+
+    client.meta.events.register('before-send', before_send)
+    client.meta.events.register_first('needs-retry', needs_retry)
+    return client
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+Per call instrumentation of the AWS API calls made by the formula.
+
+Every boto connection and boto3 client handed out by aws_clients records,
+for each call, its operation, region, latency, retries, throttles and
+response size. Calls are counted per operation under the scope they were
+made in, eg. the grain being collected or autoeips, along with how long
+each scope took.
+
+The counts are kept in memory and merged into a stats file shared by every
+process on the host whenever a scope ends, for the aws.call_stats execution
+module to report. Each call is also logged at debug level.
+"""
+import atexit
+import contextlib
+import fcntl
+import logging
+import os
+import threading
+import time
+
+import aws_metadata
+
+log = logging.getLogger(__name__)
+
+STATS_FILE = os.path.join(aws_metadata.CACHE_DIR, 'call-stats.json')
+# Bumped whenever the layout of the stats file changes
+STATS_VERSION = 2
+# Scope of calls made outside of any scope
+DEFAULT_SCOPE = 'other'
+
+_local = threading.local()
+_lock = threading.Lock()
+# Counts not yet merged into the stats file
+_pending = {}
+# Counts per operation of every call made by this process
+_totals = {}
+
+
+def _empty_scope():
+    return {
+        'runs': 0,
+        'seconds': 0.0,
+        'last_seconds': None,
+        'last_run': None,
+        'operations': {},
+    }
+
+
+def _empty_operation():
+    return {
+        'calls': 0,
+        'errors': 0,
+        'retries': 0,
+        'throttles': 0,
+        'seconds': 0.0,
+        'max_seconds': 0.0,
+        'bytes': 0,
+    }
+
+
+def current_scope():
+    """
+    Returns the scope calls made on this thread are attributed to.
+    """
+    scopes = getattr(_local, 'scopes', None)
+    return scopes[-1] if scopes else DEFAULT_SCOPE
+
+
+def record(service, region, operation, latency, retries=0, throttles=0,
+           size=0, error=None):
+    """
+    Record one API call, including all its retries.
+
+    Args:
+        service(str): The boto or boto3 service, eg. 'ec2', 'autoscaling'.
+        region(str): The AWS region.
+        operation(str): The API operation, eg. 'DescribeInstances'.
+        latency(float): Seconds the call took, including rate limiting
+            and retries.
+        retries(int): Times the call was retried.
+        throttles(int): Times the call was throttled.
+        size(int): Bytes in the response body.
+        error(str): The error code, if the call failed.
+    """
+    scope = current_scope()
+    key = '{}:{}:{}'.format(region, service, operation)
+    call = {
+        'calls': 1,
+        'errors': 1 if error else 0,
+        'retries': retries,
+        'throttles': throttles,
+        'seconds': latency,
+        'max_seconds': latency,
+        'bytes': size,
+    }
+    with _lock:
+        stats = _pending.setdefault(scope, _empty_scope())
+        _merge_operation(
+            stats['operations'].setdefault(key, _empty_operation()), call)
+        _merge_operation(_totals.setdefault(key, _empty_operation()), call)
+    log.debug("AWS call {} {}:{} in {:.3f}s, retries: {}, throttles: {}, "
+              "bytes: {}{}".format(region, service, operation, latency,
+                                   retries, throttles, size,
+                                   ', error: {}'.format(error) if error
+                                   else ''))
+
+
+def count(name):
+    """
+    Count a retry ('retries') or throttle ('throttles') of the call in
+    progress on this thread, for the rate limiter to report them.
+    """
+    call = getattr(_local, 'call', None)
+    if call is not None:
+        call[name] += 1
+
+
+def _start_call():
+    _local.call = {'start': time.time(), 'retries': 0, 'throttles': 0}
+    return _local.call
+
+
+def _end_call():
+    call = getattr(_local, 'call', None) or _start_call()
+    _local.call = None
+    return call
+
+
+@contextlib.contextmanager
+def scope(name, timed=True):
+    """
+    Attribute the calls made on this thread to name, eg.
+    'grains.ec2_neighbours', and record how long the scope took. When the
+    outermost scope ends the counts are merged into the stats file.
+
+    Args:
+        timed(bool): False to only attribute the calls, eg. in a worker
+            thread of a scope timed by its caller.
+    """
+    scopes = getattr(_local, 'scopes', None)
+    if scopes is None:
+        scopes = _local.scopes = []
+    scopes.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        scopes.pop()
+        if timed:
+            elapsed = time.time() - start
+            with _lock:
+                stats = _pending.setdefault(name, _empty_scope())
+                stats['runs'] += 1
+                stats['seconds'] += elapsed
+                stats['last_seconds'] = elapsed
+                stats['last_run'] = time.time()
+            if not scopes:
+                flush()
+
+
+def summary():
+    """
+    Returns {'<region>:<service>:<operation>': counts} for every call made
+    by this process.
+    """
+    with _lock:
+        return dict((key, dict(op)) for key, op in _totals.items())
+
+
+def _merge_operation(total, op):
+    for name in ('calls', 'errors', 'retries', 'throttles', 'seconds',
+                 'bytes'):
+        total[name] += op[name]
+    total['max_seconds'] = max(total['max_seconds'], op['max_seconds'])
+
+
+def _merge(data, pending):
+    stats = data['scopes']
+    for name, update in pending.items():
+        # Scopes are counted from the start of the file unless reset alone
+        current = stats.setdefault(name, dict(_empty_scope(),
+                                              since=data['since']))
+        current['runs'] += update['runs']
+        current['seconds'] += update['seconds']
+        if update['last_run'] is not None:
+            current['last_seconds'] = update['last_seconds']
+            current['last_run'] = update['last_run']
+        for key, op in update['operations'].items():
+            _merge_operation(
+                current['operations'].setdefault(key, _empty_operation()), op)
+
+
+class _Locked(object):
+    """
+    Exclusive lock on the stats file, yielding its scopes for update.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        self.lock = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.data = aws_metadata.read_json(self.path)
+        if not self.data or self.data.get('version') != STATS_VERSION:
+            self.data = {'version': STATS_VERSION, 'since': time.time(),
+                         'scopes': {}}
+        return self.data
+
+    def __exit__(self, *exc):
+        aws_metadata.write_json_atomic(self.path, self.data)
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+
+def flush(path=STATS_FILE):
+    """
+    Merge the counts of this process into the stats file.
+    """
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+    try:
+        with _Locked(path) as data:
+            _merge(data, pending)
+    except (IOError, OSError) as e:
+        log.debug("Could not write AWS call stats: {}".format(e))
+
+
+def read(path=STATS_FILE, reset=False, scopes=None):
+    """
+    Returns the stats file, {'since': <time>, 'scopes': {<scope>: ...}},
+    after merging the counts of this process into it. Each scope has the
+    time it is counted from as its since.
+
+    Args:
+        reset(bool): Start counting again from zero.
+        scopes(list): Only start these scopes again from zero, the others
+            keep counting.
+    """
+    flush(path)
+    with _Locked(path) as data:
+        result = dict(data, scopes=dict(data['scopes']))
+        if reset and scopes is not None:
+            now = time.time()
+            for name in scopes:
+                if name in data['scopes']:
+                    data['scopes'][name] = dict(_empty_scope(), since=now)
+        elif reset:
+            data.clear()
+            data.update({'version': STATS_VERSION, 'since': time.time(),
+                         'scopes': {}})
+    return result
+
+
+atexit.register(flush)
+
+
+def instrument_connection(connection, service, region):
+    """
+    Record every request made by a boto connection. The connection should
+    already be rate limited, so the latency includes the time spent waiting
+    for the rate limiter and on retries.
+
+    Args:
+        connection: A boto AWSQueryConnection.
+        service(str): The boto service, eg. 'ec2'.
+        region(str): The AWS region.
+
+    Returns:
+        The same connection.
+    """
+    make_request = connection.make_request
+
+    def instrumented_make_request(action, *args, **kwargs):
+        _start_call()
+        response = None
+        try:
+            response = make_request(action, *args, **kwargs)
+            return response
+        finally:
+            call = _end_call()
+            size = 0
+            error = None
+            if response is None:
+                error = 'ConnectionError'
+            else:
+                try:
+                    # boto caches the body, so the caller can still read it
+                    size = len(response.read())
+                except Exception:
+                    pass
+                if response.status >= 400:
+                    error = str(response.status)
+            record(service, region, action, time.time() - call['start'],
+                   retries=call['retries'], throttles=call['throttles'],
+                   size=size, error=error)
+
+    connection.make_request = instrumented_make_request
+    return connection
+
+
+def instrument_client(client, service, region):
+    """
+    Record every call made by a boto3 client, with botocore's own retries.
+
+    Args:
+        client: A boto3 client.
+        service(str): The boto3 service, eg. 'autoscaling'.
+        region(str): The AWS region.
+
+    Returns:
+        The same client.
+    """
+    def before_call(**kwargs):
+        _start_call()
+
+    def after_call(http_response=None, parsed=None, model=None, **kwargs):
+        call = _end_call()
+        parsed = parsed or {}
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        error = None
+        if http_response is not None and http_response.status_code >= 400:
+            error = parsed.get('Error', {}).get(
+                'Code', str(http_response.status_code))
+        size = len(http_response.content or b'') if http_response else 0
+        record(service, region, model.name if model else 'unknown',
+               time.time() - call['start'],
+               retries=max(retries, call['retries']),
+               throttles=call['throttles'], size=size, error=error)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    return client
@@ -1,13 +1,74 @@
 #!/usr/bin/env python
 import argparse
-import boto.ec2.autoscale
-import boto.ec2
-import boto.utils
 from boto.exception import EC2ResponseError
-import boto3
+import hashlib
 import json
 import logging
+import os
+import random
+import signal
 import sys
+import threading
+import time
+
+# Shared helpers from the formula's _utils directory, installed alongside
+# this script by the aws.autoeips state
+LIB_DIR = '/usr/local/lib/aws-formula'
+for _utils_path in (LIB_DIR,
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 os.pardir, os.pardir, '_utils')):
+    _utils_path = os.path.normpath(_utils_path)
+    if os.path.isdir(_utils_path) and _utils_path not in sys.path:
+        sys.path.insert(0, _utils_path)
+import aws_clients
+import aws_inventory
+import aws_metadata
+import aws_ratelimit
+import aws_stats
+
+STATE_FILE = '/var/lib/autoeips/state.json'
+STATE_TTL = 300
+DAEMON_INTERVAL = 15
+DAEMON_JITTER = 5
+FAILOVER_TIMEOUT = 30
+# Maximum number of instance ids per DescribeAutoScalingInstances call
+DESCRIBE_BATCH_SIZE = 50
+# Maximum age in seconds of the shared inventory snapshot used to check
+# the health of EIP holders
+INVENTORY_TTL = 30
+# Maximum number of concurrent associations when an instance holds several
+# EIPs
+MAX_PARALLEL = 4
+# Association errors meaning the EIP is taken or gone, so no other target
+# should try it either
+ADDRESS_CONFLICT_ERRORS = ('Resource.AlreadyAssociated',
+                           'InvalidAddress.InUse',
+                           'InvalidAddress.NotFound',
+                           'InvalidAllocationID.NotFound')
+
+
+def rendezvous_weight(instance_id, allocation_id):
+    """
+    Highest random weight hash of an instance against an EIP allocation.
+    """
+    key = '{}:{}'.format(instance_id, allocation_id)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def is_unhealthy_member(lifecycle_state, health_status):
+    """
+    Whether an autoscaling group member is unhealthy or leaving the group.
+    """
+    return (lifecycle_state.startswith(('Terminating', 'Detach')) or
+            health_status.upper() == 'UNHEALTHY')
+
+
+class RunAborted(Exception):
+    """
+    Raised by safe_exit in daemon mode to abandon the current run without
+    stopping the process.
+    """
+    pass
 
 
 class AutoEIP(object):
@@ -17,11 +78,20 @@ class AutoEIP(object):
     filter_addresses = None
     ec2_connection = None
     asg_connection = None
+    asg_client = None
     instance_metadata = None
     instance_id = None
     enable_standby_mode = None
     enable_failover_mode = None
     force = False
+    region = None
+    state_file = None
+    state_ttl = None
+    failover_timeout = None
+    listed_eips = None
+    daemon = False
+    eip_count = None
+    max_parallel = None
 
     def __init__(self,
                  filter_addresses,
@@ -30,9 +100,20 @@ class AutoEIP(object):
                  log_level='INFO',
                  log_format='json',
                  log_file=None,
-                 force=False):
+                 force=False,
+                 state_file=STATE_FILE,
+                 state_ttl=STATE_TTL,
+                 failover_timeout=FAILOVER_TIMEOUT,
+                 eip_count=1,
+                 max_parallel=MAX_PARALLEL):
         """
         Default constructor.
+
+        Args:
+            eip_count(int): Number of listed EIPs each instance should
+                hold, one per private ip across its network interfaces.
+            max_parallel(int): Maximum number of associations made at once
+                when eip_count is more than one.
         """
         self.setup_logging(log_level=log_level,
                            log_format=log_format,
@@ -46,23 +127,36 @@ class AutoEIP(object):
                              "it is not set, forcing it to be set.")
 
         self.force = force
+        self.state_file = state_file
+        self.state_ttl = state_ttl
+        self.failover_timeout = failover_timeout
+        self.eip_count = max(1, eip_count)
+        self.max_parallel = max(1, max_parallel)
+        if self.eip_count > 1 and self.enable_failover_mode:
+            self.logger.warning("Failover mode only reclaims EIPs for "
+                                "instances holding a single EIP, it is "
+                                "ignored with {} EIPs per instance"
+                                .format(self.eip_count))
 
         self.instance_metadata = self.get_instance_metadata()
         self.instance_id = self.instance_metadata.get('instance-id')
         # Collect details about this instance
-        vpc_id = (self.instance_metadata['network']
-                  ['interfaces']
-                  ['macs'].values()[0]
-                  ['vpc-id'])
-        region = (self.instance_metadata['placement']
-                  ['availability-zone'][:-1]
-                  )
-        # Setup boto3
-        boto3.setup_default_session(region_name=region)
+        self.region = self.instance_metadata['region']
+
+    def connect(self):
+        """
+        Create the AWS connections, this is deferred until they are needed
+        so that runs taking the local fast path make no API calls.
+        """
+        if self.ec2_connection is not None:
+            return
         # Enable required connections
-        self.ec2_connection = boto.ec2.connect_to_region(region)
-        if self.enable_standby_mode:
-            self.asg_connection = boto.ec2.autoscale.connect_to_region(region)
+        self.ec2_connection = aws_clients.get_connection('ec2', self.region)
+        if self.enable_standby_mode or self.enable_failover_mode:
+            self.asg_connection = aws_clients.get_connection('ec2.autoscale',
+                                                             self.region)
+            # Connect to ASG through boto3 to use its standby functions
+            self.asg_client = aws_clients.get_client('autoscaling', self.region)
 
         if self.ec2_connection is None:
             self.logger.critical("Critical error getting EC2 conection...exiting")
@@ -78,18 +172,314 @@ class AutoEIP(object):
             force(bool): True to associate an EIP even if we already have one, 
                  False to only associate an EIP if it doesnt have one.
         """
+        if self.eip_count > 1:
+            return self.update_associations()
+
+        if not self.force:
+            public_ip = self.get_local_association()
+            if public_ip:
+                self.logger.debug("Already associated with EIP: {} "
+                                  "(local state)".format(public_ip))
+                return
+
+        self.connect()
         instance_associations = self.get_instance_association()
         if len(instance_associations) < 1 or self.force:
             self.logger.info("Associating with any available eips in list {}"
                         .format(self.filter_addresses))
             filtered_eips = self.get_unassociated_eips()
-            success = self.associate_eip(filtered_eips)
+            if len(filtered_eips) < 1 and self.enable_failover_mode:
+                success = self.failover_eip()
+            else:
+                success = self.associate_eip(filtered_eips)
             if not success and not self.enable_failover_mode:
                 self.logger.critical("There was a problem associating instance {} "
                                      "with an EIP".format(self.instance_id))
         else:
             self.logger.debug("Already associated with EIP: {}".format(
                 instance_associations[0]))
+            self.save_state(instance_associations[0].public_ip)
+
+    def get_local_association(self):
+        """
+        Check, without any AWS API calls, whether this instance already holds
+        one of the EIPs in filter_addresses. The public ip reported by the
+        instance metadata must be in the list and match a state file that
+        was verified against the EC2 API less than state_ttl seconds ago.
+
+        Returns:
+            (str): The associated public ip, or None if the full check
+                against the EC2 API is required.
+        """
+        try:
+            public_ip = aws_metadata.get_instance_metadata().get(
+                'public-ipv4', max_age=0)
+        except aws_metadata.MetadataError as e:
+            self.logger.debug("Could not get public ip from metadata: {}"
+                              .format(e))
+            return None
+        if public_ip not in self.filter_addresses:
+            return None
+
+        state = aws_metadata.read_json(self.state_file) or {}
+        if (state.get('instance_id') != self.instance_id or
+                state.get('public_ip') != public_ip or
+                time.time() - state.get('verified', 0) > self.state_ttl):
+            return None
+        return public_ip
+
+    def save_state(self, public_ip):
+        """
+        Record that the EC2 API has confirmed this instance holds public_ip,
+        for use by get_local_association on later runs.
+
+        Args:
+            public_ip(str): The associated elastic ip address.
+        """
+        if public_ip not in self.filter_addresses:
+            return
+        aws_metadata.write_json_atomic(self.state_file, {
+            'instance_id': self.instance_id,
+            'public_ip': public_ip,
+            'verified': time.time(),
+        })
+
+    def update_associations(self):
+        """
+        Make sure this instance holds eip_count of the listed EIPs, one on
+        each of the first eip_count private ips of its network interfaces,
+        associating the missing ones in parallel so the instance gets all of
+        them in one pass. The instance is only put into standby if it holds
+        none. force only skips the local check.
+        """
+        targets = self.get_association_targets()
+        if not self.force:
+            public_ips = self.get_local_associations(targets)
+            if public_ips:
+                self.logger.debug("Already associated with EIPs: {} "
+                                  "(local state)".format(public_ips))
+                return
+
+        self.connect()
+        held = [eip for eip in self.get_instance_association()
+                if eip.public_ip in self.filter_addresses]
+        held_ips = set(eip.private_ip_address for eip in held)
+        free_targets = [target for target in targets
+                        if target['private_ip'] not in held_ips]
+        if free_targets:
+            self.logger.info("Associating {} private ips with any available "
+                             "eips in list {}".format(len(free_targets),
+                                                      self.filter_addresses))
+            held.extend(self.associate_eips(self.get_unassociated_eips(),
+                                            free_targets))
+        else:
+            self.logger.debug("Already associated with EIPs: {}"
+                              .format(held))
+
+        if len(held) < len(targets):
+            self.logger.warning("Holding {} of {} EIPs".format(len(held),
+                                                               len(targets)))
+        if not held:
+            self.logger.critical("There was a problem associating instance "
+                                 "{} with any EIP".format(self.instance_id))
+            self.update_standby_mode(True)
+            return
+        self.save_associations_state([eip.public_ip for eip in held],
+                                     len(targets))
+        if free_targets:
+            self.update_standby_mode(False)
+
+    def get_association_targets(self):
+        """
+        Find the private ips to associate EIPs with from the network
+        interfaces in the instance metadata: the ips of the primary
+        interface, primary ip first, then those of the other interfaces in
+        device order.
+
+        Returns:
+            (list): Up to eip_count dictionaries with interface_id, mac and
+                private_ip.
+        """
+        try:
+            interfaces = aws_metadata.get_instance_metadata().interfaces()
+        except aws_metadata.MetadataError as e:
+            self.logger.critical("Could not get network interfaces from "
+                                 "metadata: {}".format(e))
+            self.safe_exit(1)
+        targets = [{'interface_id': interface['interface_id'],
+                    'mac': interface['mac'],
+                    'private_ip': private_ip}
+                   for interface in interfaces
+                   for private_ip in interface['private_ips']]
+        if len(targets) < self.eip_count:
+            self.logger.warning("Only {} private ips for {} EIPs, assign "
+                                "more secondary ips or attach more "
+                                "interfaces".format(len(targets),
+                                                    self.eip_count))
+        return targets[:self.eip_count]
+
+    def get_local_associations(self, targets):
+        """
+        As get_local_association, for an instance holding several EIPs: the
+        listed public ips reported by the instance metadata for the target
+        interfaces must cover every target and match the state file.
+
+        Args:
+            targets(list): As returned by get_association_targets.
+
+        Returns:
+            (list): The associated public ips, or None if the full check
+                against the EC2 API is required.
+        """
+        instance_metadata = aws_metadata.get_instance_metadata()
+        public_ips = set()
+        try:
+            for mac in set(target['mac'] for target in targets):
+                public_ips.update((instance_metadata.get(
+                    'network/interfaces/macs/{}/public-ipv4s'.format(mac),
+                    max_age=0) or '').split())
+        except aws_metadata.MetadataError as e:
+            self.logger.debug("Could not get public ips from metadata: {}"
+                              .format(e))
+            return None
+        public_ips = sorted(ip for ip in public_ips
+                            if ip in self.filter_addresses)
+        if not targets or len(public_ips) < len(targets):
+            return None
+
+        state = aws_metadata.read_json(self.state_file) or {}
+        if (state.get('instance_id') != self.instance_id or
+                state.get('public_ips') != public_ips or
+                time.time() - state.get('verified', 0) > self.state_ttl):
+            return None
+        return public_ips
+
+    def save_associations_state(self, public_ips, target_count):
+        """
+        Record that the EC2 API has confirmed this instance holds
+        public_ips, for use by get_local_associations on later runs. Nothing
+        is recorded while the instance holds fewer than target_count, so
+        that the next run tries again.
+
+        Args:
+            public_ips(list): The associated elastic ip addresses.
+            target_count(int): The number of addresses it should hold.
+        """
+        if len(public_ips) < target_count:
+            return
+        aws_metadata.write_json_atomic(self.state_file, {
+            'instance_id': self.instance_id,
+            'public_ips': sorted(public_ips),
+            'verified': time.time(),
+        })
+
+    def associate_eips(self, eips, targets):
+        """
+        Associate one of eips with each of targets, up to max_parallel at
+        a time. Each target takes the next address in this instance's
+        preference order, moving on to the following one if another
+        instance claimed it first. A target that fails for any other reason
+        is skipped, leaving its address to the others. boto connections are not thread safe, so
+        every worker but the first associates through a connection of its
+        own.
+
+        Args:
+            eips(list): List of boto.ec2.address.Address objects.
+            targets(list): As returned by get_association_targets.
+
+        Returns:
+            (list): The addresses that were associated.
+        """
+        remaining = self.rank_eips(eips)
+        pending = list(targets)
+        associated = []
+        lock = threading.Lock()
+        start_time = time.time()
+
+        # Calls made by the workers count towards the run's scope
+        scope = aws_stats.current_scope()
+
+        def associate_next(connection):
+            with aws_stats.scope(scope, timed=False):
+                while True:
+                    with lock:
+                        if not pending or not remaining:
+                            return
+                        target = pending.pop(0)
+                    eip = self.claim_eip(target, remaining, lock, connection)
+                    if eip is not None:
+                        with lock:
+                            associated.append(eip)
+
+        connections = [self.ec2_connection] + [
+            aws_clients.new_connection('ec2', self.region)
+            for _ in range(min(self.max_parallel, len(targets)) - 1)]
+        workers = [threading.Thread(target=associate_next, args=(connection,))
+                   for connection in connections]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.logger.info("Associated {} of {} private ips in {:.2f}s"
+                         .format(len(associated), len(targets),
+                                 time.time() - start_time))
+        return associated
+
+    def claim_eip(self, target, remaining, lock, connection):
+        """
+        Associate target with the first of remaining that no other instance
+        claims first. Addresses found taken are dropped from remaining, any
+        other error gives up on target and puts the address back.
+
+        Args:
+            target(dict): As returned by get_association_targets.
+            remaining(list): Addresses not yet tried, shared by the
+                concurrent callers.
+            lock(threading.Lock): Lock guarding remaining.
+            connection: The EC2 connection of the calling thread.
+
+        Returns:
+            (boto.ec2.address.Address): The associated address, or None if
+                remaining ran out or target could not be associated.
+        """
+        while True:
+            with lock:
+                if not remaining:
+                    return None
+                eip = remaining.pop(0)
+            # Only this thread has the address now
+            eip.connection = connection
+            self.logger.info("Associating {} on {} with eip: {}..."
+                             .format(target['private_ip'],
+                                     target['interface_id'],
+                                     eip.allocation_id))
+            try:
+                if eip.associate(
+                        network_interface_id=target['interface_id'],
+                        private_ip_address=target['private_ip'],
+                        allow_reassociation=False):
+                    return eip
+                self.logger.warning("Association of {} with eip: {} was not "
+                                    "confirmed".format(target['private_ip'],
+                                                       eip.allocation_id))
+            except EC2ResponseError as e:
+                if e.error_code in ADDRESS_CONFLICT_ERRORS:
+                    # Most likely another instance claimed it first
+                    self.logger.info("Failed to associate with eip: {}, {}"
+                                     .format(eip.allocation_id, e.error_code))
+                    continue
+                self.logger.warning("Failed to associate {} with eip: {}, {}"
+                                    .format(target['private_ip'],
+                                            eip.allocation_id, e.error_code))
+            except Exception as e:
+                self.logger.error("Error associating {} with eip: {}, {}"
+                                  .format(target['private_ip'],
+                                          eip.allocation_id, e))
+            # Throttled, timed out or a bad target, the address is still
+            # free for the next one
+            with lock:
+                remaining.insert(0, eip)
+            return None
 
     def get_instance_association(self):
         """
@@ -104,20 +494,25 @@ class AutoEIP(object):
 
     def get_instance_metadata(self):
         """
-        Returns the instance metadata.
+        Returns the static instance metadata, from the shared metadata
+        cache where possible.
 
         Returns:
             instance_metadata(dict): Dictionary of instance metadata.
         """
-        instance_metadata = boto.utils.get_instance_metadata(timeout=5,
-                                                             num_retries=2)
+        try:
+            instance_metadata = aws_metadata.get_instance_metadata().static()
+        except aws_metadata.MetadataError as e:
+            self.logger.error(str(e))
+            instance_metadata = None
         if instance_metadata is None:
             self.logger.critical("Critical error getting instance metadata, "
                             "exiting")
             self.safe_exit(1)
         return instance_metadata
 
-    def associate_eip(self, eips, retries=3):
+    def associate_eip(self, eips, retries=3, allow_reassociation=False,
+                      standby_on_failure=True):
         """
         Try to associate an EIP with this instance
 
@@ -126,6 +521,10 @@ class AutoEIP(object):
                 attempted to associate with.
             retries(int): Number of times to retry associating with
                 each eip address.
+            allow_reassociation(bool): True to take over addresses that
+                are associated with another instance.
+            standby_on_failure(bool): False to leave entering standby to
+                the caller when no association succeeded.
 
         Return:
             success(bool): True if association was successful, False otherwise.
@@ -142,25 +541,63 @@ class AutoEIP(object):
             self.update_standby_mode(True)
             return False
         else:
+            # Each instance walks the eips in its own preference order, so
+            # instances launched together start on different addresses
+            eips = self.rank_eips(eips)
+            start_time = time.time()
+            attempts = 0
             for retry in range(retries):
                 for eip in eips:
                     self.logger.info("Associating instance: {} with eip: {}..."
                                 .format(self.instance_id,
                                         eip.allocation_id)
                                 )
-    
-                    success = eip.associate(
-                        instance_id=self.instance_id, allow_reassociation=False)
+                    attempts += 1
+                    try:
+                        success = eip.associate(
+                            instance_id=self.instance_id,
+                            allow_reassociation=allow_reassociation)
+                    except EC2ResponseError as e:
+                        # Most likely another instance claimed it first
+                        self.logger.info("Failed to associate with eip: {}, {}"
+                                         .format(eip.allocation_id, e.error_code))
+                        success = False
                     # If the association was successful, update the standby mode and exit
                     if success:
+                        self.logger.info("Associated with eip: {} after {} attempts "
+                                         "in {:.2f}s".format(eip.allocation_id,
+                                                             attempts,
+                                                             time.time() - start_time))
+                        self.save_state(eip.public_ip)
                         self.update_standby_mode(False)
                         return success
+            self.logger.info("Gave up associating after {} attempts in {:.2f}s"
+                             .format(attempts, time.time() - start_time))
         # We did not manage to associate any eips
         if not self.enable_failover_mode:
-            logger.warning("Failed to associate with any EIP's")
-        self.update_standby_mode(True)
+            self.logger.warning("Failed to associate with any EIP's")
+        if standby_on_failure:
+            self.update_standby_mode(True)
         return False
 
+    def rank_eips(self, eips):
+        """
+        Order eips by highest random weight (rendezvous) hashing of this
+        instance id against each allocation id. The order is stable for an
+        instance but differs between instances, so competing instances
+        mostly try different addresses first.
+
+        Args:
+            eips(list): List of boto.ec2.address.Address objects.
+
+        Returns:
+            (list): The same addresses, most preferred first.
+        """
+        return sorted(eips,
+                      key=lambda eip: rendezvous_weight(self.instance_id,
+                                                        eip.allocation_id),
+                      reverse=True)
+
     def get_unassociated_eips(self):
         """
         Get a list of unassociated EIP's out of the filtered list
@@ -179,6 +616,7 @@ class AutoEIP(object):
         try:
             eips = self.ec2_connection.get_all_addresses(
                 addresses=self.filter_addresses)
+            self.listed_eips = eips
 
             unassociated_eips = \
                 [eip for eip in eips if eip.association_id is None]
@@ -199,7 +637,177 @@ class AutoEIP(object):
                 self.update_standby_mode(True)
             self.safe_exit(exit_code=1)
 
-    
+    def failover_eip(self):
+        """
+        Reclaim a listed EIP whose current holder has been unhealthy or
+        terminating for at least failover_timeout seconds. The time each
+        holder was first seen unhealthy is kept in a failover state file
+        next to the association state file, and the measured failover
+        latency is logged once the address has been reclaimed.
+
+        Returns:
+            success(bool): True if an EIP was reclaimed, False otherwise.
+        """
+        holders = dict((eip.instance_id, eip) for eip in self.listed_eips or []
+                       if eip.instance_id)
+        failover_file = os.path.join(os.path.dirname(self.state_file),
+                                     'failover.json')
+        previous = aws_metadata.read_json(failover_file) or {}
+        now = time.time()
+        # Holders that have recovered or gone are dropped from the state
+        first_seen = dict((instance_id, previous.get(instance_id, now))
+                          for instance_id in self.get_unhealthy_instances(
+                              list(holders)))
+        aws_metadata.write_json_atomic(failover_file, first_seen)
+        for instance_id, seen in first_seen.items():
+            self.logger.info("EIP {} holder {} unhealthy for {:.1f}s"
+                             .format(holders[instance_id].public_ip,
+                                     instance_id, now - seen))
+
+        for instance_id, seen in sorted(first_seen.items(),
+                                        key=lambda item: item[1]):
+            eip = holders[instance_id]
+            unhealthy_for = now - seen
+            if unhealthy_for < self.failover_timeout:
+                continue
+            # Leave the address to the preferred standby instance, unless it
+            # has not claimed it within a second timeout
+            if (unhealthy_for < 2 * self.failover_timeout and
+                    not self.is_preferred_claimant(eip, list(holders))):
+                self.logger.info("Leaving EIP {} for another instance to "
+                                 "claim".format(eip.public_ip))
+                continue
+            if self.associate_eip([eip], retries=1, allow_reassociation=True,
+                                  standby_on_failure=False):
+                self.logger.warning("Failover of EIP {} from {} complete, "
+                                    "failover_latency {:.1f}s"
+                                    .format(eip.public_ip, instance_id,
+                                            time.time() - seen))
+                return True
+        return self.associate_eip([])
+
+    def get_unhealthy_instances(self, instance_ids):
+        """
+        Find which of instance_ids are unhealthy, terminating or gone. The
+        inventory snapshot shared with the grains and asg module is used
+        when it is fresh already, as collecting it describes the whole
+        region. Otherwise, and for instances it does not cover, eg. stopped
+        or in another vpc, only instance_ids are described.
+
+        Args:
+            instance_ids(list): Instance ids to check.
+
+        Returns:
+            (set): The unhealthy instance ids.
+        """
+        snapshot = aws_inventory.read_snapshot(
+            self.region, self.instance_metadata['vpc-id'],
+            ['instances', 'groups', 'impaired'], ttl=INVENTORY_TTL)
+        if snapshot is None:
+            return self.describe_unhealthy_instances(instance_ids)
+        instances = snapshot['instances']
+        groups = snapshot['groups']
+        impaired = snapshot['impaired']
+
+        members = dict((member['instance_id'], member)
+                       for group in groups.values()
+                       for member in group['instances'])
+        unhealthy = set()
+        unknown = []
+        for instance_id in instance_ids:
+            instance = instances.get(instance_id)
+            if instance is None:
+                unknown.append(instance_id)
+                continue
+            member = members.get(instance_id)
+            if (instance['state'] != 'running' or instance_id in impaired or
+                    (member and is_unhealthy_member(member['lifecycle_state'],
+                                                    member['health_status']))):
+                unhealthy.add(instance_id)
+        if unknown:
+            unhealthy.update(self.describe_unhealthy_instances(unknown))
+        return unhealthy
+
+    def describe_unhealthy_instances(self, instance_ids):
+        """
+        Find which of instance_ids are unhealthy, terminating or gone, using
+        batched autoscaling and instance status describe calls.
+
+        Args:
+            instance_ids(list): Instance ids to check.
+
+        Returns:
+            (set): The unhealthy instance ids.
+        """
+        unhealthy = set()
+        for i in range(0, len(instance_ids), DESCRIBE_BATCH_SIZE):
+            batch = instance_ids[i:i + DESCRIBE_BATCH_SIZE]
+            for instance in self.asg_connection.get_all_autoscaling_instances(
+                    instance_ids=batch):
+                if is_unhealthy_member(instance.lifecycle_state,
+                                       instance.health_status):
+                    unhealthy.add(instance.instance_id)
+            try:
+                statuses = self.ec2_connection.get_all_instance_status(
+                    instance_ids=batch, include_all_instances=True)
+            except EC2ResponseError as e:
+                self.logger.warning("Error getting instance status: {}"
+                                    .format(e.error_code))
+                continue
+            found = set()
+            for status in statuses:
+                found.add(status.id)
+                if (status.state_name != 'running' or
+                        status.system_status.status == 'impaired' or
+                        status.instance_status.status == 'impaired'):
+                    unhealthy.add(status.id)
+            unhealthy.update(set(batch) - found)
+        return unhealthy
+
+    def is_preferred_claimant(self, eip, holder_ids):
+        """
+        Check whether this instance ranks highest, by rendezvous hashing
+        against the allocation id, among the healthy members of its
+        autoscaling group that hold no listed EIP.
+
+        Args:
+            eip(boto.ec2.address.Address): The address being reclaimed.
+            holder_ids(list): Instance ids currently holding listed EIPs.
+
+        Returns:
+            (bool): True if this instance should claim the address.
+        """
+        groups = aws_inventory.get_snapshot(
+            self.region, self.instance_metadata['vpc-id'],
+            ttl=INVENTORY_TTL, sections=['groups']).get('groups')
+        if groups is None:
+            own = self.asg_connection.get_all_autoscaling_instances(
+                instance_ids=[self.instance_id])
+            if len(own) != 1:
+                return True
+            group = self.asg_connection.get_all_groups(
+                names=[own[0].group_name])[0]
+            members = [{
+                'instance_id': i.instance_id,
+                'lifecycle_state': i.lifecycle_state,
+                'health_status': i.health_status,
+            } for i in group.instances]
+        else:
+            group_name = aws_inventory.find_group(groups, self.instance_id)
+            if group_name is None:
+                return True
+            members = groups[group_name]['instances']
+        candidates = [m['instance_id'] for m in members
+                      if m['instance_id'] not in holder_ids and
+                      m['lifecycle_state'] in ('InService', 'Standby') and
+                      m['health_status'].upper() == 'HEALTHY']
+        if self.instance_id not in candidates:
+            return True
+        preferred = max(candidates,
+                        key=lambda instance_id: rendezvous_weight(
+                            instance_id, eip.allocation_id))
+        return preferred == self.instance_id
+
     def update_standby_mode(self,
                             enable_standby):
         """
@@ -235,9 +843,7 @@ class AutoEIP(object):
         
         autoscaling_group_name = autoscaling_groups[0].group_name
         instance_lifecycle_state = autoscaling_groups[0].lifecycle_state
-
-        # Connect to ASG through boto3 to use its enter_standby function
-        asg_client = boto3.client('autoscaling')
+        asg_client = self.asg_client
 
         if enable_standby:
             if instance_lifecycle_state == 'InService':
@@ -261,7 +867,6 @@ class AutoEIP(object):
             if instance_lifecycle_state == 'Standby':
                 self.logger.warn("Disabling standby mode on instance {}, "
                             "this instance will now serve traffic.".format(self.instance_id))
-                # Connect to ASG through boto3 to use its enter_standby function
                 response = asg_client.exit_standby(
                     InstanceIds=[self.instance_id],
                     AutoScalingGroupName=autoscaling_group_name
@@ -282,16 +887,74 @@ class AutoEIP(object):
                 return False
         return False
             
+    def log_call_stats(self):
+        """
+        Log how many AWS calls this process has made, and how long they
+        were held back by the host wide rate limiter, followed by the
+        calls, latency, retries, throttles and response bytes of each
+        operation.
+        """
+        stats = aws_ratelimit.get_stats()
+        if not stats['calls']:
+            return
+        level = logging.INFO if stats['throttles'] else logging.DEBUG
+        self.logger.log(level,
+                        "AWS calls: {calls}, throttled: {throttles}, "
+                        "retries: {retries}, rate limited for "
+                        "{throttled_seconds:.2f}s".format(**stats))
+        for operation, op in sorted(aws_stats.summary().items()):
+            self.logger.log(level,
+                            "AWS call stats {}: calls: {calls}, errors: "
+                            "{errors}, seconds: {seconds:.3f}, max: "
+                            "{max_seconds:.3f}, retries: {retries}, "
+                            "throttles: {throttles}, bytes: {bytes}"
+                            .format(operation, **op))
+
     def safe_exit(self, exit_code):
         """
         Method to abstract a safe exit from the script to allow for variation
         in exit actions.
 
+        In daemon mode only the current run is abandoned, the process
+        carries on with the next run.
+
         Args:
             exit_code(int): The sys exit code to use.
         """
+        self.log_call_stats()
+        if self.daemon:
+            raise RunAborted(exit_code)
         sys.exit(exit_code)
 
+    def run_forever(self,
+                    interval=DAEMON_INTERVAL,
+                    jitter=DAEMON_JITTER):
+        """
+        Run update_association in a loop, keeping this object and its AWS
+        connections alive between runs.
+
+        Args:
+            interval(int): Seconds between runs.
+            jitter(int): Maximum number of seconds to randomly add to or
+                subtract from each interval, so a fleet started at the same
+                moment does not call the AWS APIs in lockstep.
+        """
+        self.daemon = True
+        self.logger.info("Starting autoeips daemon, interval {}s, jitter {}s"
+                         .format(interval, jitter))
+        while True:
+            try:
+                with aws_stats.scope('autoeips'):
+                    self.update_association()
+            except RunAborted as e:
+                self.logger.error("Run aborted with exit code {}".format(e))
+            except Exception as e:
+                self.logger.exception("Unexpected error updating EIP "
+                                      "association: {}".format(e))
+            else:
+                self.log_call_stats()
+            time.sleep(max(1, interval + random.uniform(-jitter, jitter)))
+
     def setup_logging(self,
                       log_level='INFO',
                       log_format='json',
@@ -356,6 +1019,58 @@ if __name__ == '__main__':
                         help=('Force association of EIP addresses'),
                         action='store_true'
                         )
+    parser.add_argument('--state-file',
+                        dest='state_file',
+                        help=('File recording the last verified EIP association'),
+                        default=STATE_FILE
+                        )
+    parser.add_argument('--state-ttl',
+                        dest='state_ttl',
+                        type=int,
+                        help=('Seconds a verified association is trusted before '
+                              'checking it against the EC2 API again'),
+                        default=STATE_TTL
+                        )
+    parser.add_argument('--daemon',
+                        dest='daemon',
+                        help=('Keep running, updating the association every '
+                              'interval instead of once'),
+                        action='store_true'
+                        )
+    parser.add_argument('--interval',
+                        dest='interval',
+                        type=float,
+                        help=('Seconds between runs in daemon mode'),
+                        default=DAEMON_INTERVAL
+                        )
+    parser.add_argument('--jitter',
+                        dest='jitter',
+                        type=float,
+                        help=('Maximum random seconds added to or subtracted '
+                              'from the interval in daemon mode'),
+                        default=DAEMON_JITTER
+                        )
+    parser.add_argument('--failover-timeout',
+                        dest='failover_timeout',
+                        type=float,
+                        help=('Seconds an EIP holder must be unhealthy or '
+                              'terminating before failover mode reclaims it'),
+                        default=FAILOVER_TIMEOUT
+                        )
+    parser.add_argument('--eips-per-instance',
+                        dest='eip_count',
+                        type=int,
+                        help=('Number of EIPs each instance should hold, one '
+                              'per private ip across its network interfaces'),
+                        default=1
+                        )
+    parser.add_argument('--max-parallel',
+                        dest='max_parallel',
+                        type=int,
+                        help=('Maximum number of associations made at once '
+                              'with more than one EIP per instance'),
+                        default=MAX_PARALLEL
+                        )
     args = parser.parse_args()
     #  Load EIP list from string
     try:
@@ -371,8 +1086,19 @@ if __name__ == '__main__':
                       log_level=args.log_level,
                       log_format=args.log_format,
                       log_file=args.log_file,
-                      force=args.force
+                      force=args.force,
+                      state_file=args.state_file,
+                      state_ttl=args.state_ttl,
+                      failover_timeout=args.failover_timeout,
+                      eip_count=args.eip_count,
+                      max_parallel=args.max_parallel
                       )
-    
-    autoeip.update_association()
+
+    if args.daemon:
+        # Exit cleanly when the service manager stops us
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        autoeip.run_forever(interval=args.interval, jitter=args.jitter)
+    with aws_stats.scope('autoeips'):
+        autoeip.update_association()
+    autoeip.log_call_stats()
     sys.exit(0)
@@ -0,0 +1,646 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the instance metadata service and the AWS APIs used by
+the formula, for benchmarking.
+
+A Fleet is an in-memory model of one region and vpc: instances, an
+autoscaling group, classic load balancers and target groups, elastic IPs, a
+CloudFormation stack and an elasticache replication group. Its stub
+connections are injected into aws_clients, so the grains, the asg module and
+autoeips.py use them in place of boto, and a small HTTP server answers
+instance metadata requests for one of its instances. Every call is counted,
+along with the size of its response serialised as json, which stands in for
+the bytes AWS would have sent.
+
+The stubs take the same arguments as the boto 2.49 methods they stand in
+for, which check_signatures verifies, and return the shapes AWS and boto
+do. Responses whose attributes boto names after the raw AWS fields, such as
+a CloudFormation Stack, are built with the real boto classes.
+"""
+import importlib
+import inspect
+import json
+import os
+import sys
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from boto.cloudformation.stack import Output, Stack
+from boto.exception import EC2ResponseError
+
+REGION = 'eu-west-1'
+VPC_ID = 'vpc-0bench'
+AZS = ('eu-west-1a', 'eu-west-1b', 'eu-west-1c')
+ASG_NAME = 'bench-asg'
+STACK_NAME = 'bench-stack'
+REPLICATION_GROUP = 'bench-redis'
+# Instances registered with each load balancer and target group
+LB_MEMBERS = 10
+# Page sizes of the stubbed APIs
+ELB_PAGE_SIZE = 400
+ASG_PAGE_SIZE = 50
+STATUS_PAGE_SIZE = 1000
+CACHE_CLUSTER_PAGE_SIZE = 100
+# Shards of the elasticache replication group, which is in cluster mode
+CACHE_SHARDS = 3
+
+
+class Meter(object):
+    """
+    Counts stub API and metadata calls and their response sizes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.api_calls = 0
+        self.api_bytes = 0
+        self.imds_calls = 0
+        self.imds_bytes = 0
+        self.operations = {}
+
+    def api(self, operation, payload):
+        size = len(json.dumps(payload, default=str))
+        with self.lock:
+            self.api_calls += 1
+            self.api_bytes += size
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+
+    def imds(self, size):
+        with self.lock:
+            self.imds_calls += 1
+            self.imds_bytes += size
+
+    def report(self):
+        return {
+            'api_calls': self.api_calls,
+            'api_bytes': self.api_bytes,
+            'imds_calls': self.imds_calls,
+            'imds_bytes': self.imds_bytes,
+            'operations': dict(self.operations),
+        }
+
+
+class Obj(object):
+    """
+    Attribute access to a dictionary, standing in for boto response objects.
+    """
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class ResultSet(list):
+    next_token = None
+    next_marker = None
+
+
+def _page(items, token, size):
+    start = int(token or 0)
+    page = ResultSet(items[start:start + size])
+    if start + size < len(items):
+        page.next_token = page.next_marker = str(start + size)
+    return page
+
+
+class Fleet(object):
+    """
+    In-memory model of a region and vpc with size instances and as many
+    load balancers and target groups.
+    """
+    def __init__(self, size, meter=None, lbs=None, eips=None):
+        self.size = size
+        self.meter = meter or Meter()
+        self.instances = []
+        for n in range(size):
+            subnet = n % len(AZS)
+            self.instances.append({
+                'id': 'i-{:08x}'.format(n + 1),
+                'interface_id': 'eni-{:08x}'.format(n + 1),
+                'state': 'running',
+                'private_ip_address': '10.{}.{}.{}'.format(
+                    n // 65536, (n // 256) % 256, n % 256),
+                'private_dns_name': 'ip-10-{}-{}-{}.{}.compute.internal'
+                .format(n // 65536, (n // 256) % 256, n % 256, REGION),
+                'subnet_id': 'subnet-{}'.format(subnet),
+                'placement': AZS[subnet],
+                'lifecycle_state': 'InService',
+                'tags': {
+                    'aws:autoscaling:groupName': ASG_NAME,
+                    'aws:cloudformation:stack-name': STACK_NAME,
+                    'Role': 'web' if n % 2 else 'worker',
+                },
+            })
+        self.by_id = dict((i['id'], i) for i in self.instances)
+        self.lbs = []
+        for n in range(size if lbs is None else lbs):
+            members = [self.instances[(n * LB_MEMBERS + m) % size]['id']
+                       for m in range(min(LB_MEMBERS, size))]
+            self.lbs.append({'name': 'bench-lb-{}'.format(n),
+                             'members': members})
+        self.addresses = []
+        for n in range(max(1, size // 10) if eips is None else eips):
+            self.addresses.append({
+                'public_ip': '203.0.{}.{}'.format(n // 256, n % 256),
+                'allocation_id': 'eipalloc-{:08x}'.format(n + 1),
+                'association_id': None,
+                'instance_id': None,
+                'network_interface_id': None,
+                'private_ip_address': None,
+            })
+        # The instance the code under test runs on
+        self.local = self.instances[0]
+
+    # Persistence of the mutable parts, so a later process sees the same
+    # associations and lifecycle states
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'addresses': self.addresses,
+                'lifecycle': dict((i['id'], i['lifecycle_state'])
+                                  for i in self.instances),
+            }, f)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            state = json.load(f)
+        self.addresses = state['addresses']
+        for instance_id, lifecycle_state in state['lifecycle'].items():
+            self.by_id[instance_id]['lifecycle_state'] = lifecycle_state
+
+    def public_ip(self, instance_id):
+        for address in self.addresses:
+            if address['instance_id'] == instance_id:
+                return address['public_ip']
+        return None
+
+    def connections(self):
+        """
+        Returns the stub boto connections and boto3 clients, keyed by
+        (service, region) as in aws_clients.
+        """
+        return {
+            ('ec2', REGION): EC2Stub(self),
+            ('ec2.autoscale', REGION): AutoscaleStub(self),
+            ('ec2.elb', REGION): ELBStub(self),
+            ('cloudformation', REGION): CloudFormationStub(self),
+            ('elasticache', REGION): ElasticacheStub(self),
+        }, {
+            ('autoscaling', REGION): AutoscalingClientStub(self),
+            ('elbv2', REGION): ELBv2ClientStub(self),
+        }
+
+    def connect(self, service, region):
+        """
+        Returns a new stub boto connection, as aws_clients._connect does.
+        """
+        return self.connections()[0].get((service, region))
+
+    def install(self, aws_clients):
+        """
+        Inject the stubs into aws_clients in place of boto.
+        """
+        connections, clients = self.connections()
+        aws_clients._connect = self.connect
+        aws_clients.reset()
+        aws_clients._connections.update(connections)
+        aws_clients._clients.update(clients)
+
+
+class _Stub(object):
+    def __init__(self, fleet):
+        self.fleet = fleet
+
+    def _record(self, operation, payload):
+        self.fleet.meter.api(operation, payload)
+
+
+class AddressStub(object):
+    """
+    Stands in for boto.ec2.address.Address.
+    """
+    def __init__(self, connection, a):
+        self.connection = connection
+        self.data = a
+        for name in ('public_ip', 'allocation_id', 'association_id',
+                     'instance_id', 'network_interface_id',
+                     'private_ip_address'):
+            setattr(self, name, a[name])
+
+    def associate(self, instance_id=None, network_interface_id=None,
+                  private_ip_address=None, allow_reassociation=False,
+                  dry_run=False):
+        a = self.data
+        self.connection._record('AssociateAddress',
+                          {'allocation_id': a['allocation_id']})
+        if a['instance_id'] and not allow_reassociation:
+            # As AWS does for an address associated in the meantime
+            error = EC2ResponseError(400, 'Bad Request')
+            error.error_code = 'Resource.AlreadyAssociated'
+            raise error
+        if network_interface_id:
+            instance = [i for i in self.connection.fleet.instances
+                        if i['interface_id'] == network_interface_id][0]
+        else:
+            instance = self.connection.fleet.by_id[instance_id]
+        a.update({
+            'instance_id': instance['id'],
+            'network_interface_id': instance['interface_id'],
+            'private_ip_address': (private_ip_address or
+                                   instance['private_ip_address']),
+            'association_id': 'eipassoc-' + a['allocation_id'][9:],
+        })
+        return True
+
+
+class EC2Stub(_Stub):
+    address_class = AddressStub
+
+    def _instance(self, i):
+        return Obj(id=i['id'], state=i['state'],
+                   private_ip_address=i['private_ip_address'],
+                   private_dns_name=i['private_dns_name'],
+                   subnet_id=i['subnet_id'], placement=i['placement'],
+                   tags=dict(i['tags']))
+
+    def get_only_instances(self, instance_ids=None, filters=None,
+                           dry_run=False, max_results=None):
+        filters = filters or {}
+        items = [i for i in self.fleet.instances
+                 if (not instance_ids or i['id'] in instance_ids) and
+                 filters.get('instance-state-name', i['state']) == i['state']]
+        # boto follows every page of max_results itself
+        size = max_results or len(items) or 1
+        for start in range(0, max(1, len(items)), size):
+            self._record('DescribeInstances', items[start:start + size])
+        return [self._instance(i) for i in items]
+
+    def get_all_instance_status(self, instance_ids=None, max_results=None,
+                                next_token=None, filters=None, dry_run=False,
+                                include_all_instances=False):
+        items = [i for i in self.fleet.instances
+                 if (not instance_ids or i['id'] in instance_ids) and
+                 (include_all_instances or i['state'] == 'running')]
+        page = _page(items, next_token, max_results or STATUS_PAGE_SIZE)
+        payload = [{'id': i['id'], 'state': i['state'],
+                    'system': 'ok', 'instance': 'ok'} for i in page]
+        self._record('DescribeInstanceStatus', payload)
+        result = ResultSet(Obj(id=s['id'], state_name=s['state'],
+                               system_status=Obj(status=s['system']),
+                               instance_status=Obj(status=s['instance']))
+                           for s in payload)
+        result.next_token = page.next_token
+        return result
+
+    def get_all_addresses(self, addresses=None, filters=None,
+                          allocation_ids=None, dry_run=False):
+        items = self.fleet.addresses
+        if addresses:
+            items = [a for a in items if a['public_ip'] in addresses]
+        if filters and 'instance-id' in filters:
+            items = [a for a in items
+                     if a['instance_id'] == filters['instance-id']]
+        self._record('DescribeAddresses', items)
+        return ResultSet(self.address_class(self, a) for a in items)
+
+
+class AutoscaleStub(_Stub):
+
+    def _members(self, instance_ids=None):
+        return [{'instance_id': i['id'],
+                 'lifecycle_state': i['lifecycle_state'],
+                 'health_status': 'HEALTHY',
+                 'group_name': ASG_NAME}
+                for i in self.fleet.instances
+                if not instance_ids or i['id'] in instance_ids]
+
+    def get_all_groups(self, names=None, max_records=None, next_token=None):
+        members = self._members()
+        payload = {'name': ASG_NAME, 'desired_capacity': len(members),
+                   'instances': members}
+        groups = [payload] if not names or ASG_NAME in names else []
+        page = _page(groups, next_token, max_records or ASG_PAGE_SIZE)
+        self._record('DescribeAutoScalingGroups', list(page))
+        result = ResultSet(Obj(name=g['name'],
+                               desired_capacity=g['desired_capacity'],
+                               instances=[Obj(**m) for m in g['instances']])
+                           for g in page)
+        result.next_token = page.next_token
+        return result
+
+    def get_all_autoscaling_instances(self, instance_ids=None,
+                                      max_records=None, next_token=None):
+        members = self._members(instance_ids)
+        self._record('DescribeAutoScalingInstances', members)
+        return ResultSet(Obj(**m) for m in members)
+
+    def get_all_activities(self, autoscale_group, activity_ids=None,
+                           max_records=None, next_token=None):
+        activities = [{'activity_id': 'bench-activity-1',
+                       'status_code': 'Successful',
+                       'progress': 100}]
+        self._record('DescribeScalingActivities', activities)
+        return ResultSet(Obj(**a) for a in activities)
+
+
+class ELBStub(_Stub):
+
+    def get_all_load_balancers(self, load_balancer_names=None, marker=None):
+        page = _page(self.fleet.lbs, marker, ELB_PAGE_SIZE)
+        payload = [{
+            'name': lb['name'],
+            'dns_name': '{}.{}.elb.amazonaws.com'.format(lb['name'], REGION),
+            'scheme': 'internal',
+            'vpc_id': VPC_ID,
+            'security_groups': ['sg-bench'],
+            'instances': lb['members'],
+        } for lb in page]
+        self._record('DescribeLoadBalancers', payload)
+        result = ResultSet(Obj(instances=[Obj(id=m) for m in p.pop('instances')],
+                               **p) for p in payload)
+        result.next_marker = page.next_marker
+        return result
+
+
+class CloudFormationStub(_Stub):
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        outputs = {
+            'ElasticacheEngine': 'redis',
+            'ElasticacheReplicationGroupName': REPLICATION_GROUP,
+        }
+        self._record('DescribeStacks', outputs)
+        stack = Stack()
+        for name, value in (('StackName', STACK_NAME),
+                            ('CreationTime', '2016-01-01T00:00:00Z'),
+                            ('LastUpdatedTime', '2016-01-02T00:00:00Z')):
+            stack.endElement(name, value, None)
+        for key, value in outputs.items():
+            output = Output()
+            output.endElement('OutputKey', key, None)
+            output.endElement('OutputValue', value, None)
+            stack.outputs.append(output)
+        return ResultSet([stack])
+
+
+class ElasticacheStub(_Stub):
+    """
+    A replication group in cluster mode. As from AWS, its node groups have
+    no primary endpoint and their members no endpoints or roles, which only
+    DescribeCacheClusters gives.
+    """
+    def _members(self):
+        for shard in range(CACHE_SHARDS):
+            for node in range(len(AZS)):
+                yield shard, {
+                    'CacheClusterId': '{}-{:04d}-{:03d}'.format(
+                        REPLICATION_GROUP, shard + 1, node + 1),
+                    'CacheNodeId': '0001',
+                    'PreferredAvailabilityZone': AZS[node],
+                }
+
+    def describe_replication_groups(self, replication_group_id=None,
+                                    max_records=None, marker=None):
+        node_groups = [{
+            'NodeGroupId': '{:04d}'.format(shard + 1),
+            'Status': 'available',
+            'Slots': '{}-{}'.format(shard * 16384 // CACHE_SHARDS,
+                                    (shard + 1) * 16384 // CACHE_SHARDS - 1),
+            'NodeGroupMembers': [m for s, m in self._members() if s == shard],
+        } for shard in range(CACHE_SHARDS)]
+        group = {
+            'ReplicationGroupId': REPLICATION_GROUP,
+            'Status': 'available',
+            'ClusterEnabled': True,
+            'ConfigurationEndpoint': {
+                'Address': 'clustercfg.{}.bench.cache.amazonaws.com'.format(
+                    REPLICATION_GROUP),
+                'Port': 6379,
+            },
+            'MemberClusters': [m['CacheClusterId']
+                               for s, m in self._members()],
+            'NodeGroups': node_groups,
+        }
+        self._record('DescribeReplicationGroups', group)
+        return {'DescribeReplicationGroupsResponse': {
+            'DescribeReplicationGroupsResult': {
+                'ReplicationGroups': [group]}}}
+
+    def describe_cache_clusters(self, cache_cluster_id=None, max_records=None,
+                                marker=None, show_cache_node_info=None):
+        clusters = []
+        for shard, member in self._members():
+            cluster = {
+                'CacheClusterId': member['CacheClusterId'],
+                'ReplicationGroupId': REPLICATION_GROUP,
+                'PreferredAvailabilityZone':
+                    member['PreferredAvailabilityZone'],
+            }
+            if show_cache_node_info:
+                cluster['CacheNodes'] = [{
+                    'CacheNodeId': member['CacheNodeId'],
+                    'Endpoint': {
+                        'Address': '{}.bench.cache.amazonaws.com'.format(
+                            member['CacheClusterId']),
+                        'Port': 6379,
+                    },
+                }]
+            if cache_cluster_id in (None, cluster['CacheClusterId']):
+                clusters.append(cluster)
+        page = _page(clusters, marker, max_records or CACHE_CLUSTER_PAGE_SIZE)
+        self._record('DescribeCacheClusters', list(page))
+        return {'DescribeCacheClustersResponse': {
+            'DescribeCacheClustersResult': {
+                'CacheClusters': list(page),
+                'Marker': page.next_marker}}}
+
+
+class AutoscalingClientStub(_Stub):
+
+    def _set_lifecycle(self, operation, instance_ids, state):
+        for instance_id in instance_ids:
+            self.fleet.by_id[instance_id]['lifecycle_state'] = state
+        self._record(operation, instance_ids)
+        return {'Activities': []}
+
+    def enter_standby(self, InstanceIds, **kwargs):
+        return self._set_lifecycle('EnterStandby', InstanceIds, 'Standby')
+
+    def exit_standby(self, InstanceIds, **kwargs):
+        return self._set_lifecycle('ExitStandby', InstanceIds, 'InService')
+
+
+class _Paginator(object):
+    def __init__(self, stub, operation, key, items):
+        self.stub = stub
+        self.operation = operation
+        self.key = key
+        self.items = items
+
+    def paginate(self, **kwargs):
+        for start in range(0, max(1, len(self.items)), ELB_PAGE_SIZE):
+            page = self.items[start:start + ELB_PAGE_SIZE]
+            self.stub._record(self.operation, page)
+            yield {self.key: page}
+
+
+class ELBv2ClientStub(_Stub):
+
+    def _arn(self, kind, name):
+        return 'arn:aws:elasticloadbalancing:{}:0:{}/{}'.format(
+            REGION, kind, name)
+
+    def get_paginator(self, operation):
+        if operation == 'describe_load_balancers':
+            return _Paginator(self, 'DescribeLoadBalancersV2',
+                              'LoadBalancers', [{
+                                  'LoadBalancerArn': self._arn('alb', lb['name']),
+                                  'LoadBalancerName': lb['name'],
+                                  'DNSName': lb['name'] + '.elb.amazonaws.com',
+                                  'Scheme': 'internal',
+                                  'Type': 'application',
+                                  'VpcId': VPC_ID,
+                                  'SecurityGroups': ['sg-bench'],
+                              } for lb in self.fleet.lbs])
+        return _Paginator(self, 'DescribeTargetGroups', 'TargetGroups', [{
+            'TargetGroupArn': self._arn('targetgroup', lb['name']),
+            'TargetGroupName': lb['name'],
+            'Port': 80,
+            'Protocol': 'HTTP',
+            'VpcId': VPC_ID,
+            'TargetType': 'instance',
+            'LoadBalancerArns': [self._arn('alb', lb['name'])],
+        } for lb in self.fleet.lbs])
+
+    def describe_target_health(self, TargetGroupArn, **kwargs):
+        name = TargetGroupArn.rsplit('/', 1)[1]
+        lb = [lb for lb in self.fleet.lbs if lb['name'] == name][0]
+        targets = [{'Target': {'Id': m, 'Port': 80},
+                    'TargetHealth': {'State': 'healthy'}}
+                   for m in lb['members']]
+        self._record('DescribeTargetHealth', targets)
+        return {'TargetHealthDescriptions': targets}
+
+
+class MetadataServer(object):
+    """
+    Instance metadata service for the local instance of a fleet, served on
+    a free port of 127.0.0.1.
+    """
+    def __init__(self, fleet):
+        self.fleet = fleet
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.lookup(self.path)
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = body.encode('utf-8')
+                server.fleet.meter.imds(len(body))
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/latest/'.format(
+            self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def lookup(self, path):
+        local = self.fleet.local
+        mac = '0a:00:00:00:00:01'
+        interface = '/latest/meta-data/network/interfaces/macs/{}/'.format(mac)
+        values = {
+            '/latest/dynamic/instance-identity/document': json.dumps({
+                'instanceId': local['id'],
+                'instanceType': 'm4.large',
+                'imageId': 'ami-0bench',
+                'accountId': '000000000000',
+                'region': REGION,
+                'availabilityZone': local['placement'],
+                'privateIp': local['private_ip_address'],
+            }),
+            '/latest/meta-data/instance-id': local['id'],
+            '/latest/meta-data/mac': mac,
+            interface + 'vpc-id': VPC_ID,
+            interface + 'subnet-id': local['subnet_id'],
+            '/latest/meta-data/local-hostname': local['private_dns_name'],
+            '/latest/meta-data/public-ipv4': self.fleet.public_ip(local['id']),
+            '/latest/meta-data/network/interfaces/macs/': mac + '/',
+            interface + 'interface-id': local['interface_id'],
+            interface + 'device-number': '0',
+            interface + 'local-ipv4s': local['private_ip_address'],
+        }
+        return values.get(path)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_repo_paths(root):
+    """
+    Make the formula's _utils importable, as salt does on a minion.
+    """
+    utils = os.path.join(root, '_utils')
+    if utils not in sys.path:
+        sys.path.insert(0, utils)
+
+
+# The boto 2 classes the stubs stand in for
+STUBBED_CLASSES = (
+    (EC2Stub, 'boto.ec2.connection', 'EC2Connection'),
+    (AddressStub, 'boto.ec2.address', 'Address'),
+    (AutoscaleStub, 'boto.ec2.autoscale', 'AutoScaleConnection'),
+    (ELBStub, 'boto.ec2.elb', 'ELBConnection'),
+    (CloudFormationStub, 'boto.cloudformation.connection',
+     'CloudFormationConnection'),
+    (ElasticacheStub, 'boto.elasticache.layer1', 'ElastiCacheConnection'),
+)
+
+
+def _arguments(func):
+    try:
+        spec = inspect.getfullargspec(func)
+    except AttributeError:
+        spec = inspect.getargspec(func)
+    return spec.args, spec.defaults
+
+
+def check_signatures():
+    """
+    Returns the public methods of the stubs whose arguments differ from
+    those of the boto methods they stand in for, as descriptions.
+    """
+    mismatches = []
+    for stub, module, name in STUBBED_CLASSES:
+        real = getattr(importlib.import_module(module), name)
+        for method in sorted(vars(stub)):
+            if (method.startswith('_') or
+                    not inspect.isfunction(vars(stub)[method])):
+                continue
+            expected = _arguments(getattr(real, method))
+            actual = _arguments(getattr(stub, method))
+            if actual != expected:
+                mismatches.append('{}.{}{} is {}.{}{}'.format(
+                    stub.__name__, method, actual, name, method, expected))
+    return mismatches
@@ -0,0 +1,655 @@
+#!/usr/bin/env python
+"""
+Simulate a fleet of instances running autoeips.py against each other.
+
+Every simulated instance runs the real AutoEIP.update_association, on the
+cron schedule or as the daemon, against an in-memory model of the elastic
+IPs and the autoscaling group. Time is virtual: each API call takes a random
+latency during which the other instances carry on, so instances race for the
+same addresses as they do against AWS, and a simulated hour takes seconds.
+
+For each combination of assignment strategy, mode and interval it reports how
+long the fleet took to settle, with every address held and, in standby mode,
+exactly the instances without one in Standby, and what it cost in API calls,
+failed associations and standby transitions. A single scale out varies a lot
+with the seed, so each result is the mean of runs with several seeds, the
+same for every combination.
+
+.. code-block:: bash
+
+    python benchmarks/contention.py
+    python benchmarks/contention.py --instances 50 --eips 20 --modes daemon \\
+        --intervals 5 15 30
+    python benchmarks/contention.py --terminate 5 --terminate-at 300
+    python benchmarks/contention.py --seeds 20
+"""
+import argparse
+import functools
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import aws_stub
+from run import ROOT, load_source
+
+log = logging.getLogger(__name__)
+
+STRATEGIES = ('rendezvous', 'list-order', 'random')
+MODES = ('cron', 'daemon')
+# The autoeips cron job runs every minute
+CRON_INTERVAL = 60
+# Seconds a cron started python process takes to reach update_association
+CRON_STARTUP = 1.0
+# Range of the latency in seconds of each API and metadata call
+API_LATENCY = (0.05, 0.25)
+IMDS_LATENCY = 0.001
+COLUMNS = (
+    ('strategy', '{:<10}'),
+    ('mode', '{:<6}'),
+    ('interval', '{:>8}'),
+    ('settled_s', '{:>9}'),
+    ('runs', '{:>6}'),
+    ('api_calls', '{:>9}'),
+    ('settle_calls', '{:>12}'),
+    ('failed_assoc', '{:>12}'),
+    ('enter_standby', '{:>13}'),
+    ('exit_standby', '{:>12}'),
+    ('flapped', '{:>7}'),
+)
+# Columns averaged over the seeds
+MEAN_COLUMNS = ('settled_s', 'runs', 'api_calls', 'settle_calls',
+                'failed_assoc', 'enter_standby', 'exit_standby', 'flapped')
+
+
+class Stopped(BaseException):
+    """
+    Raised in the thread of a simulated instance when the simulation ends,
+    a BaseException so that autoeips.py does not catch it.
+    """
+    pass
+
+
+class _Actor(object):
+    """
+    A thread of the simulation, only running while the clock hands it the
+    turn.
+    """
+    def __init__(self, clock, target, context):
+        self.clock = clock
+        self.target = target
+        self.context = context
+        self.go = threading.Event()
+        self.finished = False
+        self.thread = threading.Thread(target=self._main)
+        self.thread.daemon = True
+
+    def _main(self):
+        self.go.wait()
+        try:
+            if not self.clock.stopped:
+                self.target()
+        except Stopped:
+            pass
+        except Exception as e:
+            log.exception("Simulated instance failed: {}".format(e))
+        finally:
+            self.finished = True
+            self.clock.yielded.set()
+
+
+class Clock(object):
+    """
+    Virtual clock running the simulated instances one at a time. An actor
+    calling sleep hands the turn to whichever actor or event is due next,
+    so the calls of different instances interleave by their latencies.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.queue = []
+        self.seq = itertools.count()
+        self.actors = []
+        self.current = None
+        self.stopped = False
+        self.yielded = threading.Event()
+
+    def time(self):
+        return self.now
+
+    def at(self, when, func):
+        """
+        Call func in the simulation loop at the virtual time when.
+        """
+        heapq.heappush(self.queue, (when, next(self.seq), func))
+
+    def spawn(self, when, target, context=None):
+        """
+        Start an actor running target at the virtual time when.
+        """
+        actor = _Actor(self, target, context)
+        self.actors.append(actor)
+        self.at(when, actor)
+
+    def sleep(self, seconds):
+        """
+        Suspend the running actor for seconds of virtual time.
+        """
+        actor = self.current
+        self.at(self.now + max(0, seconds), actor)
+        actor.go.clear()
+        self.yielded.set()
+        actor.go.wait()
+        if self.stopped:
+            raise Stopped()
+
+    def _resume(self, actor):
+        self.current = actor
+        self.yielded.clear()
+        if not actor.thread.is_alive() and not actor.finished:
+            actor.thread.start()
+        actor.go.set()
+        self.yielded.wait()
+        self.current = None
+
+    def run(self, until, step=None):
+        """
+        Run the simulation up to the virtual time until, calling step after
+        every actor turn or event.
+        """
+        while self.queue and self.queue[0][0] <= until:
+            when, _, item = heapq.heappop(self.queue)
+            self.now = when
+            if isinstance(item, _Actor):
+                self._resume(item)
+            else:
+                item()
+            if step is not None:
+                step()
+        self.now = until
+
+    def stop(self):
+        self.stopped = True
+        for actor in self.actors:
+            if actor.thread.is_alive():
+                actor.go.set()
+                actor.thread.join()
+
+
+class SimMeter(aws_stub.Meter):
+    """
+    Meter whose API calls take a random latency of virtual time.
+    """
+    def __init__(self, clock, rng, latency=API_LATENCY):
+        aws_stub.Meter.__init__(self)
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency
+
+    def api(self, operation, payload):
+        aws_stub.Meter.api(self, operation, payload)
+        self.clock.sleep(self.rng.uniform(*self.latency))
+
+
+class SimAddressStub(aws_stub.AddressStub):
+
+    def associate(self, *args, **kwargs):
+        try:
+            result = aws_stub.AddressStub.associate(self, *args, **kwargs)
+        except aws_stub.EC2ResponseError:
+            self.connection.fleet.failed_associations += 1
+            raise
+        self.connection.fleet.changed()
+        return result
+
+
+class SimEC2Stub(aws_stub.EC2Stub):
+    address_class = SimAddressStub
+
+
+class SimAutoscalingClientStub(aws_stub.AutoscalingClientStub):
+
+    def _set_lifecycle(self, operation, instance_ids, state):
+        for instance_id in instance_ids:
+            self.fleet.transitions[instance_id] += 1
+        response = aws_stub.AutoscalingClientStub._set_lifecycle(
+            self, operation, instance_ids, state)
+        self.fleet.changed()
+        return response
+
+
+class SimFleet(aws_stub.Fleet):
+    """
+    Fleet of instances launched over time competing for its addresses.
+    """
+    def __init__(self, size, eips, meter):
+        aws_stub.Fleet.__init__(self, size, meter, lbs=0, eips=eips)
+        for instance in self.instances:
+            instance['state'] = 'pending'
+            instance['lifecycle_state'] = 'Pending'
+        self.transitions = dict((i['id'], 0) for i in self.instances)
+        self.failed_associations = 0
+        # Bumped on every change to associations or lifecycle states
+        self.version = 0
+
+    def changed(self):
+        self.version += 1
+
+    def connections(self):
+        connections, clients = aws_stub.Fleet.connections(self)
+        connections[('ec2', aws_stub.REGION)] = SimEC2Stub(self)
+        clients[('autoscaling', aws_stub.REGION)] = \
+            SimAutoscalingClientStub(self)
+        return connections, clients
+
+    def launch(self, instance):
+        instance['state'] = 'running'
+        instance['lifecycle_state'] = 'InService'
+        self.changed()
+
+    def terminate(self, instance):
+        # Terminating an instance disassociates its addresses
+        instance['state'] = 'terminated'
+        instance['lifecycle_state'] = 'Terminating'
+        for address in self.addresses:
+            if address['instance_id'] == instance['id']:
+                address.update({'instance_id': None, 'association_id': None,
+                                'network_interface_id': None,
+                                'private_ip_address': None})
+        self.changed()
+
+    def holders(self):
+        return set(a['instance_id'] for a in self.addresses
+                   if a['instance_id'])
+
+    def is_settled(self, standby):
+        """
+        Whether every address that can be held is held by a distinct running
+        instance and, in standby mode, the running instances without one are
+        all in Standby and those with one InService.
+        """
+        running = [i for i in self.instances if i['state'] == 'running']
+        holders = self.holders()
+        held = [i for i in running if i['id'] in holders]
+        if len(held) < min(len(self.addresses), len(running)):
+            return False
+        if standby:
+            return all((i['id'] in holders) ==
+                       (i['lifecycle_state'] == 'InService')
+                       for i in running)
+        return True
+
+
+class _Metadata(object):
+    """
+    Stands in for aws_metadata in autoeips.py, answering instance metadata
+    requests for the simulated instance that is running.
+    """
+    def __init__(self, simulation, aws_metadata):
+        self.simulation = simulation
+        self.module = aws_metadata
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def get_instance_metadata(self):
+        return self
+
+    def static(self):
+        instance = self.simulation.clock.current.context
+        return {
+            'instance-id': instance['id'],
+            'region': aws_stub.REGION,
+            'vpc-id': aws_stub.VPC_ID,
+            'availability-zone': instance['placement'],
+        }
+
+    def get(self, key, max_age=None):
+        instance = self.simulation.clock.current.context
+        self.simulation.fleet.meter.imds(0)
+        self.simulation.clock.sleep(IMDS_LATENCY)
+        if key == 'public-ipv4':
+            return self.simulation.fleet.public_ip(instance['id'])
+        return self.static().get(key)
+
+
+class _Inventory(object):
+    """
+    Stands in for aws_inventory in autoeips.py, giving each simulated
+    instance its own snapshot as each host has.
+    """
+    def __init__(self, simulation, aws_inventory):
+        self.simulation = simulation
+        self.module = aws_inventory
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def _path(self):
+        instance = self.simulation.clock.current.context
+        return os.path.join(self.simulation.state_dir, instance['id'],
+                            'inventory.json')
+
+    def get_snapshot(self, region, vpc_id, ttl=None, path=None,
+                     sections=None):
+        return self.module.get_snapshot(
+            region, vpc_id, ttl=ttl or self.module.SNAPSHOT_TTL,
+            path=self._path(), sections=sections)
+
+    def read_snapshot(self, region, vpc_id, sections, ttl=None, path=None):
+        return self.module.read_snapshot(
+            region, vpc_id, sections, ttl=ttl or self.module.SNAPSHOT_TTL,
+            path=self._path())
+
+
+def _list_order(auto_eip, eips):
+    return list(eips)
+
+
+def _shuffled(rng, auto_eip, eips):
+    eips = list(eips)
+    rng.shuffle(eips)
+    return eips
+
+
+class Simulation(object):
+    """
+    One run of a fleet of simulated instances.
+
+    Args:
+        instances(int): Instances launched by the scale out.
+        eips(int): Addresses in the autoeips list.
+        strategy(str): 'rendezvous' to rank addresses as autoeips.py does,
+            'list-order' to try them in list order or 'random'.
+        mode(str): 'cron' to run every interval seconds on the minute as
+            separate processes, 'daemon' to run every interval seconds,
+            with jitter, in one process.
+        interval(float): Seconds between runs.
+        jitter(float): Maximum seconds added to or subtracted from the
+            daemon interval.
+        launch_window(float): Instances launch at random over this many
+            seconds.
+        duration(float): Virtual seconds simulated.
+        standby(bool): Run autoeips.py with --enable-standby-mode.
+        failover(bool): Run autoeips.py with --enable-failover-mode.
+        terminate(int): Address holders terminated at terminate_at.
+        terminate_at(float): Virtual time of the terminations.
+        seed(int): Seed of the launch times, jitter, latencies and random
+            order.
+    """
+    def __init__(self, autoeips, instances=50, eips=20, strategy='rendezvous',
+                 mode='cron', interval=CRON_INTERVAL, jitter=0,
+                 launch_window=60, duration=900, standby=True, failover=False,
+                 terminate=0, terminate_at=None, seed=1):
+        self.autoeips = autoeips
+        self.strategy = strategy
+        self.mode = mode
+        self.interval = interval
+        self.jitter = jitter
+        self.launch_window = launch_window
+        self.duration = duration
+        self.standby = standby
+        self.failover = failover
+        self.terminate = terminate
+        self.terminate_at = terminate_at
+        self.seed = seed
+        self.rng = random.Random(seed)
+        # Separate from the launch times and jitter, so that every strategy
+        # is measured against the same scale out
+        self.order_rng = random.Random(seed + 2)
+        self.clock = Clock()
+        self.fleet = SimFleet(instances, eips,
+                              SimMeter(self.clock, random.Random(seed + 1)))
+        self.state_dir = None
+        self.runs = 0
+        self.errors = 0
+        # Virtual time settling is measured from, the start of the scale out
+        # or the terminations
+        self.disrupted = 0.0
+        self.settled_since = None
+        self.settle_calls = None
+        self._version = None
+
+    def _rank(self):
+        if self.strategy == 'list-order':
+            return _list_order
+        if self.strategy == 'random':
+            return functools.partial(_shuffled, self.order_rng)
+        return None
+
+    def new_auto_eip(self, instance):
+        """
+        A fresh AutoEIP for instance, as a new autoeips.py process has.
+        """
+        state_dir = os.path.join(self.state_dir, instance['id'])
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        auto_eip = self.autoeips.AutoEIP(
+            filter_addresses=[a['public_ip'] for a in self.fleet.addresses],
+            enable_standby_mode=self.standby,
+            enable_failover_mode=self.failover,
+            state_file=os.path.join(state_dir, 'state.json'))
+        # Abandon failed runs rather than exiting the simulation
+        auto_eip.daemon = True
+        rank = self._rank()
+        if rank is not None:
+            auto_eip.rank_eips = functools.partial(rank, auto_eip)
+        return auto_eip
+
+    def _next_run(self):
+        if self.mode == 'cron':
+            return (self.interval - self.clock.now % self.interval +
+                    self.rng.uniform(0, CRON_STARTUP))
+        return max(1, self.interval + self.rng.uniform(-self.jitter,
+                                                       self.jitter))
+
+    def _instance(self, instance):
+        self.fleet.launch(instance)
+        auto_eip = None
+        if self.mode == 'cron':
+            self.clock.sleep(self._next_run())
+        while instance['state'] == 'running':
+            if auto_eip is None or self.mode == 'cron':
+                auto_eip = self.new_auto_eip(instance)
+            self.runs += 1
+            try:
+                auto_eip.update_association()
+            except self.autoeips.RunAborted:
+                self.errors += 1
+            except Exception as e:
+                self.errors += 1
+                log.exception("Error in {}: {}".format(instance['id'], e))
+            self.clock.sleep(self._next_run())
+
+    def _terminate(self):
+        holders = sorted(self.fleet.holders())[:self.terminate]
+        for instance_id in holders:
+            self.fleet.terminate(self.fleet.by_id[instance_id])
+        self.disrupted = self.clock.now
+
+    def _step(self):
+        if self.fleet.version == self._version:
+            return
+        self._version = self.fleet.version
+        if not self.fleet.is_settled(self.standby):
+            self.settled_since = None
+        elif self.settled_since is None:
+            self.settled_since = self.clock.now
+            self.settle_calls = self.fleet.meter.api_calls
+
+    def run(self):
+        """
+        Run the simulation, returning its measurements.
+        """
+        self.state_dir = tempfile.mkdtemp(prefix='aws-formula-contention-')
+        try:
+            for instance in self.fleet.instances:
+                self.clock.spawn(self.rng.uniform(0, self.launch_window),
+                                 functools.partial(self._instance, instance),
+                                 instance)
+            if self.terminate:
+                self.clock.at(self.terminate_at, self._terminate)
+            self.clock.run(self.duration, self._step)
+        finally:
+            self.clock.stop()
+            shutil.rmtree(self.state_dir)
+
+        operations = self.fleet.meter.operations
+        settled = self.settled_since is not None
+        return {
+            'seed': self.seed,
+            'strategy': self.strategy,
+            'mode': self.mode,
+            'interval': self.interval,
+            'settled_s': (round(self.settled_since - self.disrupted, 1)
+                          if settled else None),
+            'runs': self.runs,
+            'errors': self.errors,
+            'api_calls': self.fleet.meter.api_calls,
+            'settle_calls': self.settle_calls if settled else None,
+            'failed_assoc': self.fleet.failed_associations,
+            'enter_standby': operations.get('EnterStandby', 0),
+            'exit_standby': operations.get('ExitStandby', 0),
+            # Instances that went into Standby and back out again
+            'flapped': sum(1 for count in self.fleet.transitions.values()
+                           if count > 1),
+            'operations': dict(operations),
+        }
+
+
+def mean(results):
+    """
+    Average the results of the same combination run with different seeds.
+    Settling is only averaged when every run settled.
+    """
+    summary = dict(results[0])
+    for name in MEAN_COLUMNS:
+        values = [result[name] for result in results]
+        summary[name] = (None if None in values else
+                         round(float(sum(values)) / len(values), 1))
+    summary['errors'] = sum(result['errors'] for result in results)
+    summary['seeds'] = [result['seed'] for result in results]
+    summary['samples'] = results
+    return summary
+
+
+def load_autoeips(current):
+    """
+    Import autoeips.py with the shared modules it uses pointed at the
+    simulation in current.
+    """
+    aws_stub.add_repo_paths(ROOT)
+    import aws_inventory
+    import aws_metadata
+    autoeips = load_source('autoeips', os.path.join(ROOT, 'aws', 'files',
+                                                    'autoeips.py'))
+    autoeips.aws_metadata = _Metadata(current, aws_metadata)
+    autoeips.aws_inventory = _Inventory(current, aws_inventory)
+    return autoeips
+
+
+class _Current(object):
+    """
+    The simulation running, read by the stand-ins for the shared modules.
+    """
+    simulation = None
+
+    def __getattr__(self, name):
+        return getattr(self.simulation, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--instances', type=int, default=50,
+                        help='Instances launched by the scale out')
+    parser.add_argument('--eips', type=int, default=20,
+                        help='Addresses in the autoeips list')
+    parser.add_argument('--strategies', nargs='+', default=list(STRATEGIES),
+                        choices=STRATEGIES,
+                        help='Orders in which instances try the addresses')
+    parser.add_argument('--modes', nargs='+', default=list(MODES),
+                        choices=MODES, help='cron job or daemon')
+    parser.add_argument('--intervals', type=float, nargs='+',
+                        help='Seconds between runs, by default 60 for cron '
+                             'and 15 for the daemon')
+    parser.add_argument('--jitter', type=float, default=5,
+                        help='Daemon interval jitter in seconds')
+    parser.add_argument('--launch-window', type=float, default=60,
+                        help='Seconds over which the instances launch')
+    parser.add_argument('--duration', type=float, default=900,
+                        help='Virtual seconds to simulate')
+    parser.add_argument('--no-standby', dest='standby', action='store_false',
+                        help='Run without --enable-standby-mode')
+    parser.add_argument('--failover', action='store_true',
+                        help='Run with --enable-failover-mode')
+    parser.add_argument('--terminate', type=int, default=0,
+                        help='Address holders to terminate once settled')
+    parser.add_argument('--terminate-at', type=float, default=300,
+                        help='Virtual time of the terminations')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='First seed')
+    parser.add_argument('--seeds', type=int, default=5,
+                        help='Seeds, from --seed on, each result is the mean '
+                             'of')
+    parser.add_argument('--json', dest='json_file',
+                        help='Also write the results to this file')
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='aws-formula-contention-')
+    os.environ['AWS_FORMULA_CACHE_DIR'] = cache_dir
+    current = _Current()
+    autoeips = load_autoeips(current)
+    import aws_clients
+    import aws_inventory
+    # autoeips.py logs every attempt, keep it from drowning the results
+    logging.basicConfig(level=logging.CRITICAL)
+    logging.disable(logging.CRITICAL)
+
+    print(' '.join(fmt.format(name) for name, fmt in COLUMNS))
+    results = []
+    try:
+        for strategy in args.strategies:
+            for mode in args.modes:
+                default = CRON_INTERVAL if mode == 'cron' else \
+                    autoeips.DAEMON_INTERVAL
+                for interval in args.intervals or [default]:
+                    samples = []
+                    for seed in range(args.seed, args.seed + args.seeds):
+                        simulation = Simulation(
+                            autoeips, instances=args.instances,
+                            eips=args.eips, strategy=strategy, mode=mode,
+                            interval=interval, jitter=args.jitter,
+                            launch_window=args.launch_window,
+                            duration=args.duration, standby=args.standby,
+                            failover=args.failover,
+                            terminate=args.terminate,
+                            terminate_at=args.terminate_at, seed=seed)
+                        current.simulation = simulation
+                        # Time in autoeips.py and the snapshot ages is
+                        # virtual
+                        autoeips.time = aws_inventory.time = simulation.clock
+                        simulation.fleet.install(aws_clients)
+                        samples.append(simulation.run())
+                    result = mean(samples)
+                    results.append(result)
+                    print(' '.join(
+                        fmt.format('never' if result[name] is None
+                                   else result[name])
+                        for name, fmt in COLUMNS))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(cache_dir)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Benchmark the AWS code paths of the formula against a local stand-in for
+AWS, over a range of fleet sizes.
+
+Each benchmark runs in its own process with its own cache directory, first
+cold (empty caches, as on a fresh instance) and then warm (the caches left
+by the cold run, as on the next grains refresh or autoeips run). For every
+run the wall time, the number of AWS API and metadata calls, the bytes they
+returned and the peak memory are reported.
+
+.. code-block:: bash
+
+    python benchmarks/run.py
+    python benchmarks/run.py --sizes 10 1000 --targets ec2_neighbours autoeips
+    python benchmarks/run.py --json results.json
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import aws_stub
+
+SIZES = (10, 100, 1000, 10000)
+PHASES = ('cold', 'warm')
+FLEET_STATE_FILE = 'bench-fleet.json'
+COLUMNS = (
+    ('target', '{:<15}'),
+    ('size', '{:>6}'),
+    ('phase', '{:<5}'),
+    ('wall_s', '{:>8.3f}'),
+    ('api_calls', '{:>9}'),
+    ('api_bytes', '{:>11}'),
+    ('imds_calls', '{:>10}'),
+    ('imds_bytes', '{:>10}'),
+    ('peak_rss_kb', '{:>11}'),
+)
+
+
+def load_source(name, path):
+    """
+    Import a salt module, or autoeips.py, from its file. Like salt's loader,
+    the module's directory is on sys.path while it is imported.
+    """
+    directory = os.path.dirname(path)
+    sys.path.append(directory)
+    try:
+        try:
+            import imp
+            return imp.load_source(name, path)
+        except ImportError:
+            from importlib.machinery import SourceFileLoader
+            return SourceFileLoader(name, path).load_module()
+    finally:
+        sys.path.remove(directory)
+
+
+def _grain(module, function):
+    def prepare(cache_dir):
+        grain = load_source(module, os.path.join(ROOT, '_grains',
+                                                 module + '.py'))
+        # As salt's loader does, which registers the grain's collection
+        grain.__virtual__()
+        return getattr(grain, function)
+    return prepare
+
+
+def _asg(cache_dir):
+    asg = load_source('asg', os.path.join(ROOT, '_modules', 'asg.py'))
+    return asg.is_first_of_asg_group
+
+
+def _autoeips(cache_dir):
+    autoeips = load_source('autoeips', os.path.join(ROOT, 'aws', 'files',
+                                                    'autoeips.py'))
+
+    def update_association():
+        eips = [a['public_ip'] for a in _fleet.addresses]
+        auto_eip = autoeips.AutoEIP(
+            filter_addresses=eips,
+            log_level='WARNING',
+            log_format='text',
+            log_file=os.devnull,
+            state_file=os.path.join(cache_dir, 'autoeips-state.json'))
+        auto_eip.update_association()
+    return update_association
+
+
+TARGETS = {
+    'ec2_neighbours': _grain('ec2_neighbours', 'set_grain_instances_by_vpc'),
+    'elb_lbs': _grain('elb_lbs', 'get_elb_lbs'),
+    'elasticache': _grain('elasticache', 'get_elasticache_endpoints'),
+    'asg': _asg,
+    'autoeips': _autoeips,
+}
+
+# The fleet of the running benchmark, for targets that need it
+_fleet = None
+
+
+def run_one(target, size, phase, cache_dir):
+    """
+    Run one benchmark in this process, returning its measurements.
+    """
+    global _fleet
+    os.environ['AWS_FORMULA_CACHE_DIR'] = cache_dir
+    aws_stub.add_repo_paths(ROOT)
+    import aws_clients
+    import aws_metadata
+
+    meter = aws_stub.Meter()
+    _fleet = aws_stub.Fleet(size, meter)
+    state_file = os.path.join(cache_dir, FLEET_STATE_FILE)
+    _fleet.load(state_file)
+    server = aws_stub.MetadataServer(_fleet).start()
+    aws_metadata.METADATA_URL = server.url
+    # The stub fleet stands in for EC2, whatever this host is
+    aws_metadata.is_ec2 = lambda ttl=None: True
+    _fleet.install(aws_clients)
+    func = TARGETS[target](cache_dir)
+    # Keep the code under test from logging over the results
+    logging.disable(logging.INFO)
+
+    try:
+        import tracemalloc
+        tracemalloc.start()
+    except ImportError:
+        tracemalloc = None
+    start = time.time()
+    try:
+        func()
+    finally:
+        wall = time.time() - start
+        server.stop()
+    result = {
+        'target': target,
+        'size': size,
+        'phase': phase,
+        'wall_s': wall,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if tracemalloc is not None:
+        result['peak_alloc_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+    result.update(meter.report())
+    _fleet.save(state_file)
+    return result
+
+
+def run(target, size, phase, cache_dir):
+    """
+    Run one benchmark in a child process.
+    """
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '--one', target, str(size), phase,
+                                      cache_dir])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Fleet sizes, in instances and load balancers')
+    parser.add_argument('--targets', nargs='+', default=sorted(TARGETS),
+                        choices=sorted(TARGETS), help='Code paths to run')
+    parser.add_argument('--json', dest='json_file',
+                        help='Also write the results to this file')
+    parser.add_argument('--one', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        target, size, phase, cache_dir = args.one
+        print(json.dumps(run_one(target, int(size), phase, cache_dir)))
+        return
+
+    mismatches = aws_stub.check_signatures()
+    if mismatches:
+        parser.error('the stubs no longer match boto:\n' +
+                     '\n'.join(mismatches))
+
+    print(' '.join(fmt.replace('.3f', '').format(name)
+                   for name, fmt in COLUMNS))
+    results = []
+    for target in args.targets:
+        for size in args.sizes:
+            cache_dir = tempfile.mkdtemp(prefix='aws-formula-bench-')
+            try:
+                for phase in PHASES:
+                    result = run(target, size, phase, cache_dir)
+                    results.append(result)
+                    print(' '.join(fmt.format(result[name])
+                                   for name, fmt in COLUMNS))
+                    sys.stdout.flush()
+            finally:
+                shutil.rmtree(cache_dir)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
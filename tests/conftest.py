@@ -0,0 +1,77 @@
+"""
+Shared setup for the tests.
+
+The helpers in _utils are put on sys.path, as salt does once they are
+synced to a minion, and every cache is written to a temporary directory.
+The benchmarks' stand-in for AWS is importable as aws_stub.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), os.pardir))
+
+CACHE_DIR = os.environ['AWS_FORMULA_CACHE_DIR'] = tempfile.mkdtemp(
+    prefix='aws-formula-tests-')
+sys.path.insert(0, os.path.join(ROOT, '_utils'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+
+@pytest.fixture
+def load_module():
+    """
+    Returns a function importing a file of the formula, eg.
+    load_module('_modules/aws.py'). Like salt's loader, the module's
+    directory is on sys.path while it is imported.
+    """
+    def load(relative_path):
+        path = os.path.join(ROOT, relative_path)
+        name = 'formula_' + os.path.splitext(os.path.basename(path))[0]
+        directory = os.path.dirname(path)
+        sys.path.append(directory)
+        try:
+            try:
+                import imp
+                return imp.load_source(name, path)
+            except ImportError:
+                from importlib.machinery import SourceFileLoader
+                return SourceFileLoader(name, path).load_module()
+        finally:
+            sys.path.remove(directory)
+    return load
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    """
+    A stub fleet of 10 instances standing in for AWS and the instance
+    metadata service, with empty caches. Its meter counts the calls made.
+    """
+    pytest.importorskip('boto')
+    import aws_clients
+    import aws_collector
+    import aws_metadata
+    import aws_stub
+
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    fleet = aws_stub.Fleet(10)
+    server = aws_stub.MetadataServer(fleet).start()
+    monkeypatch.setattr(aws_metadata, 'METADATA_URL', server.url)
+    monkeypatch.setattr(aws_metadata, '_instance_metadata', None)
+    monkeypatch.setattr(aws_metadata, 'is_ec2', lambda ttl=None: True)
+    monkeypatch.setattr(aws_clients, '_connect', aws_clients._connect)
+    monkeypatch.setattr(aws_collector, '_tasks', {})
+    monkeypatch.setattr(aws_collector, '_round', None)
+    fleet.install(aws_clients)
+    yield fleet
+    server.stop()
+    aws_clients.reset()
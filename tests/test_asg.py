@@ -0,0 +1,84 @@
+"""
+Tests for the cached membership and consistent hash ring of the asg module.
+"""
+import pytest
+
+pytest.importorskip('boto')
+
+
+@pytest.fixture
+def asg(load_module):
+    return load_module('_modules/asg.py')
+
+
+KEYS = ['job-{}'.format(n) for n in range(2000)]
+
+
+def test_ring_owner_is_a_stable_member(asg):
+    members = ['i-1', 'i-2', 'i-3']
+    for key in KEYS[:100]:
+        owner = asg._ring_owner(members, key)
+        assert owner in members
+        assert asg._ring_owner(list(reversed(members)), key) == owner
+
+
+def test_ring_owner_spreads_keys(asg):
+    members = ['i-{}'.format(n) for n in range(4)]
+    counts = dict((m, 0) for m in members)
+    for key in KEYS:
+        counts[asg._ring_owner(members, key)] += 1
+    for count in counts.values():
+        assert len(KEYS) / 8 < count < len(KEYS) / 2
+
+
+def test_ring_owner_moves_few_keys_when_a_member_joins(asg):
+    members = ['i-{}'.format(n) for n in range(4)]
+    before = dict((k, asg._ring_owner(members, k)) for k in KEYS)
+    after = dict((k, asg._ring_owner(members + ['i-new'], k)) for k in KEYS)
+    moved = [k for k in KEYS if before[k] != after[k]]
+    # Only keys taken over by the new member move, about 1/5 of them
+    assert all(after[k] == 'i-new' for k in moved)
+    assert len(moved) < len(KEYS) / 3
+
+
+def _operations(fleet):
+    operations = fleet.meter.report()['operations']
+    fleet.meter.reset()
+    return operations
+
+
+def test_membership_is_cached_within_the_ttl(asg, fleet):
+    assert asg.is_first_of_asg_group() is True
+    assert _operations(fleet) == {'DescribeAutoScalingGroups': 1,
+                                  'DescribeScalingActivities': 1}
+
+    assert asg.is_first_of_asg_group() is True
+    assert asg.member_count() == 10
+    assert _operations(fleet) == {}
+
+
+def test_unchanged_activity_keeps_the_membership(asg, fleet, monkeypatch):
+    monkeypatch.setattr(asg, '__opts__', {'asg_membership_ttl': 0},
+                        raising=False)
+    asg.member_count()
+    fleet.meter.reset()
+
+    assert asg.member_count() == 10
+    assert _operations(fleet) == {'DescribeScalingActivities': 1}
+
+
+def test_new_activity_describes_the_groups_again(asg, fleet, monkeypatch):
+    monkeypatch.setattr(asg, '__opts__', {'asg_membership_ttl': 0},
+                        raising=False)
+    assert asg.is_first_of_asg_group() is True
+
+    fleet.local['lifecycle_state'] = 'Standby'
+    monkeypatch.setattr(asg, '_scaling_activity_signature',
+                        lambda autoscale, group_name: 'activity-2')
+    fleet.meter.reset()
+
+    # A standby instance is never the first
+    assert asg.is_first_of_asg_group() is False
+    assert asg.member_count() == 9
+    assert asg.member_rank() is None
+    assert 'DescribeAutoScalingGroups' in _operations(fleet)
@@ -0,0 +1,184 @@
+"""
+Tests for the EIP ranking and association of autoeips.py.
+"""
+import logging
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('boto')
+
+from boto.exception import EC2ResponseError  # noqa: E402
+
+
+class Address(object):
+
+    def __init__(self, allocation_id, instance_id=None, claimed=False,
+                 errors=None):
+        self.allocation_id = allocation_id
+        self.public_ip = allocation_id
+        self.instance_id = instance_id
+        self.claimed = claimed
+        # Error codes by private ip
+        self.errors = errors or {}
+        self.connection = None
+        self.threads = set()
+
+    def associate(self, private_ip_address=None, **kwargs):
+        self.threads.add((self.connection, threading.current_thread()))
+        # Long enough for the other workers to start meanwhile
+        time.sleep(0.05)
+        if self.claimed:
+            raise _error('Resource.AlreadyAssociated')
+        if private_ip_address in self.errors:
+            raise _error(self.errors[private_ip_address])
+        return True
+
+
+def _error(code):
+    error = EC2ResponseError(400, 'Bad Request')
+    error.error_code = code
+    return error
+
+
+@pytest.fixture
+def autoeips(load_module):
+    return load_module('aws/files/autoeips.py')
+
+
+def _auto_eip(autoeips, instance_id='i-1', **attrs):
+    auto_eip = autoeips.AutoEIP.__new__(autoeips.AutoEIP)
+    auto_eip.instance_id = instance_id
+    auto_eip.logger = logging.getLogger('autoeips')
+    auto_eip.__dict__.update(attrs)
+    return auto_eip
+
+
+def _ranked(autoeips, instance_id, eips):
+    auto_eip = _auto_eip(autoeips, instance_id)
+    return [eip.allocation_id for eip in auto_eip.rank_eips(eips)]
+
+
+def test_rendezvous_weight_is_stable(autoeips):
+    assert (autoeips.rendezvous_weight('i-1', 'eipalloc-1') ==
+            autoeips.rendezvous_weight('i-1', 'eipalloc-1'))
+    assert (autoeips.rendezvous_weight('i-1', 'eipalloc-1') !=
+            autoeips.rendezvous_weight('i-2', 'eipalloc-1'))
+
+
+def test_rank_eips_orders_by_weight(autoeips):
+    eips = [Address('eipalloc-{}'.format(n)) for n in range(8)]
+    ranked = _ranked(autoeips, 'i-1', eips)
+    weights = [autoeips.rendezvous_weight('i-1', a) for a in ranked]
+    assert sorted(ranked) == sorted(e.allocation_id for e in eips)
+    assert weights == sorted(weights, reverse=True)
+    # The order does not depend on the order the addresses are listed in
+    assert _ranked(autoeips, 'i-1', list(reversed(eips))) == ranked
+
+
+def test_rank_eips_spreads_first_choices(autoeips):
+    eips = [Address('eipalloc-{}'.format(n)) for n in range(8)]
+    first = set(_ranked(autoeips, 'i-{}'.format(n), eips)[0]
+                for n in range(32))
+    assert len(first) > 1
+
+
+def test_rank_eips_keeps_order_when_an_eip_goes(autoeips):
+    eips = [Address('eipalloc-{}'.format(n)) for n in range(8)]
+    ranked = _ranked(autoeips, 'i-1', eips)
+    remaining = [e for e in eips if e.allocation_id != ranked[0]]
+    assert _ranked(autoeips, 'i-1', remaining) == ranked[1:]
+
+
+def test_associate_eips_uses_a_connection_per_worker(autoeips, monkeypatch):
+    monkeypatch.setattr(autoeips.aws_clients, 'new_connection',
+                        lambda service, region: object())
+    auto_eip = _auto_eip(autoeips, ec2_connection=object(), max_parallel=3,
+                         region='eu-west-1')
+    eips = [Address('eipalloc-{}'.format(n), claimed=n % 2)
+            for n in range(8)]
+    targets = [{'interface_id': 'eni-1', 'private_ip': '10.0.0.{}'.format(n)}
+               for n in range(4)]
+
+    associated = auto_eip.associate_eips(eips, targets)
+
+    assert len(associated) == 4
+    assert all(not eip.claimed for eip in associated)
+    used = set()
+    for eip in eips:
+        used.update(eip.threads)
+    # Every worker has a connection of its own, the first the shared one
+    assert len(set(t for _, t in used)) == 3
+    assert len(set(c for c, _ in used)) == len(used) == 3
+    assert auto_eip.ec2_connection in set(c for c, _ in used)
+
+
+def test_failed_target_leaves_its_eip_to_the_others(autoeips):
+    auto_eip = _auto_eip(autoeips, ec2_connection=object(), max_parallel=1)
+    errors = {'10.0.0.0': 'RequestLimitExceeded',
+              '10.0.0.1': 'InvalidNetworkInterfaceID.NotFound'}
+    eips = [Address('eipalloc-{}'.format(n), claimed=n == 0, errors=errors)
+            for n in range(3)]
+    targets = [{'interface_id': 'eni-1', 'private_ip': '10.0.0.{}'.format(n)}
+               for n in range(3)]
+
+    associated = auto_eip.associate_eips(eips, targets)
+
+    # Only the claimed address is given up, the failed targets leave theirs
+    # to the last one
+    assert [eip.allocation_id for eip in associated] == [
+        eip.allocation_id for eip in auto_eip.rank_eips(eips)
+        if not eip.claimed][:1]
+
+
+def test_failed_failover_enters_standby_once(autoeips, monkeypatch, tmpdir):
+    standby = []
+    auto_eip = _auto_eip(
+        autoeips,
+        listed_eips=[Address('eipalloc-1', 'i-2', claimed=True),
+                     Address('eipalloc-2', 'i-3', claimed=True)],
+        state_file=str(tmpdir.join('state.json')),
+        failover_timeout=0,
+        enable_failover_mode=True,
+        update_standby_mode=standby.append,
+        get_unhealthy_instances=lambda instance_ids: instance_ids,
+        is_preferred_claimant=lambda eip, holders: True)
+
+    assert auto_eip.failover_eip() is False
+    assert standby == [True]
+
+
+@pytest.fixture
+def health_check(autoeips, fleet):
+    import aws_clients
+    import aws_stub
+    return _auto_eip(
+        autoeips,
+        region=aws_stub.REGION,
+        instance_metadata={'vpc-id': aws_stub.VPC_ID},
+        ec2_connection=aws_clients.get_connection('ec2', aws_stub.REGION),
+        asg_connection=aws_clients.get_connection('ec2.autoscale',
+                                                  aws_stub.REGION))
+
+
+def test_health_check_describes_only_the_holders(health_check, fleet):
+    holders = [i['id'] for i in fleet.instances[:3]]
+    fleet.instances[1]['lifecycle_state'] = 'Terminating:Wait'
+    fleet.instances[2]['state'] = 'stopped'
+
+    assert health_check.get_unhealthy_instances(holders) == set(holders[1:])
+    assert fleet.meter.report()['operations'] == {
+        'DescribeAutoScalingInstances': 1, 'DescribeInstanceStatus': 1}
+
+
+def test_health_check_uses_a_fresh_snapshot(health_check, fleet, autoeips):
+    import aws_inventory
+    holders = [i['id'] for i in fleet.instances[:2]]
+    fleet.instances[1]['lifecycle_state'] = 'Terminating:Wait'
+    aws_inventory.get_snapshot(health_check.region,
+                               health_check.instance_metadata['vpc-id'])
+    fleet.meter.reset()
+
+    assert health_check.get_unhealthy_instances(holders) == set(holders[1:])
+    assert fleet.meter.report()['api_calls'] == 0
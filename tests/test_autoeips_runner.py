@@ -0,0 +1,110 @@
+"""
+Tests for the planning of the autoeips runner.
+"""
+import pytest
+
+import aws_clients
+import aws_stats
+
+
+@pytest.fixture
+def runner(load_module):
+    return load_module('_runners/autoeips.py')
+
+
+def _address(public_ip, instance_id=None):
+    address = {'PublicIp': public_ip,
+               'AllocationId': 'eipalloc-' + public_ip.replace('.', '')}
+    if instance_id:
+        address['InstanceId'] = instance_id
+    return address
+
+
+def _member(instance_id, lifecycle_state='InService', health='Healthy'):
+    return {'InstanceId': instance_id, 'LifecycleState': lifecycle_state,
+            'HealthStatus': health}
+
+
+def test_plan_keeps_existing_associations(runner):
+    plan = runner._plan([_address('1.1.1.1', 'i-2'), _address('1.1.1.2')],
+                        [_member('i-1'), _member('i-2')])
+    assert plan['assignments'] == {'i-1': '1.1.1.2', 'i-2': '1.1.1.1'}
+    assert plan['associate'] == [{'instance_id': 'i-1',
+                                  'public_ip': '1.1.1.2',
+                                  'allocation_id': 'eipalloc-1112',
+                                  'reassociate': False}]
+    assert plan['enter_standby'] == []
+    assert plan['unused_eips'] == []
+
+
+def test_plan_takes_addresses_from_leaving_members(runner):
+    plan = runner._plan([_address('1.1.1.1', 'i-1')],
+                        [_member('i-1', 'Terminating:Wait'), _member('i-2')])
+    assert plan['assignments'] == {'i-2': '1.1.1.1'}
+    assert plan['associate'][0]['reassociate'] is True
+
+
+def test_plan_frees_a_second_address_of_a_member(runner):
+    plan = runner._plan([_address('1.1.1.1', 'i-1'),
+                         _address('1.1.1.2', 'i-1')],
+                        [_member('i-1'), _member('i-2')])
+    assert plan['assignments'] == {'i-1': '1.1.1.1', 'i-2': '1.1.1.2'}
+    assert plan['associate'][0]['reassociate'] is True
+
+
+def test_plan_leaves_addresses_held_outside_the_group(runner):
+    plan = runner._plan([_address('1.1.1.1', 'i-other')], [_member('i-1')])
+    assert plan['assignments'] == {}
+    assert plan['associate'] == []
+    assert plan['unused_eips'] == []
+    assert plan['enter_standby'] == ['i-1']
+
+
+def test_plan_moves_members_in_and_out_of_standby(runner):
+    plan = runner._plan([_address('1.1.1.1')],
+                        [_member('i-1', 'Standby'), _member('i-2'),
+                         _member('i-3', health='Unhealthy')])
+    assert plan['assignments'] == {'i-1': '1.1.1.1'}
+    assert plan['exit_standby'] == ['i-1']
+    assert plan['enter_standby'] == ['i-2']
+
+
+class Client(object):
+    """
+    Stand-in for a boto3 client, recording the calls made through it.
+    """
+    def __init__(self, service, region, calls, responses):
+        self.service = service
+        self.region = region
+        self.calls = calls
+        self.responses = responses
+
+    def __getattr__(self, operation):
+        def call(**kwargs):
+            self.calls.append((self.service, operation,
+                               aws_stats.current_scope()))
+            return self.responses.get(operation, {})
+        return call
+
+
+def test_rebalance_uses_the_shared_clients(runner, monkeypatch):
+    calls = []
+    responses = {
+        'describe_addresses': {'Addresses': [_address('1.1.1.1')]},
+        'describe_auto_scaling_groups': {'AutoScalingGroups': [
+            {'Instances': [_member('i-1'), _member('i-2')]}]},
+    }
+    monkeypatch.setattr(aws_clients, 'get_client',
+                        lambda service, region: Client(service, region,
+                                                       calls, responses))
+
+    changes = runner.rebalance('asg', ['1.1.1.1'], region='eu-west-1')
+
+    assert changes['result'] is True
+    # Rate limited and counted like every other AWS call
+    assert calls == [
+        ('ec2', 'describe_addresses', runner.STATS_SCOPE),
+        ('autoscaling', 'describe_auto_scaling_groups', runner.STATS_SCOPE),
+        ('ec2', 'associate_address', runner.STATS_SCOPE),
+        ('autoscaling', 'enter_standby', runner.STATS_SCOPE),
+    ]
@@ -0,0 +1,99 @@
+"""
+Tests for the concurrent collection of the AWS grains.
+"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('boto')
+
+import aws_collector  # noqa: E402
+
+
+@pytest.fixture
+def collector(monkeypatch, tmpdir):
+    monkeypatch.setattr(aws_collector, '_tasks', {})
+    monkeypatch.setattr(aws_collector, '_round', None)
+    monkeypatch.setattr(aws_collector, 'CACHE_DIR', str(tmpdir))
+    return aws_collector
+
+
+class Grain(object):
+    """
+    A collection function counting its calls, taking delay seconds.
+    """
+    def __init__(self, value, delay=0, error=False):
+        self.value = value
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise ValueError('describe failed')
+        return dict(self.value)
+
+
+def test_grains_share_a_round_slower_than_round_ttl(collector, monkeypatch):
+    monkeypatch.setattr(collector, 'ROUND_TTL', 0.1)
+    slow = Grain({'slow': 1}, delay=0.3)
+    fast = Grain({'fast': 1})
+    collector.register('slow', slow)
+    collector.register('fast', fast)
+    opts = {'aws_grains_deadline': 5}
+
+    assert collector.get('slow', opts)['slow'] == 1
+    assert collector.get('fast', opts)['fast'] == 1
+    assert (slow.calls, fast.calls) == (1, 1)
+
+
+def test_round_restarts_after_its_deadline(collector, monkeypatch):
+    monkeypatch.setattr(collector, 'ROUND_TTL', 0)
+    grain = Grain({'value': 1})
+    collector.register('grain', grain)
+    opts = {'aws_grains_deadline': 0.1}
+
+    collector.get('grain', opts)
+    time.sleep(0.2)
+    collector.get('grain', opts)
+    assert grain.calls == 2
+
+
+def test_grains_carry_a_content_hash(collector):
+    collector.register('grain', Grain({'value': 1}))
+    first = collector.get('grain')
+    second = collector.get('grain', refresh=True)
+    assert first['grain_hash'] == second['grain_hash']
+
+
+def test_late_grain_falls_back_to_last_good_value(collector):
+    grain = Grain({'value': 1})
+    collector.register('grain', grain)
+    good = collector.get('grain')
+
+    grain.value = {'value': 2}
+    grain.delay = 0.5
+    assert collector.get('grain', {'aws_grains_deadline': 0.1},
+                         refresh=True) == good
+
+
+def test_failed_grain_falls_back_to_last_good_value(collector):
+    grain = Grain({'value': 1})
+    collector.register('grain', grain)
+    good = collector.get('grain')
+
+    grain.error = True
+    assert collector.get('grain', refresh=True) == good
+
+
+def test_failed_grain_without_last_good_value_is_an_error(collector):
+    collector.register('grain', Grain({}, error=True))
+    assert collector.get('grain') == {'custom_grain_error': True}
+    collector.register('late', Grain({'value': 1}, delay=0.5))
+    assert collector.get('late', {'aws_grains_deadline': 0.1},
+                         refresh=True) == {'custom_grain_error': True}
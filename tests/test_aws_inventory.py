@@ -0,0 +1,163 @@
+"""
+Tests for the section TTLs and locking of the shared inventory snapshot.
+"""
+import threading
+import time
+
+import pytest
+
+import aws_inventory
+
+
+class Describer(object):
+    """
+    Stand-in for the describe function of a section, counting its calls.
+    """
+    def __init__(self, name, delay=0, error=None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, region, vpc_id):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise Exception(self.error)
+        return {'vpc_id': vpc_id, 'call': self.calls}
+
+
+@pytest.fixture
+def describers(monkeypatch):
+    describers = dict((name, Describer(name))
+                      for name in ('instances', 'impaired', 'groups', 'elb'))
+    monkeypatch.setattr(aws_inventory, 'SECTIONS', [
+        (name, describers[name])
+        for name in ('instances', 'impaired', 'groups', 'elb')])
+    return describers
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('inventory.json'))
+
+
+def _calls(describers):
+    return dict((name, d.calls) for name, d in describers.items())
+
+
+def test_collects_only_the_sections_read(describers, path):
+    snapshot = aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                                          sections=['instances'])
+
+    assert snapshot['instances']['call'] == 1
+    assert 'groups' not in snapshot
+    assert _calls(describers) == {'instances': 1, 'impaired': 0,
+                                  'groups': 0, 'elb': 0}
+
+
+def test_fresh_sections_are_not_collected_again(describers, path):
+    aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                               sections=['instances'])
+    snapshot = aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                                          sections=['instances', 'groups'])
+
+    assert snapshot['instances']['call'] == 1
+    assert snapshot['groups']['call'] == 1
+    assert _calls(describers) == {'instances': 1, 'impaired': 0,
+                                  'groups': 1, 'elb': 0}
+
+
+def test_each_section_has_the_ttl_of_its_reader(describers, path):
+    aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                               sections=['instances', 'groups'])
+    time.sleep(0.2)
+
+    # A reader accepting 60s old groups leaves them alone while the
+    # instances are too old for another
+    aws_inventory.get_snapshot('eu-west-1', 'vpc-1', ttl=60, path=path,
+                               sections=['groups'])
+    snapshot = aws_inventory.get_snapshot('eu-west-1', 'vpc-1', ttl=0.1,
+                                          path=path, sections=['instances'])
+
+    assert snapshot['instances']['call'] == 2
+    assert snapshot['groups']['call'] == 1
+    assert snapshot['serial'] == 2
+
+
+def test_another_vpc_is_collected_from_scratch(describers, path):
+    aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                               sections=['instances', 'groups'])
+    snapshot = aws_inventory.get_snapshot('eu-west-1', 'vpc-2', path=path,
+                                          sections=['instances'])
+
+    assert snapshot['vpc_id'] == 'vpc-2'
+    assert snapshot['instances']['vpc_id'] == 'vpc-2'
+    assert 'groups' not in snapshot
+
+
+def test_concurrent_readers_collect_once(describers, path):
+    describers['instances'].delay = 0.3
+    snapshots = []
+
+    def read():
+        snapshots.append(aws_inventory.get_snapshot(
+            'eu-west-1', 'vpc-1', path=path, sections=['instances']))
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    # The others waited on the lock and found the first one's result
+    assert describers['instances'].calls == 1
+    assert [s['instances']['call'] for s in snapshots] == [1] * 4
+
+
+def test_failed_section_leaves_the_others(describers, path):
+    describers['elb'].error = 'AccessDenied'
+
+    snapshot = aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                                          sections=['instances', 'elb'])
+
+    assert snapshot['instances']['call'] == 1
+    assert snapshot['elb'] is None
+    assert snapshot['errors'] == {'elb': 'AccessDenied'}
+
+
+def test_get_section_raises_for_a_failed_section(describers, path,
+                                                 monkeypatch):
+    get_snapshot = aws_inventory.get_snapshot
+    monkeypatch.setattr(aws_inventory, 'get_snapshot',
+                        lambda *args, **kwargs: get_snapshot(
+                            *args, path=path, **kwargs))
+    describers['groups'].error = 'AccessDenied'
+
+    with pytest.raises(aws_inventory.InventoryError) as e:
+        aws_inventory.get_section('eu-west-1', 'vpc-1', 'groups')
+    assert 'AccessDenied' in str(e.value)
+
+
+def test_read_snapshot_never_collects(describers, path):
+    assert aws_inventory.read_snapshot('eu-west-1', 'vpc-1', ['instances'],
+                                       path=path) is None
+    aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                               sections=['instances'])
+
+    assert aws_inventory.read_snapshot('eu-west-1', 'vpc-1', ['instances'],
+                                       path=path)['instances']['call'] == 1
+    assert aws_inventory.read_snapshot('eu-west-1', 'vpc-1',
+                                       ['instances', 'groups'],
+                                       path=path) is None
+    assert describers['instances'].calls == 1
+
+
+def test_invalidate_makes_the_next_reader_collect(describers, path):
+    aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                               sections=['instances'])
+    aws_inventory.invalidate(path)
+    snapshot = aws_inventory.get_snapshot('eu-west-1', 'vpc-1', path=path,
+                                          sections=['instances'])
+
+    assert snapshot['instances']['call'] == 2
@@ -0,0 +1,64 @@
+"""
+Tests for the detection of hosts outside EC2.
+"""
+import pytest
+
+import aws_metadata
+
+
+@pytest.fixture
+def platform(monkeypatch, tmpdir):
+    """
+    Platform files, boot id and cache in a temporary directory. Returns
+    the list of the metadata service probes made, which find nothing.
+    """
+    tmpdir.join('boot_id').write('boot-1\n')
+    monkeypatch.setattr(aws_metadata, 'BOOT_ID_FILE',
+                        str(tmpdir.join('boot_id')))
+    monkeypatch.setattr(aws_metadata, 'PLATFORM_CACHE_FILE',
+                        str(tmpdir.join('platform.json')))
+    monkeypatch.setattr(aws_metadata, 'PLATFORM_FILES', (
+        (str(tmpdir.join('uuid')), ('ec2',)),
+        (str(tmpdir.join('sys_vendor')), ('Amazon EC2',)),
+    ))
+    probes = []
+
+    def fetch(path, timeout=5, num_retries=2):
+        probes.append((path, timeout, num_retries))
+        raise aws_metadata.MetadataError('timed out')
+
+    monkeypatch.setattr(aws_metadata, 'fetch', fetch)
+    return probes
+
+
+def test_platform_files_answer_without_a_probe(platform, tmpdir):
+    tmpdir.join('sys_vendor').write('QEMU\n')
+    assert aws_metadata.is_ec2() is False
+
+    tmpdir.join('sys_vendor').write('Amazon EC2\n')
+    tmpdir.join('platform.json').remove()
+    assert aws_metadata.is_ec2() is True
+    assert platform == []
+
+
+def test_unreadable_platform_files_probe_once(platform):
+    assert aws_metadata.is_ec2() is False
+    assert aws_metadata.is_ec2() is False
+
+    # A single short probe, without retries
+    assert platform == [('meta-data/instance-id', 0.5, 0)]
+
+
+def test_answer_is_checked_again_after_a_reboot(platform, tmpdir):
+    aws_metadata.is_ec2()
+    tmpdir.join('boot_id').write('boot-2\n')
+    aws_metadata.is_ec2()
+
+    assert len(platform) == 2
+
+
+def test_answer_is_checked_again_after_the_ttl(platform):
+    aws_metadata.is_ec2()
+    aws_metadata.is_ec2(ttl=0)
+
+    assert len(platform) == 2
@@ -0,0 +1,89 @@
+"""
+Tests for the aws execution module.
+"""
+import pytest
+
+salt_config = pytest.importorskip('salt.config')
+
+import aws_collector  # noqa: E402
+import aws_inventory  # noqa: E402
+
+GRAIN = '''
+import aws_collector
+
+
+def __virtual__():
+    aws_collector.register('fake_aws', _collect)
+    return True
+
+
+def _collect():
+    return {'fake_aws': {'instances': 3}}
+'''
+
+
+@pytest.fixture
+def aws(load_module, monkeypatch, tmpdir):
+    """
+    The aws module under a minion config with one registered grain in its
+    extension modules, which nothing has loaded yet.
+    """
+    extmods = tmpdir.mkdir('extmods')
+    extmods.mkdir('grains').join('fake_aws.py').write(GRAIN)
+    opts = salt_config.minion_config(None)
+    opts['extension_modules'] = str(extmods)
+    opts['cachedir'] = str(tmpdir.mkdir('cache'))
+    monkeypatch.setattr(aws_collector, '_tasks', {})
+    monkeypatch.setattr(aws_collector, '_round', None)
+
+    module = load_module('_modules/aws.py')
+    module.calls = []
+    monkeypatch.setattr(aws_inventory, 'invalidate',
+                        lambda: module.calls.append('invalidate'))
+    module.__opts__ = opts
+    module.__grains__ = {}
+    module.__salt__ = {
+        'saltutil.refresh_grains':
+            lambda: module.calls.append('refresh_grains'),
+        'event.send': lambda tag, data: module.calls.append((tag, data)),
+    }
+    return module
+
+
+def test_refresh_if_changed_loads_the_grain_modules(aws):
+    ret = aws.refresh_if_changed()
+
+    assert aws_collector.registered() == ['fake_aws']
+    assert ret['fake_aws']['changed'] is True
+    assert aws.calls == [
+        'invalidate',
+        'refresh_grains',
+        (aws.CHANGED_EVENT_TAG, {
+            'grains': ['fake_aws'],
+            'hashes': {'fake_aws': ret['fake_aws']['hash']},
+        }),
+    ]
+
+
+def test_refresh_if_changed_only_refreshes_changed_grains(aws):
+    current = aws.refresh_if_changed()['fake_aws']['hash']
+    aws.__grains__ = {'fake_aws_hash': current}
+    del aws.calls[:]
+
+    ret = aws.refresh_if_changed(grains=['fake_aws'])
+
+    assert ret == {'fake_aws': {'changed': False, 'hash': current}}
+    assert aws.calls == ['invalidate']
+
+
+def test_call_stats_resets_only_the_scope_sent(aws, monkeypatch):
+    reads = []
+    monkeypatch.setattr(aws.aws_stats, 'read', lambda **kwargs: (
+        reads.append(kwargs) or {'since': 0, 'scopes': {}}))
+    monkeypatch.setattr(aws, '_send_statsd', lambda *args: None)
+    aws.call_stats(scope='asg', statsd='localhost:8125')
+    aws.call_stats(statsd='localhost:8125')
+    aws.call_stats(scope='asg')
+    assert reads == [{'reset': True, 'scopes': ['asg']},
+                     {'reset': True, 'scopes': None},
+                     {'reset': False, 'scopes': ['asg']}]
@@ -0,0 +1,45 @@
+"""
+Tests for the neighbour scopes of aws_neighbours.
+"""
+import aws_neighbours
+
+OWN = {'subnet_id': 'subnet-1', 'availability_zone': 'eu-west-1a',
+       'asg': 'web'}
+
+
+def _instance(**details):
+    instance = dict(OWN, state='running', tags={'Role': 'web'})
+    instance.update(details)
+    return instance
+
+
+def test_vpc_scope_takes_running_instances():
+    in_scope = aws_neighbours.scope_filter(OWN)
+    assert in_scope(_instance(subnet_id='subnet-2', asg=None))
+    assert not in_scope(_instance(state='stopped'))
+
+
+def test_scopes_are_combined():
+    in_scope = aws_neighbours.scope_filter(OWN, scopes=['subnet', 'az'])
+    assert in_scope(_instance())
+    assert not in_scope(_instance(subnet_id='subnet-2'))
+    assert not in_scope(_instance(availability_zone='eu-west-1b'))
+
+
+def test_single_scope_may_be_a_string():
+    in_scope = aws_neighbours.scope_filter(OWN, scopes='asg')
+    assert in_scope(_instance())
+    assert not in_scope(_instance(asg='db'))
+
+
+def test_asg_scope_is_ignored_outside_a_group():
+    in_scope = aws_neighbours.scope_filter(dict(OWN, asg=None), scopes='asg')
+    assert in_scope(_instance(asg='db'))
+
+
+def test_tags_only_apply_to_the_tag_scope():
+    tags = {'Role': 'db'}
+    assert aws_neighbours.scope_filter(OWN, tags=tags)(_instance())
+    in_scope = aws_neighbours.scope_filter(OWN, scopes=['tag'], tags=tags)
+    assert not in_scope(_instance())
+    assert in_scope(_instance(tags={'Role': 'db', 'Env': 'prod'}))
@@ -0,0 +1,133 @@
+"""
+Tests for the host wide rate limiter of AWS calls.
+"""
+import pytest
+
+import aws_metadata
+import aws_ratelimit
+
+
+class Response(object):
+
+    def __init__(self, status, code=None):
+        self.status = status
+        self.body = '<Code>{}</Code>'.format(code) if code else ''
+
+    def read(self):
+        return self.body
+
+
+class Connection(object):
+    """
+    Stand-in for a boto connection answering with responses in turn.
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def make_request(self, *args, **kwargs):
+        self.requests += 1
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def limiter(monkeypatch, tmpdir):
+    """
+    A limiter of 2 calls burst and 20 calls per second, with its state in a
+    temporary directory. Returns the list of the sleeps it makes.
+    """
+    monkeypatch.setattr(aws_ratelimit, 'STATE_FILE',
+                        str(tmpdir.join('ratelimit.json')))
+    monkeypatch.setattr(aws_ratelimit, 'LOCK_FILE',
+                        str(tmpdir.join('ratelimit.lock')))
+    monkeypatch.setattr(aws_ratelimit, 'CAPACITY', 2.0)
+    monkeypatch.setattr(aws_ratelimit, 'RATE', 20.0)
+    monkeypatch.setattr(aws_ratelimit, 'RATE_RECOVERY', 0)
+    monkeypatch.setattr(aws_ratelimit, 'BACKOFF', 0.01)
+    monkeypatch.setattr(aws_ratelimit, '_stats', dict(
+        calls=0, throttles=0, retries=0, throttled_seconds=0.0))
+    sleeps = []
+    real_sleep = aws_ratelimit.time.sleep
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        real_sleep(seconds)
+
+    monkeypatch.setattr(aws_ratelimit.time, 'sleep', sleep)
+    return sleeps
+
+
+def _state():
+    return aws_metadata.read_json(aws_ratelimit.STATE_FILE)
+
+
+def test_burst_is_not_delayed(limiter):
+    assert aws_ratelimit.acquire() == 0
+    assert aws_ratelimit.acquire() == 0
+    assert limiter == []
+    assert _state()['tokens'] < 1
+
+
+def test_calls_beyond_the_burst_wait_for_a_token(limiter):
+    for _ in range(3):
+        waited = aws_ratelimit.acquire()
+
+    # One token at 20 per second, plus up to half again of jitter
+    assert 0 < waited <= 0.075
+    assert aws_ratelimit.get_stats()['calls'] == 3
+
+
+def test_throttle_halves_the_rate_and_backs_off_every_caller(limiter):
+    backoff = aws_ratelimit.throttled(0)
+
+    assert 0.01 <= backoff <= 0.02
+    assert _state()['rate'] == 10.0
+    # The next caller, whichever process, waits out the backoff
+    assert aws_ratelimit.acquire() > 0
+    assert aws_ratelimit.get_stats()['throttles'] == 1
+
+
+def test_rate_does_not_drop_below_the_minimum(limiter, monkeypatch):
+    monkeypatch.setattr(aws_ratelimit, 'BACKOFF', 0)
+    for attempt in range(10):
+        aws_ratelimit.throttled(0)
+    assert _state()['rate'] == aws_ratelimit.MIN_RATE
+
+
+def test_throttled_requests_are_retried(limiter):
+    connection = aws_ratelimit.limit_connection(Connection(
+        Response(400, 'RequestLimitExceeded'), Response(503, 'Throttling'),
+        Response(200)))
+
+    assert connection.make_request('DescribeInstances').status == 200
+    assert connection.requests == 3
+    assert aws_ratelimit.get_stats()['retries'] == 2
+
+
+def test_other_errors_are_not_retried(limiter):
+    connection = aws_ratelimit.limit_connection(Connection(
+        Response(400, 'InvalidInstanceID.NotFound'), Response(200)))
+
+    assert connection.make_request('DescribeInstances').status == 400
+    assert connection.requests == 1
+
+
+def test_retries_stop_after_max_retries(limiter, monkeypatch):
+    monkeypatch.setattr(aws_ratelimit, 'MAX_RETRIES', 2)
+    monkeypatch.setattr(aws_ratelimit, 'BACKOFF', 0)
+    connection = aws_ratelimit.limit_connection(Connection(
+        *[Response(400, 'Throttling')] * 4))
+
+    assert connection.make_request('DescribeInstances').status == 400
+    assert connection.requests == 3
+
+
+def test_calls_are_not_blocked_without_shared_state(limiter, monkeypatch,
+                                                    tmpdir):
+    tmpdir.join('file').write('')
+    monkeypatch.setattr(aws_ratelimit, 'LOCK_FILE',
+                        str(tmpdir.join('file', 'ratelimit.lock')))
+
+    for _ in range(5):
+        assert aws_ratelimit.acquire() == 0
+    assert limiter == []
@@ -0,0 +1,47 @@
+"""
+Tests for the AWS call stats.
+"""
+import pytest
+
+import aws_stats
+
+
+@pytest.fixture
+def stats_file(tmpdir):
+    """
+    A stats file with calls in the grains.elb_lbs and asg scopes.
+    """
+    path = str(tmpdir.join('call-stats.json'))
+    for name in ('grains.elb_lbs', 'asg'):
+        with aws_stats.scope(name, timed=False):
+            aws_stats.record('ec2', 'eu-west-1', 'DescribeInstances', 0.1)
+    aws_stats.flush(path)
+    return path
+
+
+def _calls(data, name):
+    scope = data['scopes'].get(name)
+    return sum(op['calls'] for op in scope['operations'].values()) \
+        if scope else None
+
+
+def test_read_counts_scopes_from_the_file_start(stats_file):
+    data = aws_stats.read(stats_file)
+    assert _calls(data, 'grains.elb_lbs') == 1
+    assert data['scopes']['asg']['since'] == data['since']
+
+
+def test_reset_starts_every_scope_again(stats_file):
+    before = aws_stats.read(stats_file, reset=True)
+    assert _calls(before, 'asg') == 1
+    assert aws_stats.read(stats_file)['scopes'] == {}
+
+
+def test_reset_of_some_scopes_keeps_the_others(stats_file):
+    before = aws_stats.read(stats_file, reset=True, scopes=['asg', 'none'])
+    assert _calls(before, 'asg') == 1
+    after = aws_stats.read(stats_file)
+    assert sorted(after['scopes']) == ['asg', 'grains.elb_lbs']
+    assert _calls(after, 'asg') == 0
+    assert after['scopes']['asg']['since'] > after['since']
+    assert _calls(after, 'grains.elb_lbs') == 1
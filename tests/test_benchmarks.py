@@ -0,0 +1,26 @@
+"""
+Tests for the stand-ins for AWS used by the benchmarks.
+"""
+import pytest
+
+pytest.importorskip('boto')
+
+import aws_stub  # noqa: E402
+
+
+def test_stubs_match_boto():
+    assert aws_stub.check_signatures() == []
+
+
+def test_address_stub_refuses_associated_addresses():
+    fleet = aws_stub.Fleet(2, aws_stub.Meter(), lbs=0, eips=1)
+    ec2 = aws_stub.EC2Stub(fleet)
+    ec2.get_all_addresses()[0].associate(instance_id=fleet.instances[0]['id'])
+    with pytest.raises(aws_stub.EC2ResponseError) as error:
+        ec2.get_all_addresses()[0].associate(
+            instance_id=fleet.instances[1]['id'])
+    assert error.value.error_code == 'Resource.AlreadyAssociated'
+    ec2.get_all_addresses()[0].associate(
+        network_interface_id=fleet.instances[1]['interface_id'],
+        allow_reassociation=True)
+    assert fleet.addresses[0]['instance_id'] == fleet.instances[1]['id']
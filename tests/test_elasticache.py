@@ -0,0 +1,140 @@
+"""
+Tests for the endpoint ordering of the elasticache grain.
+"""
+import pytest
+
+pytest.importorskip('boto')
+
+
+@pytest.fixture
+def elasticache(load_module):
+    return load_module('_grains/elasticache.py')
+
+
+def _endpoint(name):
+    return {'Address': name + '.cache.amazonaws.com', 'Port': 6379}
+
+
+def _member(name, az, role=None, endpoint=True):
+    member = {'CacheClusterId': name, 'CacheNodeId': '0001',
+              'PreferredAvailabilityZone': az}
+    if role:
+        member['CurrentRole'] = role
+    if endpoint:
+        member['ReadEndpoint'] = _endpoint(name)
+    return member
+
+
+def _addresses(endpoints):
+    return [e['Address'].split('.')[0] for e in endpoints]
+
+
+def test_read_endpoints_are_local_first_then_replicas(elasticache):
+    members = [_member('a-primary', 'eu-west-1a', 'primary'),
+               _member('b-replica', 'eu-west-1b', 'replica'),
+               _member('a-replica', 'eu-west-1a', 'replica'),
+               _member('c-replica', 'eu-west-1c', 'replica'),
+               _member('a-none', 'eu-west-1a', 'replica', endpoint=False)]
+    assert _addresses(elasticache._read_endpoints(members, 'eu-west-1a')) == [
+        'a-replica', 'a-primary', 'b-replica', 'c-replica']
+
+
+def test_shard_with_roles(elasticache):
+    shard = elasticache._shard({
+        'NodeGroupId': '0001',
+        'PrimaryEndpoint': _endpoint('primary'),
+        'NodeGroupMembers': [_member('a', 'eu-west-1a', 'primary'),
+                             _member('b', 'eu-west-1b', 'replica'),
+                             _member('c', 'eu-west-1c', 'replica')],
+    }, 'eu-west-1c')
+    assert shard['primary_endpoint'] == _endpoint('primary')
+    assert _addresses(shard['replica_endpoints']) == ['c', 'b']
+    assert shard['nearest_read_endpoint'] == _endpoint('c')
+
+
+def test_shard_without_replicas_reads_from_the_primary(elasticache):
+    shard = elasticache._shard({
+        'NodeGroupId': '0001',
+        'NodeGroupMembers': [_member('a', 'eu-west-1a', 'primary')],
+    }, 'eu-west-1b')
+    assert shard['primary_endpoint'] == _endpoint('a')
+    assert shard['replica_endpoints'] == []
+    assert shard['nearest_read_endpoint'] == _endpoint('a')
+
+
+class CacheClusters(object):
+    """
+    Answers DescribeCacheClusters for one cache cluster at a time.
+    """
+    def __init__(self, clusters):
+        self.clusters = dict((c['CacheClusterId'], c) for c in clusters)
+        self.calls = []
+
+    def describe_cache_clusters(self, cache_cluster_id=None, max_records=None,
+                                marker=None, show_cache_node_info=None):
+        self.calls.append(cache_cluster_id)
+        return {'DescribeCacheClustersResponse': {
+            'DescribeCacheClustersResult': {
+                'CacheClusters': [self.clusters[cache_cluster_id]],
+                'Marker': None}}}
+
+
+def _cluster(name):
+    return {'CacheClusterId': name, 'ReplicationGroupId': 'rg',
+            'CacheNodes': [{'CacheNodeId': '0001',
+                            'Endpoint': _endpoint(name)}]}
+
+
+def test_node_endpoints_describe_only_new_member_clusters(elasticache):
+    conn = CacheClusters([_cluster('rg-0001-001'), _cluster('rg-0001-002')])
+    endpoints = elasticache._node_endpoints(
+        conn, ['rg-0001-001', 'rg-0001-002'], {})
+    assert conn.calls == ['rg-0001-001', 'rg-0001-002']
+    assert endpoints['rg-0001-002'] == {'0001': _endpoint('rg-0001-002')}
+
+    del conn.calls[:]
+    endpoints = elasticache._node_endpoints(
+        conn, ['rg-0001-002'], endpoints)
+    assert conn.calls == []
+    assert sorted(endpoints) == ['rg-0001-002']
+
+
+def test_cluster_mode_shard_from_node_endpoints(elasticache):
+    endpoints = elasticache._node_endpoints(
+        CacheClusters([_cluster('rg-0001-001'), _cluster('rg-0001-002')]),
+        ['rg-0001-001', 'rg-0001-002'], {})
+    node_group = {
+        'NodeGroupId': '0001',
+        'Slots': '0-16383',
+        'NodeGroupMembers': [
+            _member('rg-0001-001', 'eu-west-1a', endpoint=False),
+            _member('rg-0001-002', 'eu-west-1b', endpoint=False)],
+    }
+    shard = elasticache._shard(
+        elasticache._with_node_endpoints(node_group, endpoints), 'eu-west-1b')
+    assert 'ReadEndpoint' not in node_group['NodeGroupMembers'][0]
+    assert shard['primary_endpoint'] is None
+    assert _addresses(shard['replica_endpoints']) == ['rg-0001-002',
+                                                      'rg-0001-001']
+    assert shard['slots'] == '0-16383'
+
+
+def test_unchanged_group_reuses_the_cached_endpoints(elasticache, fleet,
+                                                     monkeypatch):
+    import aws_stub
+    shards = []
+    shard = elasticache._shard
+    monkeypatch.setattr(elasticache, '_shard', lambda *args: (
+        shards.append(args) or shard(*args)))
+    grain = elasticache._collect()
+    assert len(grain['elasticache']['shards']) == aws_stub.CACHE_SHARDS
+    del shards[:]
+    fleet.meter.reset()
+
+    assert elasticache._collect() == grain
+    assert shards == []
+    assert fleet.meter.report()['operations'] == {
+        'DescribeReplicationGroups': 1}
+
+    monkeypatch.setattr(aws_stub, 'CACHE_SHARDS', 2)
+    assert len(elasticache._collect()['elasticache']['shards']) == 2
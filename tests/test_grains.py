@@ -0,0 +1,58 @@
+"""
+Tests for loading the AWS grains through salt's loader.
+"""
+import os
+
+import pytest
+
+salt_config = pytest.importorskip('salt.config')
+salt_loader = pytest.importorskip('salt.loader')
+
+import aws_collector  # noqa: E402
+from conftest import ROOT  # noqa: E402
+
+
+def _minion_opts(tmpdir, **options):
+    extmods = tmpdir.mkdir('extmods')
+    os.symlink(os.path.join(ROOT, '_grains'), str(extmods.join('grains')))
+    opts = salt_config.minion_config(None)
+    opts['extension_modules'] = str(extmods)
+    opts['cachedir'] = str(tmpdir.mkdir('cache'))
+    opts.update(options)
+    return opts
+
+
+def _refresh(load_module, opts):
+    aws = load_module('_modules/aws.py')
+    aws.__opts__ = opts
+    aws.__grains__ = {}
+    aws.__salt__ = {'saltutil.refresh_grains': lambda: None,
+                    'event.send': lambda tag, data: None}
+    return aws.refresh_if_changed()
+
+
+def _elb_operations(fleet):
+    return [op for op in fleet.meter.report()['operations']
+            if 'LoadBalancer' in op or 'TargetGroup' in op]
+
+
+def test_grains_register_when_loaded(fleet, load_module, tmpdir):
+    opts = _minion_opts(tmpdir)
+    list(salt_loader.grain_funcs(opts))
+    assert aws_collector.registered() == ['ec2_neighbours', 'elasticache',
+                                          'elb_lbs']
+
+    _refresh(load_module, opts)
+
+    assert _elb_operations(fleet)
+
+
+def test_pillar_mode_makes_no_elb_calls(fleet, load_module, tmpdir):
+    opts = _minion_opts(tmpdir, aws_topology_source='pillar')
+    list(salt_loader.grain_funcs(opts))
+    assert aws_collector.registered() == ['ec2_neighbours', 'elasticache']
+
+    ret = _refresh(load_module, opts)
+
+    assert sorted(ret) == ['ec2_neighbours', 'elasticache']
+    assert not _elb_operations(fleet)